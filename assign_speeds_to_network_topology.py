@@ -24,6 +24,10 @@ if __name__ == "__main__":
         "'tram' or 'bus'.")
     parser.add_option('--speed_funcs', dest='speed_funcs', help="Name in "\
         "register of speed functions to use.")
+    parser.add_option('--write_batch_size', dest='write_batch_size',
+        help="(Optional) Number of segments to write per transaction, if "\
+        "the segments file format supports transactions (default %d)." \
+        % seg_speed_models.DEFAULT_SPEEDS_WRITE_BATCH_SIZE)
     (options, args) = parser.parse_args()
 
     if options.inputsegments is None:
@@ -45,6 +49,13 @@ if __name__ == "__main__":
             "Allowed choice of speed_funcs is %s" \
             % (sorted(seg_speed_models.SPEED_FUNC_SETS_REGISTER.keys())))
         
+    write_batch_size = None
+    if options.write_batch_size:
+        write_batch_size = int(options.write_batch_size)
+        if write_batch_size < 1:
+            parser.print_help()
+            parser.error("Write batch size given must be at least 1.")
+
     mode_config = m_t_info.settings[options.service]
     check_func, offpeak_func, peak_func = \
         seg_speed_models.SPEED_FUNC_SETS_REGISTER[options.speed_funcs]
@@ -62,7 +73,7 @@ if __name__ == "__main__":
         "Register under name '%s'" % options.speed_funcs
     speed_model = seg_speed_models.PerSegmentPeakOffPeakSpeedModel()
     speed_model.assign_speeds_to_all_segments(route_segments_lyr, mode_config,
-        check_func, offpeak_func, peak_func)
+        check_func, offpeak_func, peak_func, write_batch_size)
 
     # Close the shape files - includes making sure it writes
     route_segments_shp.Destroy()
@@ -260,7 +260,8 @@ def main():
     parser.add_option('--service', dest='service',
         help="Should be one of %s" % allowedServs)
     parser.add_option('--input_speeds_dir', dest='input_speeds_dir', 
-        help='Path in which to read input speeds files.')
+        help='Path in which to read input speeds files (can also be a '\
+            'speeds pack file created by speeds_pack.py).')
     parser.add_option('--output_speeds_dir', dest='output_speeds_dir', 
         help='Path in which to create output speeds files.')
     parser.add_option('--speed_func', dest='speed_func',
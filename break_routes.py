@@ -332,8 +332,8 @@ def main():
     parser.add_option('--service', dest='service',
         help="Should be one of %s" % allowedServs)
     parser.add_option('--input_speeds_dir', dest='input_speeds_dir',
-        help="(Optional) Path of directory containing speeds for input routes"
-            "- will be updated to output_speeds_dir.")
+        help="(Optional) Path of directory (or speeds pack file) containing "
+            "speeds for input routes - will be updated to output_speeds_dir.")
     parser.add_option('--output_speeds_dir', dest='output_speeds_dir',
         help="(Optional) Path of directory to save output speeds to."\
             "(Requires input_speeds_dir also specified).")
@@ -7,7 +7,6 @@ import os, sys
 import os.path
 import operator
 import csv
-import glob
 from optparse import OptionParser
 
 import misc_utils
@@ -18,7 +17,8 @@ SPEED_ROUND_PLACES = 3
 def main():
     parser = OptionParser()
     parser.add_option('--input_dir_speeds', dest='input_dir_speeds',
-        help='Directory to input avg speed files to read from.')
+        help='Directory to input avg speed files to read from (or a '\
+            'speeds pack file created by speeds_pack.py).')
     parser.add_option('--output_dir_speeds', dest='output_dir_speeds',
         help='Directory to output avg speed files to create.')
     parser.add_option('--speed_ratio', dest='speed_ratio',
@@ -55,8 +55,8 @@ def main():
         "changing them by ratio of %f, and saving modified results to dir "\
         "%s ..." % (input_dir_speeds, speed_ratio, output_dir_speeds)
 
-    for ii, csv_speeds_in_fname in enumerate(glob.glob("%s%s*speeds*.csv" \
-            % (input_dir_speeds, os.sep))):
+    for ii, csv_speeds_in_fname in enumerate(
+            tps_speeds_model.get_all_avg_speeds_fnames(input_dir_speeds)):
         #print "Reading speeds in file %s" % csv_speeds_in_fname
         fname_sections = os.path.basename(csv_speeds_in_fname).split('-')
         serv_period = fname_sections[-3]
@@ -8,14 +8,16 @@ import re
 import csv
 import inspect
 import copy
-from datetime import datetime, date, time, timedelta
+from datetime import date, timedelta
 from optparse import OptionParser
 import sys
 import os.path
 import operator
+import multiprocessing
+import itertools
 
 import osgeo.ogr
-from osgeo import ogr
+from osgeo import ogr, osr
 import transitfeed
 
 import parser_utils
@@ -24,7 +26,13 @@ import mode_timetable_info as m_t_info
 import topology_shapefile_data_model as tp_model
 import route_segs
 import seg_speed_models
+import speed_funcs_vehicle_based
 import time_periods_hways_model as tps_hways_model
+import gtfs_stream_writer
+import gtfs_build_cache
+import speed_model_snapshot
+import speeds_pack
+import stage_stats
 
 # Will determine how much infor is printed.
 VERBOSE = False
@@ -34,6 +42,18 @@ TODAY = date.today()
 
 ROUTE_WRITE_BATCH_DEF_SIZE = 20
 
+# GTFS stop locations are in Lat/Lon WGS84.
+GTFS_EPSG = 4326
+
+# Allowed ways of writing the output GTFS file:-
+#  'transitfeed': build a complete transitfeed Schedule in memory (or its DB),
+#   validate it, then write it.
+#  'stream': write trips and stop times straight to the output as they are
+#   generated. Much less memory for large networks, but not validated.
+WRITER_TRANSITFEED = 'transitfeed'
+WRITER_STREAM = 'stream'
+ALLOWED_WRITERS = [WRITER_TRANSITFEED, WRITER_STREAM]
+
 class Seq_Stop_Info:
     """A small struct to store key info about a stop in the sequence of a
     particular route, pulled from the Shapefiles, that will be later used
@@ -51,26 +71,80 @@ class Seq_Stop_Info:
         self.extra_speed_info = speed_model.save_extra_seg_speed_info(
             next_segment, serv_period, travel_dir)
 
-    def calc_time_on_next_segment(self, speed_model, mode_config, curr_time,
+    def calc_time_on_next_segment(self, speed_model, mode_config, curr_secs,
             peak_status):
-        """Calculates travel time between two stops. Current algorithm is 
-        based on an average speed on that segment, and physical distance
-        between them."""
+        """Calculates travel time between two stops, in integer seconds.
+        curr_secs is the time at the stop, in seconds since midnight.
+        Current algorithm is based on an average speed on that segment, and
+        physical distance between them."""
         if self.dist_km_to_next < (1 / 1000.0):
             # Defensive case for weird very short segments, which sometimes
             #  happens in GTFS files.
-            return timedelta(seconds=1.0)
+            return 1
 
         seg_speed = speed_model.get_speed_on_next_segment(self.extra_speed_info,
-            curr_time, peak_status)
+            timedelta(seconds=curr_secs), peak_status)
         assert seg_speed > 0
         time_hrs = self.dist_km_to_next / float(seg_speed)
-        # Need to round this to nearest second and return as a timedelta.
-        return timedelta(seconds=round(time_hrs * 3600))
+        # Need to round this to nearest second.
+        return int(round(time_hrs * 3600))
  
+class Trip_Run:
+    """A small struct to store a run of consecutive trips in a trip set,
+    starting in the same time period at a constant headway, and with
+    identical stop time offsets. These can be written as one trip, plus a
+    frequencies.txt entry (with exact_times=1)."""
+    def __init__(self, trip_id, period_i, start_secs, stop_offsets):
+        self.trip_id = trip_id
+        self.period_i = period_i
+        self.start_secs = start_secs
+        self.last_start_secs = start_secs
+        self.stop_offsets = stop_offsets
+        self.hway_secs = None
+        self.n_trips = 1
+
+    def try_extend(self, period_i, start_secs, stop_offsets):
+        """Adds a trip to the run, if it belongs in it. Returns whether it
+        did."""
+        if period_i != self.period_i or stop_offsets != self.stop_offsets:
+            return False
+        hway_secs = start_secs - self.last_start_secs
+        if hway_secs <= 0 \
+                or (self.hway_secs is not None and hway_secs != self.hway_secs):
+            return False
+        self.hway_secs = hway_secs
+        self.last_start_secs = start_secs
+        self.n_trips += 1
+        return True
+
+def get_stop_list_and_seg_info_along_route(route_def, serv_period, dir_id,
+        route_segments_shp, stops_shp, mode_config, schedule, seg_speed_model,
+        stop_id_to_gtfs_stop_id_map, route_stop_lists):
+    """Sets up the speed model for the trip set, and returns its stop list.
+    route_stop_lists is a dict of the stop lists already built for other trip
+    sets of the route, keyed by direction and speed model signature :- if
+    the speed model says a stop list with the same signature can be shared,
+    it is re-used rather than read from the segments again."""
+    seg_speed_model.setup_for_trip_set(route_def, serv_period, dir_id)
+    stop_list_key = (dir_id, seg_speed_model.get_stop_list_signature(
+        route_def, serv_period, dir_id))
+    try:
+        prebuilt_stop_info_list = route_stop_lists[stop_list_key]
+    except KeyError:
+        prebuilt_stop_info_list = build_stop_list_and_seg_info_along_route(
+            route_def, serv_period, dir_id, route_segments_shp, stops_shp,
+            mode_config, schedule, seg_speed_model,
+            stop_id_to_gtfs_stop_id_map)
+        route_stop_lists[stop_list_key] = prebuilt_stop_info_list
+    else:
+        seg_speed_model.reuse_extra_seg_speed_infos(
+            [s_info.extra_speed_info for s_info in prebuilt_stop_info_list])
+    return prebuilt_stop_info_list
+
 def build_stop_list_and_seg_info_along_route(route_def, serv_period, dir_id,
         route_segments_shp, stops_shp, mode_config, schedule, seg_speed_model,
         stop_id_to_gtfs_stop_id_map):
+    """Note: seg_speed_model.setup_for_trip_set() should be called first."""
 
     prebuilt_stop_info_list = []
     if len(route_def.ordered_seg_ids) == 0:
@@ -80,14 +154,13 @@ def build_stop_list_and_seg_info_along_route(route_def, serv_period, dir_id,
     route_segments_lyr = route_segments_shp.GetLayer(0)
     stops_lyr = stops_shp.GetLayer(0)
 
-    seg_speed_model.setup_for_trip_set(route_def, serv_period, dir_id)
-
     # Apply a filter to speed up calculations - only segments on this route.
     where_clause = "%s LIKE '%%%s' OR %s LIKE '%%%s,%%'" % \
         (tp_model.SEG_ROUTE_LIST_FIELD, route_def.id,\
         tp_model.SEG_ROUTE_LIST_FIELD, route_def.id)
     route_segments_lyr.SetAttributeFilter(where_clause)
     segs_lookup_table = tp_model.build_segs_lookup_table(route_segments_lyr)
+    stage_stats.add_count('shapefile_feature_reads', len(segs_lookup_table))
 
     ordered_seg_refs = route_segs.create_ordered_seg_refs_from_ids(
         route_def.ordered_seg_ids, segs_lookup_table)
@@ -154,16 +227,55 @@ def create_gtfs_route_entries(route_defs, mode_config, schedule):
         schedule.AddRouteObject(route)
     return route_id_to_gtfs_route_id_map        
 
-def create_gtfs_stop_entries(stops_shapefile, mode_config, schedule):
+class Stops_Table:
+    """A compact in-memory table of the stops in the stops shapefile, with
+    everything needed to create their GTFS stop entries :- so the shapefile
+    only needs to be read once, however many schedules are created."""
+    def __init__(self):
+        self.stop_ids = []
+        self.gtfs_stop_ids = []
+        self.names = []
+        self.lats = []
+        self.lngs = []
+        self.stop_id_to_gtfs_stop_id_map = {}
+
+    def add_stop(self, stop_id, gtfs_stop_id, name, lat, lng):
+        self.stop_ids.append(stop_id)
+        self.gtfs_stop_ids.append(gtfs_stop_id)
+        self.names.append(name)
+        self.lats.append(lat)
+        self.lngs.append(lng)
+        self.stop_id_to_gtfs_stop_id_map[stop_id] = gtfs_stop_id
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+def read_stops_table(stops_shapefile, mode_config):
     """This function requires that in the stops shapefile, there is an
     attribute called 'Name' listing the name of the stop. (Note: it is ok if
     this is actually just a number, but it will be treated as a string.)"""
 
     print "%s() called." % inspect.stack()[0][3]
 
-    stop_id_to_gtfs_stop_id_map = {}
+    stops_table = Stops_Table()
     layer = stops_shapefile.GetLayer(0)
     stop_prefix = mode_config['stop_prefix']
+    # GTFS needs stop locations in Lat/Lon WGS84.
+    stops_srs = layer.GetSpatialRef()
+    gtfs_srs = osr.SpatialReference()
+    gtfs_srs.ImportFromEPSG(GTFS_EPSG)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        # GDAL 3+ otherwise uses the EPSG axis order (lat, lon) for
+        #  EPSG:4326, but we read transformed points as X = lon, Y = lat.
+        gtfs_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if stops_srs is not None:
+            # (A copy, so the layer's own spatial ref isn't changed.)
+            stops_srs = stops_srs.Clone()
+            stops_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if stops_srs is None or stops_srs.IsSame(gtfs_srs):
+        transform = None
+    else:
+        transform = osr.CoordinateTransformation(stops_srs, gtfs_srs)
     for stop_cnt, stop_feature in enumerate(layer):
         
         stop_id = stop_feature.GetField(tp_model.STOP_ID_FIELD)
@@ -179,16 +291,59 @@ def create_gtfs_stop_entries(stops_shapefile, mode_config, schedule):
             stop_name = tp_model.get_stop_feature_default_name(stop_feature,
                 stop_prefix)
         assert stop_name
-        stop_desc = None
-        stop_code = None
         stop_id_gtfs = str(mode_config['index'] + stop_cnt)
-        stop_id_to_gtfs_stop_id_map[stop_id] = stop_id_gtfs
         geom = stop_feature.GetGeometryRef()
+        if transform is not None:
+            geom = geom.Clone()
+            geom.Transform(transform)
         lng = geom.GetX()
         lat = geom.GetY() 
-        # TODO: For now assume they are in Lat/Lon WGS84 - really should
-        # double-check and do a coordinate transform if not.
+        stops_table.add_stop(stop_id, stop_id_gtfs, stop_name, lat, lng)
+        stage_stats.add_count('shapefile_feature_reads')
+    stage_stats.add_count('stops', len(stops_table))
+    # See http://gis.stackexchange.com/questions/76683/python-ogr-nested-loop-only-loops-once
+    layer.ResetReading() # Necessary as we need to loop thru again later
+    return stops_table
+
+def build_seg_stop_ids_map(segs_layer):
+    """Returns a dict of the IDs of the stops at each end of each segment,
+    keyed by segment ID."""
+    seg_stop_ids_map = {}
+    for seg_feature in segs_layer:
+        seg_id = int(seg_feature.GetField(tp_model.SEG_ID_FIELD))
+        seg_stop_ids_map[seg_id] = tp_model.get_stop_ids_of_seg(seg_feature)
+        seg_feature.Destroy()
+    segs_layer.ResetReading()
+    stage_stats.add_count('shapefile_feature_reads', len(seg_stop_ids_map))
+    return seg_stop_ids_map
 
+def get_stop_ids_used_by_routes(route_defs, seg_stop_ids_map):
+    stop_ids = set()
+    for route_def in route_defs:
+        for seg_id in route_def.ordered_seg_ids:
+            try:
+                stop_ids.update(seg_stop_ids_map[seg_id])
+            except KeyError:
+                # Will be reported when creating the route's trips.
+                pass
+    return stop_ids
+
+def create_gtfs_stop_entries(stops_table, mode_config, schedule,
+        stop_ids=None):
+    """Adds the stops in stops_table to the schedule (only those with IDs in
+    stop_ids, if given). Returns a map of all stop IDs in the table to
+    their GTFS stop IDs."""
+
+    print "%s() called." % inspect.stack()[0][3]
+
+    for ii, stop_id in enumerate(stops_table.stop_ids):
+        if stop_ids is not None and stop_id not in stop_ids:
+            continue
+        stop_id_gtfs = stops_table.gtfs_stop_ids[ii]
+        stop_name = stops_table.names[ii]
+        lat = stops_table.lats[ii]
+        lng = stops_table.lngs[ii]
+        stop_code = None
         stop = transitfeed.Stop(
             stop_id = stop_id_gtfs,
             name = stop_name,
@@ -200,9 +355,7 @@ def create_gtfs_stop_entries(stops_shapefile, mode_config, schedule):
             print "Adding stop with ID %s, name '%s', lat,long of (%3f,%3f)" % \
                 (stop_id_gtfs, stop_name, lat, lng)
         schedule.AddStopObject(stop)
-    # See http://gis.stackexchange.com/questions/76683/python-ogr-nested-loop-only-loops-once
-    layer.ResetReading() # Necessary as we need to loop thru again later
-    return stop_id_to_gtfs_stop_id_map       
+    return stops_table.stop_id_to_gtfs_stop_id_map
 
 def add_service_period(days_week_str, schedule):    
     service_period = transitfeed.ServicePeriod(id=days_week_str)
@@ -241,36 +394,47 @@ def create_gtfs_trips_stoptimes(route_defs, route_segments_shp, stops_shp,
         mode_config, schedule, seg_speed_model, route_id_to_gtfs_id_map,
         stop_id_to_gtfs_stop_id_map, initial_trip_id=None,
         per_route_hways=None,
-        hways_tps=None):
+        hways_tps=None,
+        gtfs_writer=None,
+        use_frequencies=False):
     """This function creates the GTFS trip and stoptime entries for every trip.
 
     It requires route definitions linking route names to a definition of
     segments in a shapefile.
+
+    If gtfs_writer is given (a GTFSStreamWriter), trips and stop times are
+    written out via it, rather than being added to the schedule.
+
+    Returns the number of trips created (including those represented by
+    frequencies entries, if use_frequencies is set :- see
+    create_gtfs_trips_stoptimes_for_route()).
     """ 
     # Build this now for fast lookups.
     # Initialise trip_id and counter
     # Need to check existing trip count so updates are right numbers
     if initial_trip_id:
         trip_ctr = initial_trip_id
+    elif gtfs_writer:
+        trip_ctr = gtfs_writer.trips_written
     else:
         trip_ctr = len(schedule.trips)
+    init_trip_ctr = trip_ctr
     # Do routes and directions as outer loops rather than service periods - as 
     # allows maximal pre-calculation
     sorted_route_defs = sorted(route_defs,
         key=route_segs.get_route_order_key_from_name)
     for ii, route_def in enumerate(sorted_route_defs):
         gtfs_route_id = route_id_to_gtfs_id_map[route_def.id]
-        avg_hways_for_route = None
-        if per_route_hways:
-            gtfs_origin_r_id = route_def.gtfs_origin_id
-            avg_hways_for_route = per_route_hways[gtfs_origin_r_id]
+        avg_hways_for_route = get_avg_hways_for_route(route_def,
+            per_route_hways)
         ntrips_this_route = create_gtfs_trips_stoptimes_for_route(
             route_def, route_segments_shp,
             stops_shp, mode_config, schedule, seg_speed_model,
             gtfs_route_id, stop_id_to_gtfs_stop_id_map,
-            trip_ctr, avg_hways_for_route, hways_tps)
+            trip_ctr, avg_hways_for_route, hways_tps, gtfs_writer,
+            use_frequencies)
         trip_ctr += ntrips_this_route    
-    return
+    return trip_ctr - init_trip_ctr
 
 def get_service_infos_in_dir(services_infos_by_dir_period_pair, direction):
     service_infos_in_dir = {}
@@ -281,10 +445,100 @@ def get_service_infos_in_dir(services_infos_by_dir_period_pair, direction):
             service_infos_in_dir[serv_period] = serv_headways
     return service_infos_in_dir
 
+def get_avg_hways_for_route(route_def, per_route_hways):
+    avg_hways_for_route = None
+    if per_route_hways:
+        gtfs_origin_r_id = route_def.gtfs_origin_id
+        avg_hways_for_route = per_route_hways[gtfs_origin_r_id]
+    return avg_hways_for_route
+
+def get_serv_periods_for_route(services_info, avg_hways_for_route):
+    if not avg_hways_for_route:
+        serv_periods = map(operator.itemgetter(0), services_info)
+    else:
+        serv_periods = sorted(set(map(operator.itemgetter(1), 
+            avg_hways_for_route.keys())))
+    return serv_periods
+
+def get_serv_headways_for_route(route_def, dir_id, sp_i, serv_period,
+        services_info, avg_hways_for_route, hways_tps):
+    serv_headways = None
+    if not avg_hways_for_route:
+        serv_headways = services_info[sp_i][1]
+    else:
+        direction = route_def.dir_names[dir_id]
+        try:
+            avg_hways_for_route_in_dir_period = \
+                avg_hways_for_route[(direction, serv_period)]
+        except KeyError:
+            # In some cases for bus loops, we had to manually add a
+            # reverse dir, so try other one.
+            other_dir = route_def.dir_names[1 - dir_id]
+            avg_hways_for_route_in_dir_period = \
+                avg_hways_for_route[(other_dir, serv_period)]
+        serv_headways = tps_hways_model.get_tp_hways_tuples(\
+            avg_hways_for_route_in_dir_period, hways_tps)
+    assert serv_headways
+    return serv_headways
+
+def get_trip_start_times_in_serv_headways(serv_hways_secs):
+    """Generator of the (time period index, start time) of each trip that
+    should be created for a given list of service headways (as a
+    m_t_info.ServiceHeadwaysSecs). Start times are in seconds since
+    midnight, keeping any fraction of a second from fractional headways,
+    so speed models see the exact time (only GTFS output times are
+    rounded down to whole seconds)."""
+    for curr_tp_i, hway_usecs in enumerate(serv_hways_secs.hway_usecs):
+        hw_min = serv_hways_secs.serv_headways[curr_tp_i][m_t_info.HWAY_COL]
+        if hw_min <= 0:
+            # No trips should start during this period.
+            # Skip ahead straight to next.
+            continue
+        # Increment in microseconds, so fractional second headways
+        # accumulate exactly.
+        period_start_usecs = serv_hways_secs.start_secs[curr_tp_i] * 1000000
+        period_duration_usecs = \
+            serv_hways_secs.duration_secs[curr_tp_i] * 1000000
+        curr_period_inc = 0
+        while curr_period_inc < period_duration_usecs:
+            curr_start_secs = (period_start_usecs + curr_period_inc) \
+                % (misc_utils.SECS_PER_DAY * 1000000) / 1000000.0
+            yield curr_tp_i, curr_start_secs
+            curr_period_inc += hway_usecs
+    return
+
+def count_trips_for_route(route_def, mode_config, avg_hways_for_route=None,
+        hways_tps=None):
+    """Number of trips create_gtfs_trips_stoptimes_for_route() will create
+    for a route. (Depends only on headways, not speeds, so is cheap.)"""
+    ntrips = 0
+    services_info = mode_config['services_info']
+    serv_periods = get_serv_periods_for_route(services_info,
+        avg_hways_for_route)
+    for dir_id, direction in enumerate(route_def.dir_names):
+        for sp_i, serv_period in enumerate(serv_periods):
+            serv_headways = get_serv_headways_for_route(route_def, dir_id,
+                sp_i, serv_period, services_info, avg_hways_for_route,
+                hways_tps)
+            serv_hways_secs = m_t_info.ServiceHeadwaysSecs(serv_headways)
+            for trip_start_info in \
+                    get_trip_start_times_in_serv_headways(serv_hways_secs):
+                ntrips += 1
+    return ntrips
+
 def create_gtfs_trips_stoptimes_for_route(route_def, route_segments_shp,
         stops_shp, mode_config, schedule, seg_speed_model,
         gtfs_route_id, stop_id_to_gtfs_stop_id_map,
-        init_trip_ctr, avg_hways_for_route=None, hways_tps=None):
+        init_trip_ctr, avg_hways_for_route=None, hways_tps=None,
+        gtfs_writer=None, use_frequencies=False):
+    """Creates the trips and stop times of a route, in all directions and
+    service periods. Returns the number of trips created.
+
+    If use_frequencies is set, runs of trips in the same time period with
+    identical stop time offsets are written as one trip plus a frequencies
+    entry. Trip IDs are still allocated as if every trip was written, so
+    each trip written has the trip ID of the first trip it represents, and
+    the number of trips returned includes all trips represented."""
 
     print "Adding trips and stops for route %s" \
         % (route_segs.get_print_name(route_def))
@@ -293,11 +547,8 @@ def create_gtfs_trips_stoptimes_for_route(route_def, route_segments_shp,
     route = schedule.GetRoute(gtfs_route_id)
 
     services_info = mode_config['services_info']
-    if not avg_hways_for_route:
-        serv_periods = map(operator.itemgetter(0), services_info)
-    else:
-        serv_periods = sorted(set(map(operator.itemgetter(1), 
-            avg_hways_for_route.keys())))
+    serv_periods = get_serv_periods_for_route(services_info,
+        avg_hways_for_route)
 
     rsetup_status = seg_speed_model.setup_for_route(route_def, serv_periods)
     if not rsetup_status:
@@ -306,6 +557,9 @@ def create_gtfs_trips_stoptimes_for_route(route_def, route_segments_shp,
                route_def.long_name)
         sys.exit(1)
 
+    # Stop lists built so far, that can be shared between trip sets.
+    route_stop_lists = {}
+
     # For our basic scheduler, we're going to just create both trips in
     # both directions, starting at exactly the same time, at the same
     # frequencies. The real-world implication of this is at least
@@ -314,23 +568,12 @@ def create_gtfs_trips_stoptimes_for_route(route_def, route_segments_shp,
         headsign = direction
         for sp_i, serv_period in enumerate(serv_periods):
             print "Handing service period '%s'" % (serv_period)
-            serv_headways = None
-            if not avg_hways_for_route:
-                serv_headways = services_info[sp_i][1]
-            else:
-                try:
-                    avg_hways_for_route_in_dir_period = \
-                        avg_hways_for_route[(direction, serv_period)]
-                except KeyError:
-                    # In some cases for bus loops, we had to manually add a
-                    # reverse dir, so try other one.
-                    other_dir = route_def.dir_names[1 - dir_id]
-                    avg_hways_for_route_in_dir_period = \
-                        avg_hways_for_route[(other_dir, serv_period)]
-                serv_headways = tps_hways_model.get_tp_hways_tuples(\
-                    avg_hways_for_route_in_dir_period, hways_tps)
-                    
-            assert serv_headways
+            serv_headways = get_serv_headways_for_route(route_def, dir_id,
+                sp_i, serv_period, services_info, avg_hways_for_route,
+                hways_tps)
+            serv_hways_secs = m_t_info.ServiceHeadwaysSecs(serv_headways)
+            # Stop time offsets that can be shared by trips in this trip set.
+            trip_templates = {}
 
             try:
                 gtfs_period = schedule.GetServicePeriod(serv_period)
@@ -340,113 +583,229 @@ def create_gtfs_trips_stoptimes_for_route(route_def, route_segments_shp,
             # Pre-calculate the stops list and save relevant info related to 
             # speed calculation from shapefiles for later.
             # as this is a moderately expensive operation.
-            # This way we do this just once per route, direction,
-            # and serv period.
-            prebuilt_stop_info_list = build_stop_list_and_seg_info_along_route(
+            # This way we do this at most once per route, direction,
+            # and serv period (or less, if the speed model allows sharing).
+            prebuilt_stop_info_list = get_stop_list_and_seg_info_along_route(
                 route_def, serv_period, dir_id, route_segments_shp, stops_shp,
                 mode_config, schedule, seg_speed_model,
-                stop_id_to_gtfs_stop_id_map)
+                stop_id_to_gtfs_stop_id_map, route_stop_lists)
         
-            for curr_tp_i, curr_period_info in enumerate(serv_headways):
-                hw_min = serv_headways[curr_tp_i][m_t_info.HWAY_COL]
-                if hw_min <= 0:
-                    # No trips should start during this period.
-                    # Skip ahead straight to next.
-                    continue
-                curr_headway = timedelta(minutes=hw_min)
-                curr_period_inc = timedelta(0)
-                curr_period_start = curr_period_info[m_t_info.TP_START_COL]
-                curr_period_end = curr_period_info[m_t_info.TP_END_COL]
-                period_duration = \
-                    datetime.combine(TODAY, curr_period_end) - \
-                    datetime.combine(TODAY, curr_period_start)
-                # This logic needed to handle periods that cross midnight
-                if period_duration < timedelta(0):
-                    period_duration += timedelta(days=1)
- 
-                curr_start_time = curr_period_start
-                while curr_period_inc < period_duration:
-                    trip_id = mode_config['index'] + init_trip_ctr \
-                        + ntrips_this_route   
-                    trip = route.AddTrip(
-                        schedule, 
-                        headsign = headsign,
-                        trip_id = trip_id,
-                        service_period = gtfs_period )
-
-                    create_gtfs_trip_stoptimes(trip, curr_start_time,
-                        curr_tp_i, serv_headways, route_def,
+            trip_run = None
+            for curr_tp_i, curr_start_secs in \
+                    get_trip_start_times_in_serv_headways(serv_hways_secs):
+                trip_id = mode_config['index'] + init_trip_ctr \
+                    + ntrips_this_route   
+                if not use_frequencies:
+                    trip = create_gtfs_trip(route, headsign, trip_id,
+                        gtfs_period, schedule, gtfs_writer)
+                    create_gtfs_trip_stoptimes(trip, curr_start_secs,
+                        curr_tp_i, serv_hways_secs, route_def,
                         prebuilt_stop_info_list, mode_config,
-                        schedule, seg_speed_model)
-                    ntrips_this_route += 1
-                    # Now update necessary variables ...
-                    curr_period_inc += curr_headway
-                    next_start_time = (datetime.combine(TODAY, \
-                        curr_start_time) + curr_headway).time()
-                    curr_start_time = next_start_time
+                        schedule, seg_speed_model, trip_templates)
+                else:
+                    stop_offsets = calc_trip_stop_offsets(curr_start_secs,
+                        curr_tp_i, serv_hways_secs, route_def,
+                        prebuilt_stop_info_list, mode_config,
+                        seg_speed_model, trip_templates)
+                    # Runs are written as GTFS times, so in whole seconds.
+                    gtfs_start_secs = int(curr_start_secs)
+                    if trip_run is None or not trip_run.try_extend(
+                            curr_tp_i, gtfs_start_secs, stop_offsets):
+                        if trip_run is not None:
+                            create_gtfs_trip_run(trip_run, route, headsign,
+                                gtfs_period, prebuilt_stop_info_list,
+                                schedule, gtfs_writer)
+                        trip_run = Trip_Run(trip_id, curr_tp_i,
+                            gtfs_start_secs, stop_offsets)
+                ntrips_this_route += 1
+            if trip_run is not None:
+                create_gtfs_trip_run(trip_run, route, headsign, gtfs_period,
+                    prebuilt_stop_info_list, schedule, gtfs_writer)
+    stage_stats.add_count('routes')
     return ntrips_this_route
 
-def create_gtfs_trip_stoptimes(trip, trip_start_time,
-        trip_start_period_i, serv_headways,
-        route_def, prebuilt_stop_info_list, mode_config, schedule,
+def create_gtfs_trip(route, headsign, trip_id, gtfs_period, schedule,
+        gtfs_writer=None):
+    if gtfs_writer is None:
+        trip = route.AddTrip(
+            schedule, 
+            headsign = headsign,
+            trip_id = trip_id,
+            service_period = gtfs_period )
+    else:
+        trip = gtfs_writer.add_trip(route, headsign, trip_id,
+            gtfs_period)
+    stage_stats.add_count('trips')
+    return trip
+
+def create_gtfs_trip_run(trip_run, route, headsign, gtfs_period,
+        prebuilt_stop_info_list, schedule, gtfs_writer=None):
+    """Creates the trip, stop times, and if it represents more than one trip,
+    frequency entry for a Trip_Run."""
+    trip = create_gtfs_trip(route, headsign, trip_run.trip_id, gtfs_period,
+        schedule, gtfs_writer)
+    add_gtfs_stop_times(trip, trip_run.start_secs, trip_run.stop_offsets,
+        prebuilt_stop_info_list)
+    if trip_run.n_trips > 1:
+        # End time is exclusive, as trips start at the headway from
+        # start time up to (but not including) end time.
+        trip.AddFrequency(trip_run.start_secs,
+            trip_run.last_start_secs + trip_run.hway_secs,
+            trip_run.hway_secs, 1)
+        stage_stats.add_count('frequencies')
+    return
+
+def get_trip_template_key(trip_start_secs, trip_start_period_i,
         seg_speed_model):
+    """Returns the key to use for looking up shared stop time offsets for a
+    trip starting at given time and period, and the time (in secs) the speed
+    model's speeds are guaranteed to be the same until. Key is None if the
+    speed model can't guarantee this."""
+    speeds_band = seg_speed_model.get_speeds_time_band(
+        timedelta(seconds=trip_start_secs))
+    if speeds_band is None:
+        return None, None
+    band_key, band_end = speeds_band
+    if band_end is not None:
+        band_end = misc_utils.tdToSecs(band_end)
+    return (trip_start_period_i, band_key), band_end
+
+def trip_template_applies(trip_start_secs, trip_start_period_i,
+        serv_hways_secs, speeds_band_end, trip_duration):
+    """Does a trip, starting at given time and lasting trip_duration secs,
+    stay within both its starting service period (so, same peak status) and
+    its speed model time band for every stop? If so, all trips with the same
+    template key will have identical stop time offsets."""
+    if speeds_band_end is not None and \
+            trip_start_secs + trip_duration >= speeds_band_end:
+        return False
+    if trip_start_period_i+1 < len(serv_hways_secs):
+        start_elapsed = m_t_info.calc_total_service_secs_elapsed(
+            serv_hways_secs.first_start_secs, trip_start_secs)
+        end_elapsed_curr_p = \
+            serv_hways_secs.end_elapsed_secs[trip_start_period_i]
+        if start_elapsed + trip_duration >= end_elapsed_curr_p:
+            return False
+    return True
+
+def add_gtfs_stop_time(trip, s_info, stop_seq, time_sec_for_gtfs):
+    problems = None
+    gtfs_stop_time = transitfeed.StopTime(
+        problems, 
+        s_info.gtfs_stop,
+        pickup_type = 0, # Regularly scheduled pickup 
+        drop_off_type = 0, # Regularly scheduled drop off
+        shape_dist_traveled = None, 
+        arrival_secs = time_sec_for_gtfs,
+        departure_secs = time_sec_for_gtfs, 
+        stop_time = time_sec_for_gtfs, 
+        stop_sequence = stop_seq
+        )
+    trip.AddStopTimeObject(gtfs_stop_time)
+    return
+
+def create_gtfs_trip_stoptimes(trip, trip_start_secs,
+        trip_start_period_i, serv_hways_secs,
+        route_def, prebuilt_stop_info_list, mode_config, schedule,
+        seg_speed_model, trip_templates=None):
     """Creates the actual stop times on a route.
     Since Apr 2014, now needs to access curr_period and serv_headways,
     since we are allowing for time-dependent vehicle speeds by serv period.
-    Still uses pre-calculated list of stops, segments along a route."""
+    Still uses pre-calculated list of stops, segments along a route.
+    All times are seconds since midnight (trip_start_secs may have a
+    fraction of a second, stop time offsets are integers), with service
+    headways pre-calculated in a m_t_info.ServiceHeadwaysSecs.
+
+    If trip_templates is given (a dict, shared by all trips of a trip set),
+    stop time offsets of trips that don't cross a service period or speed
+    model time band are saved there, and re-used by later trips starting
+    in the same period and band, rather than re-calculating speeds."""
 
     if VERBOSE:
         print "\n%s() called on route '%s', trip_id = %d, trip start time %s"\
             % (inspect.stack()[0][3], route_def.name, trip.trip_id,\
-                str(trip_start_time))
+                str(misc_utils.secsToTimeOfDay(trip_start_secs)))
+
+    stop_offsets = calc_trip_stop_offsets(trip_start_secs,
+        trip_start_period_i, serv_hways_secs, route_def,
+        prebuilt_stop_info_list, mode_config, seg_speed_model,
+        trip_templates)
+    add_gtfs_stop_times(trip, trip_start_secs, stop_offsets,
+        prebuilt_stop_info_list)
+    return
+
+def add_gtfs_stop_times(trip, trip_start_secs, stop_offsets,
+        prebuilt_stop_info_list):
+    stage_stats.add_count('stop_times', len(stop_offsets))
+    for stop_seq, stop_offset in enumerate(stop_offsets):
+        s_info = prebuilt_stop_info_list[stop_seq]
+        # Need to add time on trip to trip start time to get it as a
+        # 'daily' time in whole secs, suited for GTFS.
+        time_sec_for_gtfs = int(trip_start_secs) + stop_offset
+        add_gtfs_stop_time(trip, s_info, stop_seq, time_sec_for_gtfs)
+        if VERBOSE:
+            print "Added stop # %d for this route (stop ID %s) - at t %s" \
+                % (stop_seq, s_info.gtfs_stop.stop_id, 
+                   timedelta(seconds=time_sec_for_gtfs))
+    return
 
+def calc_trip_stop_offsets(trip_start_secs, trip_start_period_i,
+        serv_hways_secs, route_def, prebuilt_stop_info_list, mode_config,
+        seg_speed_model, trip_templates=None):
+    """Calculates the time (in secs) from the start of a trip that it reaches
+    each stop on the route. See create_gtfs_trip_stoptimes()."""
     if len(route_def.ordered_seg_ids) == 0:
         print "Warning: for route name '%s', no route segments defined " \
             "skipping." % route_def.name
-        return
+        return []
 
-    # We will also create the stopping time object as a timedelta, as this way
-    # it will handle trips that cross midnight the way GTFS requires
+    # Stop times are kept as seconds since midnight of the trip start, so
+    # they handle trips that cross midnight the way GTFS requires
     # (as a number that can increases past 24:00 hours,
     # rather than ticking back to 00:00)
-    start_time_delta = datetime.combine(TODAY, trip_start_time) - \
-        datetime.combine(TODAY, time(0))
-    cumulative_time_on_trip = timedelta(0)
+    template_key = None
+    if trip_templates is not None:
+        template_key, speeds_band_end = get_trip_template_key(
+            trip_start_secs, trip_start_period_i, seg_speed_model)
+    if template_key is not None and template_key in trip_templates:
+        stop_offsets = trip_templates[template_key]
+        if trip_template_applies(trip_start_secs, trip_start_period_i,
+                serv_hways_secs, speeds_band_end, stop_offsets[-1]):
+            # Repeat the last speed calculation of the trip, so any state
+            # the speed model keeps between calls (e.g. last time period
+            # found) is the same as if we'd calculated the whole trip.
+            peak_status = serv_hways_secs.peak_statuses[trip_start_period_i]
+            for stop_seq in reversed(range(len(stop_offsets)-1)):
+                s_info = prebuilt_stop_info_list[stop_seq]
+                if s_info.dist_km_to_next >= (1 / 1000.0):
+                    s_info.calc_time_on_next_segment(seg_speed_model,
+                        mode_config, trip_start_secs + stop_offsets[stop_seq],
+                        peak_status)
+                    break
+            return stop_offsets
+
+    stop_offsets = seg_speed_model.calc_trip_stop_offsets(
+        prebuilt_stop_info_list, trip_start_secs)
+    if stop_offsets is not None:
+        return stop_offsets
+
+    cumulative_time_on_trip = 0
+    stop_offsets = []
     # These variable needed to track change in periods for possible
     # time-dependent vehicle speed in peak or off-peak
     period_at_stop_i = trip_start_period_i
-    peak_status = serv_headways[period_at_stop_i][m_t_info.PEAK_STATUS_COL]
-    time_at_stop = trip_start_time
-    end_elapsed_curr_p = m_t_info.calc_service_time_elapsed_end_period(
-        serv_headways, period_at_stop_i)
+    peak_status = serv_hways_secs.peak_statuses[period_at_stop_i]
+    end_elapsed_curr_p = serv_hways_secs.end_elapsed_secs[period_at_stop_i]
+    n_periods = len(serv_hways_secs)
+    first_period_start_secs = serv_hways_secs.first_start_secs
     n_stops_on_route = len(prebuilt_stop_info_list)
 
     for stop_seq, s_info in enumerate(prebuilt_stop_info_list):
         # Enter a stop at first stop in the segment in chosen direction.
-        problems = None
         # Enter the stop info now at the start. Then will add on time in this
         # segment.
-        # Need to add cumulative time on trip start time to get it as a 'daily'
-        # time_delta, suited for GTFS.
-        stop_time_delta = start_time_delta + cumulative_time_on_trip
-        time_at_stop = (datetime.min + stop_time_delta).time()
-        time_sec_for_gtfs = stop_time_delta.days * 24*60*60 \
-            + stop_time_delta.seconds
-        gtfs_stop_time = transitfeed.StopTime(
-            problems, 
-            s_info.gtfs_stop,
-            pickup_type = 0, # Regularly scheduled pickup 
-            drop_off_type = 0, # Regularly scheduled drop off
-            shape_dist_traveled = None, 
-            arrival_secs = time_sec_for_gtfs,
-            departure_secs = time_sec_for_gtfs, 
-            stop_time = time_sec_for_gtfs, 
-            stop_sequence = stop_seq
-            )
-        trip.AddStopTimeObject(gtfs_stop_time)
-        if VERBOSE:
-            print "Added stop # %d for this route (stop ID %s) - at t %s" \
-                % (stop_seq, gtfs_stop.stop_id, stop_time_delta)
+        time_at_stop_secs = trip_start_secs + cumulative_time_on_trip
+        stop_offsets.append(cumulative_time_on_trip)
 
         # Given elapsed time at stop we just added:- have we just crossed over
         # int peak period of schedule for this mode? Will affect calc. time to
@@ -456,33 +815,327 @@ def create_gtfs_trip_stoptimes(trip, trip_start_time,
         # road/rails after the
         # nominal end time of the period. In this case, just keep going
         # in same conditions of current period.
-        serv_elapsed = m_t_info.calc_total_service_time_elapsed(
-            serv_headways, time_at_stop)
-        if (period_at_stop_i+1 < len(serv_headways)) \
+        serv_elapsed = m_t_info.calc_total_service_secs_elapsed(
+            first_period_start_secs, time_at_stop_secs)
+        if (period_at_stop_i+1 < n_periods) \
                 and serv_elapsed >= end_elapsed_curr_p:
             period_at_stop_i += 1
-            peak_status =  \
-                serv_headways[period_at_stop_i][m_t_info.PEAK_STATUS_COL]
-            end_elapsed_curr_p = m_t_info.calc_service_time_elapsed_end_period(
-                serv_headways, period_at_stop_i)
+            peak_status = serv_hways_secs.peak_statuses[period_at_stop_i]
+            end_elapsed_curr_p = \
+                serv_hways_secs.end_elapsed_secs[period_at_stop_i]
             
         # Only have to do time inc. calculations if more stops remaining.
         if (stop_seq+1) < n_stops_on_route:
             time_inc = s_info.calc_time_on_next_segment(seg_speed_model,
-                mode_config, stop_time_delta, peak_status)
+                mode_config, time_at_stop_secs, peak_status)
             cumulative_time_on_trip += time_inc
-    return
+
+    if template_key is not None and template_key not in trip_templates \
+            and trip_template_applies(trip_start_secs, trip_start_period_i,
+                serv_hways_secs, speeds_band_end, stop_offsets[-1]):
+        trip_templates[template_key] = stop_offsets
+    return stop_offsets
 
 def get_partial_save_name(output_fname, ii):
     fname = output_fname+".partial.%d.zip" % ii
     return fname
 
+def create_gtfs_base_schedule(route_defs, stops_table, mode_config,
+        memory_db=True, stop_ids=None):
+    """Create a schedule with everything except the trips and stop times:
+    i.e. agency, service periods, routes and stops (only those with IDs in
+    stop_ids, if given)."""
+    schedule = transitfeed.Schedule(memory_db=memory_db)
+    schedule.AddAgency(mode_config['name'], mode_config['url'],
+        mode_config['loc'], agency_id=mode_config['id'])
+    create_gtfs_service_periods(mode_config['services_info'], schedule)
+    route_id_to_gtfs_route_id_map = create_gtfs_route_entries(
+        route_defs, mode_config, schedule)
+    stop_id_to_gtfs_stop_id_map = create_gtfs_stop_entries(stops_table,
+        mode_config, schedule, stop_ids)
+    return schedule, route_id_to_gtfs_route_id_map, \
+        stop_id_to_gtfs_stop_id_map
+
+def process_data_stream_writer(route_defs, route_segments_shp, stops_shp,
+        stops_table, mode_config, output, seg_speed_model, per_route_hways,
+        hways_tps, use_frequencies=False):
+    """Create the GTFS file by streaming trips and stop times straight to
+    the output as they are generated, rather than building them up in a
+    transitfeed schedule. So there's no need to write in batches of routes."""
+    stage_stats.start_stage('stop_entries')
+    schedule, route_id_to_gtfs_route_id_map, stop_id_to_gtfs_stop_id_map = \
+        create_gtfs_base_schedule(route_defs, stops_table, mode_config)
+    stage_stats.end_stage('stop_entries')
+    gtfs_writer = gtfs_stream_writer.GTFSStreamWriter(output)
+    stage_stats.start_stage('create_trips')
+    create_gtfs_trips_stoptimes(route_defs,
+        route_segments_shp, stops_shp, mode_config, schedule,
+        seg_speed_model, route_id_to_gtfs_route_id_map,
+        stop_id_to_gtfs_stop_id_map,
+        per_route_hways = per_route_hways,
+        hways_tps = hways_tps,
+        gtfs_writer = gtfs_writer,
+        use_frequencies = use_frequencies)
+    stage_stats.end_stage('create_trips')
+    print "About to write static tables, and copy %d streamed trips "\
+        "(%d stop times) to file %s ..." \
+        % (gtfs_writer.trips_written, gtfs_writer.stop_times_written, output)
+    stage_stats.start_stage('write')
+    gtfs_writer.close(schedule)
+    stage_stats.end_stage('write')
+    print "...finished writing to file %s." % (output)
+    return
+
+def get_route_fragment_name(output_fname, route_i):
+    return output_fname + ".route%d" % route_i
+
+# State of each worker process, when creating routes in parallel. Set once
+# per worker process by init_route_worker().
+_route_worker_state = {}
+
+def init_route_worker(route_defs, input_segments_fname, input_stops_fname,
+        stops_table, used_stop_ids, mode_config, seg_speed_model,
+        per_route_hways, hways_tps, use_frequencies, seg_speed_snapshot=None,
+        speed_model_is_setup=False):
+    """Initialiser for each process of the pool used to create routes in
+    parallel. Each worker needs its own shapefile handles, set up speed model
+    (unless speed_model_is_setup, i.e. it was set up before the workers
+    were forked), and schedule holding the routes (and stops, of those in
+    used_stop_ids) trips are added to."""
+    route_segments_shp = osgeo.ogr.Open(input_segments_fname)
+    stops_shp = osgeo.ogr.Open(input_stops_fname)
+    segs_layer = route_segments_shp.GetLayer(0)
+    stops_layer = stops_shp.GetLayer(0)
+    if not speed_model_is_setup:
+        speed_model_snapshot.setup_speed_model(seg_speed_model, route_defs,
+            segs_layer, stops_layer, mode_config, seg_speed_snapshot)
+    schedule, route_id_to_gtfs_route_id_map, stop_id_to_gtfs_stop_id_map = \
+        create_gtfs_base_schedule(route_defs, stops_table, mode_config,
+            stop_ids=used_stop_ids)
+    _route_worker_state['route_defs'] = route_defs
+    _route_worker_state['route_segments_shp'] = route_segments_shp
+    _route_worker_state['stops_shp'] = stops_shp
+    _route_worker_state['mode_config'] = mode_config
+    _route_worker_state['seg_speed_model'] = seg_speed_model
+    _route_worker_state['per_route_hways'] = per_route_hways
+    _route_worker_state['hways_tps'] = hways_tps
+    _route_worker_state['use_frequencies'] = use_frequencies
+    _route_worker_state['schedule'] = schedule
+    _route_worker_state['route_id_to_gtfs_route_id_map'] = \
+        route_id_to_gtfs_route_id_map
+    _route_worker_state['stop_id_to_gtfs_stop_id_map'] = \
+        stop_id_to_gtfs_stop_id_map
+    return
+
+def init_route_worker_process(*init_args):
+    """Initialiser for each process of the pool. Worker processes don't
+    record stage stats (otherwise a forked worker would have a copy of the
+    parent process's recorder), and re-open any speeds packs the parent
+    process had open (e.g. while calculating build cache keys)."""
+    stage_stats.set_active_recorder(None)
+    speeds_pack.close_all_packs()
+    init_route_worker(*init_args)
+    return
+
+def create_route_fragment_in_worker(route_job):
+    """Create the trips and stop times of one route, in a worker process.
+    route_job is a tuple of (index of route in route defs, trip counter to
+    start trip IDs at, output file name). Returns the GTFSStreamWriter
+    fragment the trips and stop times were written to."""
+    route_i, init_trip_ctr, output = route_job
+    st = _route_worker_state
+    route_def = st['route_defs'][route_i]
+    gtfs_writer = gtfs_stream_writer.GTFSStreamWriter(
+        get_route_fragment_name(output, route_i))
+    try:
+        create_gtfs_trips_stoptimes_for_route(route_def,
+            st['route_segments_shp'], st['stops_shp'], st['mode_config'],
+            st['schedule'], st['seg_speed_model'],
+            st['route_id_to_gtfs_route_id_map'][route_def.id],
+            st['stop_id_to_gtfs_stop_id_map'], init_trip_ctr,
+            get_avg_hways_for_route(route_def, st['per_route_hways']),
+            st['hways_tps'], gtfs_writer, st['use_frequencies'])
+    except SystemExit:
+        # Turn into an exception that gets passed back to the parent process,
+        # rather than leaving the pool waiting on a dead worker.
+        raise RuntimeError("Failed to create trips for route %s." \
+            % route_segs.get_print_name(route_def))
+    return gtfs_writer.close_fragment()
+
+def process_data_fragments(route_defs, input_segments_fname,
+        input_stops_fname, segs_layer, stops_table, mode_config, output,
+        seg_speed_model, per_route_hways, hways_tps, n_workers=1,
+        use_frequencies=False, build_cache_dir=None, seg_speed_snapshot=None):
+    """Create the GTFS file by creating the trips and stop times of each
+    route as a separate fragment file, then combining them in route order.
+
+    If n_workers > 1, uses a pool of n_workers processes to create the
+    fragments in parallel. If build_cache_dir is given, the fragment of
+    each route is saved there, and re-used in later runs if none of the
+    inputs used to create it have changed. (Entries for routes not in this
+    run are pruned from it afterwards.)
+
+    Since the number of trips of each route depends only on its headways,
+    the trip IDs each route starts at are calculated up-front. So the output
+    is identical to what a single process streaming writer would create."""
+    sorted_route_defs = sorted(route_defs,
+        key=route_segs.get_route_order_key_from_name)
+    route_jobs = []
+    trip_ctr = 0
+    for route_i, route_def in enumerate(sorted_route_defs):
+        route_jobs.append((route_i, trip_ctr, output))
+        trip_ctr += count_trips_for_route(route_def, mode_config,
+            get_avg_hways_for_route(route_def, per_route_hways), hways_tps)
+    stage_stats.start_stage('stop_entries')
+    schedule, route_id_to_gtfs_route_id_map, stop_id_to_gtfs_stop_id_map = \
+        create_gtfs_base_schedule(route_defs, stops_table, mode_config)
+    stage_stats.end_stage('stop_entries')
+
+    build_cache = None
+    route_keys = [None] * len(sorted_route_defs)
+    if build_cache_dir:
+        # Route keys depend on what the speed model reads in setup, so set
+        #  it up once here (workers forked later get a copy).
+        stage_stats.start_stage('speed_model_setup')
+        stops_shp = osgeo.ogr.Open(input_stops_fname)
+        speed_model_snapshot.setup_speed_model(seg_speed_model,
+            sorted_route_defs, segs_layer, stops_shp.GetLayer(0),
+            mode_config, seg_speed_snapshot)
+        stops_shp = None
+        stage_stats.end_stage('speed_model_setup')
+
+    stage_stats.start_stage('create_trips')
+    if build_cache_dir:
+        build_cache = gtfs_build_cache.RouteBuildCache(build_cache_dir)
+        segs_lookup_table = tp_model.build_segs_lookup_table(segs_layer)
+        stage_stats.add_count('shapefile_feature_reads',
+            len(segs_lookup_table))
+        services_info = mode_config['services_info']
+        for route_i, route_def in enumerate(sorted_route_defs):
+            avg_hways_for_route = get_avg_hways_for_route(route_def,
+                per_route_hways)
+            route_keys[route_i] = gtfs_build_cache.calc_route_build_key(
+                route_def, route_id_to_gtfs_route_id_map[route_def.id],
+                get_serv_periods_for_route(services_info,
+                    avg_hways_for_route),
+                segs_lookup_table, stop_id_to_gtfs_stop_id_map, mode_config,
+                seg_speed_model, avg_hways_for_route, hways_tps,
+                use_frequencies)
+        segs_lookup_table = None
+        jobs_to_create = [route_job for route_job in route_jobs \
+            if not build_cache.contains(route_keys[route_job[0]])]
+        print "%d of %d routes found unchanged in build cache %s." \
+            % (len(route_jobs) - len(jobs_to_create), len(route_jobs),
+               build_cache_dir)
+    else:
+        jobs_to_create = route_jobs
+
+    route_is_to_create = set([route_job[0] for route_job in jobs_to_create])
+
+    gtfs_writer = gtfs_stream_writer.GTFSStreamWriter(output)
+    pool = None
+    if jobs_to_create:
+        # Workers only need the stops of the routes they create.
+        used_stop_ids = get_stop_ids_used_by_routes(
+            [sorted_route_defs[route_job[0]] for route_job in jobs_to_create],
+            build_seg_stop_ids_map(segs_layer))
+    if not jobs_to_create:
+        created_fragments = iter([])
+    elif n_workers > 1:
+        print "Creating trips for %d routes using %d worker processes ..." \
+            % (len(jobs_to_create), n_workers)
+        pool = multiprocessing.Pool(n_workers, init_route_worker_process,
+            (sorted_route_defs, input_segments_fname, input_stops_fname,
+                stops_table, used_stop_ids, mode_config, seg_speed_model,
+                per_route_hways, hways_tps, use_frequencies,
+                seg_speed_snapshot, build_cache is not None))
+        # imap returns results in order of routes, so fragments can be
+        # appended as soon as each is ready.
+        created_fragments = pool.imap(create_route_fragment_in_worker,
+            jobs_to_create)
+    else:
+        # Serially, the speed model is set up here (unless already set up
+        #  above for the build cache), so record it as its own stage.
+        stage_stats.end_stage('create_trips')
+        stage_stats.start_stage('speed_model_setup')
+        init_route_worker(sorted_route_defs, input_segments_fname,
+            input_stops_fname, stops_table, used_stop_ids, mode_config,
+            seg_speed_model, per_route_hways, hways_tps, use_frequencies,
+            seg_speed_snapshot, build_cache is not None)
+        stage_stats.end_stage('speed_model_setup')
+        stage_stats.start_stage('create_trips')
+        created_fragments = itertools.imap(create_route_fragment_in_worker,
+            jobs_to_create)
+    try:
+        for route_job in route_jobs:
+            route_i, init_trip_ctr = route_job[:2]
+            if not use_frequencies:
+                assert gtfs_writer.trips_written == init_trip_ctr
+            route_key = route_keys[route_i]
+            if route_i not in route_is_to_create:
+                try:
+                    fragment, delete_files = build_cache.get_fragment(
+                        route_key, init_trip_ctr,
+                        get_route_fragment_name(output, route_i))
+                except KeyError:
+                    # Only routes not in the cache when the run started
+                    #  are set up to be created, so can't create it now.
+                    raise RuntimeError("Build cache entry for route %s was "\
+                        "removed during the run (re-run to re-create it)." \
+                        % route_segs.get_print_name(
+                            sorted_route_defs[route_i]))
+                gtfs_writer.append_fragment(fragment, delete_files)
+                stage_stats.add_count('routes_from_cache')
+            else:
+                fragment = created_fragments.next()
+                if pool is not None:
+                    # Counts made in the worker processes aren't recorded.
+                    stage_stats.add_count('routes')
+                    stage_stats.add_count('trips', fragment[1])
+                    stage_stats.add_count('stop_times', fragment[2])
+                    stage_stats.add_count('frequencies', fragment[3])
+                if build_cache is not None:
+                    build_cache.save_fragment(route_key, fragment,
+                        init_trip_ctr)
+                gtfs_writer.append_fragment(fragment)
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    if not use_frequencies:
+        assert gtfs_writer.trips_written == trip_ctr
+    stage_stats.end_stage('create_trips')
+    if build_cache is not None:
+        print "Re-used %d routes from build cache, created %d." \
+            % (build_cache.hits, build_cache.misses)
+        n_pruned = build_cache.prune(set(route_keys))
+        if n_pruned:
+            print "Pruned %d unused routes from build cache." % n_pruned
+    print "About to write static tables, and copy %d trips "\
+        "(%d stop times) to file %s ..." \
+        % (gtfs_writer.trips_written, gtfs_writer.stop_times_written, output)
+    stage_stats.start_stage('write')
+    gtfs_writer.close(schedule)
+    stage_stats.end_stage('write')
+    print "...finished writing to file %s." % (output)
+    return
+
 def process_data(route_defs_csv_fname, input_segments_fname,
         input_stops_fname, mode_config, output, seg_speed_model,
         memory_db, delete_partials, route_write_batch_size,
-        per_route_hways_fname = None):
+        per_route_hways_fname = None, writer=WRITER_TRANSITFEED,
+        n_workers=1, use_frequencies=False, build_cache_dir=None,
+        speed_snapshot_fname=None):
     # Now see if we can open both needed shape files correctly
+    stage_stats.start_stage('read_route_defs')
     route_defs = route_segs.read_route_defs(route_defs_csv_fname)
+    stage_stats.add_count('route_defs', len(route_defs))
+    stage_stats.end_stage('read_route_defs')
     route_segments_shp = osgeo.ogr.Open(input_segments_fname)
     if route_segments_shp is None:
         print "Error, route segments shape file given, %s , failed to open." \
@@ -495,17 +1148,55 @@ def process_data(route_defs_csv_fname, input_segments_fname,
         sys.exit(1)
     segs_layer = route_segments_shp.GetLayer(0)
     stops_layer = stops_shp.GetLayer(0)
-
-    seg_speed_model.setup(route_defs, segs_layer, stops_layer, mode_config)
+    # Read the stops just once, for all the schedules created below.
+    stage_stats.start_stage('read_stops')
+    stops_table = read_stops_table(stops_shp, mode_config)
+    stage_stats.end_stage('read_stops')
 
     if per_route_hways_fname:
+        stage_stats.start_stage('read_headways')
         per_route_hways, hways_tps, r_ids_to_names_map  = \
             tps_hways_model.read_route_hways_all_routes_all_stops(
                 per_route_hways_fname)
+        stage_stats.end_stage('read_headways')
     else:
         per_route_hways = None
         hways_tps = None
 
+    seg_speed_snapshot = None
+    if speed_snapshot_fname:
+        seg_speed_snapshot = speed_model_snapshot.SpeedModelSnapshot(
+            speed_snapshot_fname,
+            [route_defs_csv_fname, input_segments_fname, input_stops_fname])
+
+    if writer == WRITER_STREAM and (n_workers > 1 or build_cache_dir):
+        # Speed model is set up by each worker (if any routes need creating),
+        #  or once up-front when using a build cache.
+        process_data_fragments(route_defs, input_segments_fname,
+            input_stops_fname, segs_layer, stops_table, mode_config, output,
+            seg_speed_model, per_route_hways, hways_tps, n_workers,
+            use_frequencies, build_cache_dir, seg_speed_snapshot)
+        return
+
+    stage_stats.start_stage('speed_model_setup')
+    speed_model_snapshot.setup_speed_model(seg_speed_model, route_defs,
+        segs_layer, stops_layer, mode_config, seg_speed_snapshot)
+    stage_stats.end_stage('speed_model_setup')
+    if seg_speed_snapshot and seg_speed_snapshot.loaded:
+        print "(Loaded speed model set up from snapshot %s.)" \
+            % speed_snapshot_fname
+
+    if writer == WRITER_STREAM:
+        process_data_stream_writer(route_defs, route_segments_shp, stops_shp,
+            stops_table, mode_config, output, seg_speed_model,
+            per_route_hways, hways_tps, use_frequencies)
+        return
+
+    if route_write_batch_size < len(route_defs):
+        # Each partial file only needs the stops its routes use.
+        stage_stats.start_stage('stop_entries')
+        seg_stop_ids_map = build_seg_stop_ids_map(segs_layer)
+        stage_stats.end_stage('stop_entries')
     partial_save_files = []
     trips_total = 0
     for ii, r_start in enumerate(range(0, len(route_defs), \
@@ -514,70 +1205,80 @@ def process_data(route_defs_csv_fname, input_segments_fname,
         if r_end >= len(route_defs):
             r_end = len(route_defs) - 1
         print "Processing routes %d to %d" % (r_start, r_end)
+        stage_stats.start_stage('stop_entries')
+        if route_write_batch_size < len(route_defs):
+            batch_stop_ids = get_stop_ids_used_by_routes(
+                route_defs[r_start:r_end+1], seg_stop_ids_map)
+        else:
+            batch_stop_ids = None
         # Create our schedule
-        schedule = transitfeed.Schedule(memory_db=memory_db)
-        # Agency
-        schedule.AddAgency(mode_config['name'], mode_config['url'],
-            mode_config['loc'], agency_id=mode_config['id'])
-        create_gtfs_service_periods(mode_config['services_info'], schedule)
-        route_id_to_gtfs_route_id_map = create_gtfs_route_entries(
-            route_defs[r_start:r_end+1], mode_config, schedule)
-        stop_id_to_gtfs_stop_id_map = create_gtfs_stop_entries(stops_shp,
-            mode_config, schedule)
-        create_gtfs_trips_stoptimes(route_defs[r_start:r_end+1],
+        schedule, route_id_to_gtfs_route_id_map, \
+            stop_id_to_gtfs_stop_id_map = create_gtfs_base_schedule(
+                route_defs[r_start:r_end+1], stops_table, mode_config,
+                memory_db, batch_stop_ids)
+        stage_stats.end_stage('stop_entries')
+        stage_stats.start_stage('create_trips')
+        ntrips_batch = create_gtfs_trips_stoptimes(
+            route_defs[r_start:r_end+1],
             route_segments_shp, stops_shp, mode_config, schedule,
             seg_speed_model, route_id_to_gtfs_route_id_map,
             stop_id_to_gtfs_stop_id_map,
             initial_trip_id = trips_total,
             per_route_hways = per_route_hways,
-            hways_tps = hways_tps)
-        trips_total += len(schedule.trips)
+            hways_tps = hways_tps,
+            use_frequencies = use_frequencies)
+        stage_stats.end_stage('create_trips')
+        trips_total += ntrips_batch
         if route_write_batch_size >= len(route_defs):
             print "About to save complete timetable to file %s ..." \
                 % output
+            stage_stats.start_stage('validate')
             schedule.Validate()
+            stage_stats.end_stage('validate')
+            stage_stats.start_stage('write')
             schedule.WriteGoogleTransitFeed(output)
+            stage_stats.end_stage('write')
             print "...finished writing to file %s." % (output)
         else:
             fname = get_partial_save_name(output, ii)
             print "About to save timetable so far to file %s in case..." \
                 % fname
+            # The merged file isn't re-loaded as a whole, so each batch is
+            #  validated instead.
+            stage_stats.start_stage('validate')
+            schedule.Validate()
+            stage_stats.end_stage('validate')
+            stage_stats.start_stage('write')
             schedule.WriteGoogleTransitFeed(fname)
+            stage_stats.end_stage('write')
             print "...finished writing to file %s." % (fname)
             if fname not in partial_save_files:
                 partial_save_files.append(fname)
 
     if route_write_batch_size < len(route_defs):
-        # Now we want to re-combine the separate zip files together
-        # to create our master schedule
-        master_schedule = transitfeed.Schedule(memory_db=False)
-        master_schedule.AddAgency(mode_config['name'], mode_config['url'],
-            mode_config['loc'], agency_id=mode_config['id'])
-        create_gtfs_service_periods(mode_config['services_info'],
-            master_schedule)
-        create_gtfs_route_entries(route_defs, mode_config, master_schedule)
-        create_gtfs_stop_entries(stops_shp, mode_config, master_schedule)
+        # Now we want to re-combine the separate zip files together.
+        # The master schedule only needs the agency, service periods, routes
+        # and stops :- trips and stop times are streamed across from the
+        # partial files at the CSV level, rather than re-loading them.
+        stage_stats.start_stage('merge_partials')
+        master_schedule, route_id_to_gtfs_route_id_map, \
+            stop_id_to_gtfs_stop_id_map = create_gtfs_base_schedule(
+                route_defs, stops_table, mode_config, memory_db=False)
         # Now close the shape files.
         stops_shp = None
         route_segments_shp = None
-        # Load it up progressively from partial files.
+        gtfs_writer = gtfs_stream_writer.GTFSStreamWriter(output)
         for fname in partial_save_files:
-            loader = transitfeed.Loader(feed_path=fname,
-                problems=transitfeed.ProblemReporter(),
-                memory_db=memory_db,
-                load_stop_times=True)
-            print "... now re-opening partial file %s ...." % fname 
-            part_schedule = loader.Load()
-            for trip in part_schedule.trips.itervalues():
-                stop_times = trip.GetStopTimes()
-                master_schedule.AddTripObject(trip)
-                for stop_time in stop_times:
-                    trip.AddStopTimeObject(stop_time)
-            part_schedule = None
-
-        print "About to do final validate and write ...."
-        master_schedule.Validate()
-        master_schedule.WriteGoogleTransitFeed(output)
+            print "... now copying trips and stop times from partial "\
+                "file %s ...." % fname 
+            gtfs_writer.append_feed(fname)
+
+        print "About to write combined file with %d trips (%d stop times)"\
+            " ...." % (gtfs_writer.trips_written,
+                gtfs_writer.stop_times_written)
+        gtfs_writer.close(master_schedule)
+        stage_stats.add_count('partial_files', len(partial_save_files))
+        stage_stats.end_stage('merge_partials')
         print "Written successfully to file %s" % output
         if delete_partials:
             print "Cleaning up partial GTFS files..."
@@ -604,9 +1305,20 @@ if __name__ == "__main__":
     parser.add_option('--usesegspeeds', dest='usesegspeeds', 
         help='Use per-segment speeds defined in route segments shapefile? '\
             'If false, then will just use a constant speed defined per mode.')
+    parser.add_option('--vehicle_speeds', dest='vehicle_speeds',
+        help='(Optional) Calculate speed on each segment from its length, '\
+            'and the acceleration and stop dwell time of a vehicle: either '\
+            'one of the vehicle classes %s, or "mode" to use those of the '\
+            'mode config of the service. Overrides usesegspeeds.' \
+            % sorted(speed_funcs_vehicle_based.VEHICLE_CLASS_PARAMS.keys()))
     parser.add_option('--gtfs_speeds_dir', dest='gtfs_speeds_dir',
         help='Path to dir containing extracted speeds per time period from '
-            'a GTFS input file.')
+            'a GTFS input file (or a speeds pack file of them, created by '
+            'speeds_pack.py).')
+    parser.add_option('--interpolate_speeds', dest='interpolate_speeds',
+        help='If using gtfs_speeds_dir, interpolate speeds linearly between '\
+            'the middle of each time period, rather than changing them in '\
+            'steps at period boundaries? (Default false.)')
     parser.add_option('--memorydb', dest='memorydb', 
         help='Should the GTFS schedule use an in-memory DB, or file based '\
             'one? Creating large GTFS schedules can be memory-hungry.')
@@ -620,10 +1332,44 @@ if __name__ == "__main__":
     parser.add_option('--per_route_hways', dest='per_route_hways',
         help='An optional file specifying per-route headways in time '\
             'periods.')
+    parser.add_option('--writer', dest='writer',
+        help='How to write the output GTFS file, one of %s. \'%s\' streams '\
+            'trips and stop times to the output as they are generated, '\
+            'using much less memory for large networks (but skips '\
+            'transitfeed validation, and ignores --memorydb and '\
+            '--route_write_batch_size).' \
+            % (', '.join(ALLOWED_WRITERS), WRITER_STREAM))
+    parser.add_option('--workers', dest='workers',
+        help='Number of worker processes to create route trips with, in '\
+            'parallel. Values > 1 require --writer=%s.' % WRITER_STREAM)
+    parser.add_option('--use_frequencies', dest='use_frequencies',
+        help='Write runs of trips with the same stop time offsets, at a '\
+            'constant headway within a time period, as a single trip plus '\
+            'a frequencies.txt entry (with exact_times=1)? Makes much '\
+            'smaller files for high-frequency services.')
+    parser.add_option('--build_cache_dir', dest='build_cache_dir',
+        help='Optional dir to cache the trips and stop times created for '\
+            'each route in. Routes whose inputs haven\'t changed since a '\
+            'previous run using the same dir are re-used rather than '\
+            're-created (cached routes not in this run are deleted). '\
+            'Requires --writer=%s.' % WRITER_STREAM)
+    parser.add_option('--speed_model_snapshot', dest='speed_model_snapshot',
+        help='Optional file to save a snapshot of the set up speed model '\
+            'to. Later runs with the same speed model and unchanged input '\
+            'files load it, rather than setting up the model again.')
+    parser.add_option('--stage_stats', dest='stage_stats',
+        help='Optional JSON file to write stats of each stage of creating '\
+            'the GTFS file to (wall and CPU time, peak memory, and counts '\
+            'of routes, trips, stop times, shapefile features read etc). '\
+            'A summary table is also printed at the end.')
+    parser.add_option('--profile_dir', dest='profile_dir',
+        help='Optional dir to save cProfile stats of each stage to, as '\
+            '<stage name>.prof.')
     parser.set_defaults(output='google_transit.zip', usesegspeeds='True',
-        gtfs_speeds_dir='', memorydb='True',
+        gtfs_speeds_dir='', interpolate_speeds='False', memorydb='True',
         delete_partials='True',
-        route_write_batch_size=ROUTE_WRITE_BATCH_DEF_SIZE,)
+        route_write_batch_size=ROUTE_WRITE_BATCH_DEF_SIZE,
+        writer=WRITER_TRANSITFEED, workers=1, use_frequencies='False')
     (options, args) = parser.parse_args()
             
 
@@ -657,6 +1403,21 @@ if __name__ == "__main__":
             parser.print_help()
             parser.error("GTFS speeds dir given '%s' doesn't exist." \
                 % gtfs_speeds_dir)
+    interpolate_speeds = parser_utils.str2bool(options.interpolate_speeds)
+
+    vehicle_speeds = options.vehicle_speeds
+    if vehicle_speeds:
+        if use_gtfs_speeds:
+            parser.print_help()
+            parser.error("Only one of gtfs_speeds_dir and vehicle_speeds "\
+                "can be given.")
+        use_seg_speeds = False
+        if vehicle_speeds != 'mode' and vehicle_speeds not in \
+                speed_funcs_vehicle_based.VEHICLE_CLASS_PARAMS:
+            parser.print_help()
+            parser.error("Vehicle speeds class '%s' not 'mode' or one of "\
+                "allowed classes %s." % (vehicle_speeds, sorted(
+                    speed_funcs_vehicle_based.VEHICLE_CLASS_PARAMS.keys())))
 
     if options.per_route_hways:
         per_route_hways_fname = options.per_route_hways
@@ -668,6 +1429,7 @@ if __name__ == "__main__":
         per_route_hways_fname = None
 
     memory_db = parser_utils.str2bool(options.memorydb)
+    use_frequencies = parser_utils.str2bool(options.use_frequencies)
     delete_partials = parser_utils.str2bool(options.delete_partials)
     route_write_batch_size = int(options.route_write_batch_size)
     if route_write_batch_size <= 0:
@@ -675,13 +1437,60 @@ if __name__ == "__main__":
         parser.error("Bad value of --route_write_batch_size given, must "\
             "be > 0.")
 
+    if options.writer not in ALLOWED_WRITERS:
+        parser.print_help()
+        parser.error("Writer option requested '%s' not in allowed set, of %s"\
+            % (options.writer, ALLOWED_WRITERS))
+
+    n_workers = int(options.workers)
+    if n_workers <= 0:
+        parser.print_help()
+        parser.error("Bad value of --workers given, must be > 0.")
+    if n_workers > 1 and options.writer != WRITER_STREAM:
+        parser.print_help()
+        parser.error("--workers > 1 requires --writer=%s." % WRITER_STREAM)
+
+    build_cache_dir = None
+    if options.build_cache_dir:
+        build_cache_dir = os.path.expanduser(options.build_cache_dir)
+        if options.writer != WRITER_STREAM:
+            parser.print_help()
+            parser.error("--build_cache_dir requires --writer=%s." \
+                % WRITER_STREAM)
+
+    stage_stats_fname = None
+    if options.stage_stats:
+        stage_stats_fname = os.path.expanduser(options.stage_stats)
+    profile_dir = None
+    if options.profile_dir:
+        profile_dir = os.path.expanduser(options.profile_dir)
+    speed_snapshot_fname = None
+    if options.speed_model_snapshot:
+        speed_snapshot_fname = os.path.expanduser(options.speed_model_snapshot)
+    stats_recorder = None
+    if stage_stats_fname or profile_dir:
+        stats_recorder = stage_stats.StageStatsRecorder(profile_dir)
+        stage_stats.set_active_recorder(stats_recorder)
+
     mode_config = m_t_info.settings[options.service]
 
     seg_speed_model = None
-    if use_gtfs_speeds:
+    if use_gtfs_speeds and interpolate_speeds:
+        seg_speed_model = \
+            seg_speed_models.InterpolatedTimePeriodsPerRouteSpeedModel(
+                gtfs_speeds_dir)
+    elif use_gtfs_speeds:
         seg_speed_model = \
             seg_speed_models.MultipleTimePeriodsPerRouteSpeedModel(
                 gtfs_speeds_dir)    
+    elif vehicle_speeds:
+        if vehicle_speeds == 'mode':
+            vehicle_params = None
+        else:
+            vehicle_params = \
+                speed_funcs_vehicle_based.VEHICLE_CLASS_PARAMS[vehicle_speeds]
+        seg_speed_model = seg_speed_models.VehicleAccelDwellSpeedModel(
+            vehicle_params)
     elif use_seg_speeds:
         seg_speed_model = seg_speed_models.PerSegmentPeakOffPeakSpeedModel()
     else:
@@ -697,4 +1506,18 @@ if __name__ == "__main__":
         memory_db,
         delete_partials,
         route_write_batch_size,
-        per_route_hways_fname)
+        per_route_hways_fname,
+        options.writer,
+        n_workers,
+        use_frequencies,
+        build_cache_dir,
+        speed_snapshot_fname)
+
+    if stats_recorder is not None:
+        stats_recorder.print_summary()
+        if stage_stats_fname:
+            stats_recorder.write_json(stage_stats_fname)
+            print "Written stage stats to %s." % stage_stats_fname
+        if profile_dir:
+            stats_recorder.dump_profiles()
+            print "Written stage profiles to %s." % profile_dir
@@ -15,9 +15,11 @@ import misc_utils
 import parser_utils
 import route_segs
 import seg_speed_models
+import speed_model_snapshot
 import topology_shapefile_data_model as tp_model
 import mode_timetable_info as m_t_info
 import time_periods_hways_model as tps_hways_model
+import time_periods_speeds_model as tps_speeds_model
 
 # Length calculations:-
 
@@ -127,7 +129,8 @@ def format_timedelta_nicely(time_d):
     return "%d:%02d:%04.1f" % (hours, mins, secs)
 
 def get_all_route_infos(segs_lyr, stops_lyr, route_defs_csv_fname,
-        mode_config, seg_speed_model, per_route_hways=None, hways_tps=None):
+        mode_config, seg_speed_model, per_route_hways=None, hways_tps=None,
+        seg_speed_snapshot=None):
 
     route_defs = route_segs.read_route_defs(route_defs_csv_fname)
     route_defs.sort(key=route_segs.get_route_order_key_from_name)
@@ -167,7 +170,8 @@ def get_all_route_infos(segs_lyr, stops_lyr, route_defs_csv_fname,
     route_avg_speeds = {}
     route_vehicles_needed = {}
 
-    seg_speed_model.setup(route_defs, segs_lyr, stops_lyr, mode_config)
+    speed_model_snapshot.setup_speed_model(seg_speed_model, route_defs,
+        segs_lyr, stops_lyr, mode_config, seg_speed_snapshot)
 
     peak_serv_period_i = None
     peak_serv_period_to_use = None
@@ -314,10 +318,15 @@ def main():
             'If false, then will just use a constant speed defined per mode.')
     parser.add_option('--gtfs_speeds_dir', dest='gtfs_speeds_dir',
         help='Path to dir containing extracted speeds per time period from '
-            'a GTFS input file.')
+            'a GTFS input file (or a speeds pack file of them, created by '
+            'speeds_pack.py).')
     parser.add_option('--per_route_hways', dest='per_route_hways',
         help='An optional file specifying per-route headways in time '\
             'periods.')
+    parser.add_option('--speed_model_snapshot', dest='speed_model_snapshot',
+        help='Optional file to save a snapshot of the set up speed model '\
+            'to. Later runs with the same speed model and unchanged input '\
+            'files load it, rather than setting up the model again.')
     parser.set_defaults(output_csv='route_infos.csv', usesegspeeds='True')
     (options, args) = parser.parse_args()
 
@@ -376,13 +385,26 @@ def main():
     else:
         seg_speed_model = seg_speed_models.ConstantSpeedPerModeModel()
 
+    seg_speed_snapshot = None
+    if options.speed_model_snapshot:
+        seg_speed_snapshot = speed_model_snapshot.SpeedModelSnapshot(
+            os.path.expanduser(options.speed_model_snapshot),
+            [options.routes, options.segments, options.stops])
+
     segs_shp = osgeo.ogr.Open(options.segments)
     segs_lyr = segs_shp.GetLayer(0)
     stops_shp = osgeo.ogr.Open(options.stops)
     stops_lyr = stops_shp.GetLayer(0)
     
     get_all_route_infos(segs_lyr, stops_lyr, options.routes, mode_config,
-        seg_speed_model, per_route_hways, hways_tps)
+        seg_speed_model, per_route_hways, hways_tps, seg_speed_snapshot)
+    if seg_speed_snapshot and seg_speed_snapshot.loaded:
+        print "(Loaded speed model set up from snapshot %s.)" \
+            % seg_speed_snapshot.snapshot_fname
+    if use_gtfs_speeds:
+        speeds_cache = tps_speeds_model.get_parsed_speeds_cache()
+        print "(Speed files read: %d parsed, %d re-used from cache.)" \
+            % (speeds_cache.misses, speeds_cache.hits)
     segs_shp.Destroy()
     stops_shp.Destroy()
 
@@ -0,0 +1,207 @@
+"""A cache of the trips, stop times and frequencies generated for each route
+when creating a GTFS feed, so that re-running after small changes to the
+inputs only needs to re-generate the routes that actually changed.
+
+Each route's generated rows are stored as a fragment (see
+gtfs_stream_writer), keyed by a hash of all the inputs used to generate
+them: the route definition, the route's segments and their stops, the
+headways and mode config used, and what the speed model reads for the
+route (input files, and anything it matched in setup).
+
+Entries that aren't used by a run are pruned at the end of it, so the cache
+only holds the routes of the latest run."""
+
+import os
+import os.path
+import csv
+import json
+import re
+import shutil
+import hashlib
+
+import topology_shapefile_data_model as tp_model
+import speeds_pack
+import gtfs_stream_writer
+
+# Change this whenever the way trips are generated changes, so that old
+#  cached fragments aren't re-used.
+CACHE_FORMAT_VERSION = 2
+
+CACHE_META_FNAME = 'meta.json'
+
+# Names of entry dirs (keys are SHA-1 hex digests), including temporary ones.
+ENTRY_DIR_NAME_RE = re.compile(r'^[0-9a-f]{40}(\.tmp)?$')
+
+def hash_file_contents(fname, hasher):
+    pack_entry = speeds_pack.get_pack_entry(fname)
+    if pack_entry:
+        pack, entry_fname = pack_entry
+        contents = pack.get_contents(entry_fname)
+        if contents is None:
+            hasher.update(repr((fname, None)))
+        else:
+            hasher.update(repr((fname, len(contents))))
+            hasher.update(contents)
+        return
+    if not os.path.exists(fname):
+        hasher.update(repr((fname, None)))
+        return
+    hasher.update(repr((fname, os.path.getsize(fname))))
+    in_file = open(fname, 'rb')
+    while True:
+        chunk = in_file.read(gtfs_stream_writer.STREAM_BUFFER_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    in_file.close()
+    return
+
+def get_mode_config_items(mode_config):
+    """The mode config entries that can affect creating trips, sorted.
+    (Nested dicts, e.g. 'on_motorway', are only used in assigning speeds to
+    segments, and can refer back to mode_config.)"""
+    return sorted([(key, value) for key, value in mode_config.iteritems() \
+        if not isinstance(value, dict)])
+
+def calc_route_build_key(route_def, gtfs_route_id, serv_periods,
+        segs_lookup_table, stop_id_to_gtfs_stop_id_map, mode_config,
+        seg_speed_model, avg_hways_for_route, hways_tps, use_frequencies):
+    """Calculates the key to store the generated fragment of a route under,
+    as a hex string hash of everything used to generate it."""
+    hasher = hashlib.sha1()
+    hasher.update(repr(CACHE_FORMAT_VERSION))
+    hasher.update(repr((route_def.id, route_def.gtfs_origin_id,
+        route_def.short_name, route_def.long_name, route_def.dir_names,
+        route_def.ordered_seg_ids, gtfs_route_id)))
+    for seg_id in route_def.ordered_seg_ids:
+        seg_feature = segs_lookup_table.get(seg_id)
+        if seg_feature is None:
+            hasher.update(repr((seg_id, None)))
+            continue
+        seg_fields = [seg_feature.GetField(field_i) for field_i in \
+            range(seg_feature.GetFieldCount())]
+        stop_gtfs_ids = [stop_id_to_gtfs_stop_id_map.get(stop_id) \
+            for stop_id in tp_model.get_stop_ids_of_seg(seg_feature)]
+        hasher.update(repr((seg_id, seg_fields, stop_gtfs_ids)))
+    hasher.update(repr(get_mode_config_items(mode_config)))
+    if avg_hways_for_route:
+        hasher.update(repr(sorted(avg_hways_for_route.items())))
+        hasher.update(repr(hways_tps))
+    hasher.update(repr(use_frequencies))
+    hasher.update(seg_speed_model.__class__.__name__)
+    hasher.update(repr(seg_speed_model.get_params_signature()))
+    hasher.update(repr(seg_speed_model.get_route_input_signature(route_def)))
+    for fname in seg_speed_model.get_route_input_fnames(route_def,
+            serv_periods):
+        hash_file_contents(fname, hasher)
+    return hasher.hexdigest()
+
+def copy_table_renumbering_trips(in_fname, out_fname, trip_id_delta):
+    """Copy a trips, stop times or frequencies CSV file, adding trip_id_delta
+    to all the (integer) trip IDs in it."""
+    in_file = open(in_fname, 'rb', gtfs_stream_writer.STREAM_BUFFER_SIZE)
+    out_file = open(out_fname, 'wb', gtfs_stream_writer.STREAM_BUFFER_SIZE)
+    reader = csv.reader(in_file)
+    writer = csv.writer(out_file)
+    try:
+        header = reader.next()
+    except StopIteration:
+        # Empty table file.
+        header = None
+    if header is not None:
+        writer.writerow(header)
+        trip_id_i = header.index('trip_id')
+        for row in reader:
+            row[trip_id_i] = str(int(row[trip_id_i]) + trip_id_delta)
+            writer.writerow(row)
+    in_file.close()
+    out_file.close()
+    return
+
+class RouteBuildCache:
+    """A directory of cached route fragments, one sub-directory per key."""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def prune(self, keys_to_keep):
+        """Deletes all entries except those with keys in keys_to_keep (e.g.
+        the keys of all routes of this run), since old entries are never
+        used again once any input of their route changes. Returns the
+        number of entries deleted."""
+        n_pruned = 0
+        for entry_dir_name in os.listdir(self.cache_dir):
+            if not ENTRY_DIR_NAME_RE.match(entry_dir_name) \
+                    or entry_dir_name in keys_to_keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, entry_dir_name))
+            n_pruned += 1
+        return n_pruned
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self._get_entry_dir(key),
+            CACHE_META_FNAME))
+
+    def get_fragment(self, key, init_trip_id, tmp_prefix):
+        """Returns a tuple of a fragment (as created by
+        GTFSStreamWriter.close_fragment()) for the route with given key, with
+        trip IDs starting at init_trip_id, and whether the fragment's files
+        are temporary ones that should be deleted once appended.
+        Raises KeyError if there's no cached fragment for this key."""
+        if not self.contains(key):
+            raise KeyError(key)
+        self.hits += 1
+        entry_dir = self._get_entry_dir(key)
+        meta_file = open(os.path.join(entry_dir, CACHE_META_FNAME), 'r')
+        meta = json.load(meta_file)
+        meta_file.close()
+        trip_id_delta = init_trip_id - meta['init_trip_id']
+        fnames = {}
+        for table_fname in gtfs_stream_writer.STREAMED_TABLE_FNAMES:
+            cached_fname = os.path.join(entry_dir, table_fname)
+            if trip_id_delta == 0:
+                fnames[table_fname] = cached_fname
+            else:
+                # Route trips have to be numbered differently this time,
+                # since trip counts of earlier routes changed.
+                fnames[table_fname] = gtfs_stream_writer.get_stream_tmp_name(
+                    tmp_prefix, table_fname)
+                copy_table_renumbering_trips(cached_fname,
+                    fnames[table_fname], trip_id_delta)
+        fragment = (fnames, meta['n_trips'], meta['n_stop_times'],
+            meta['n_frequencies'])
+        return fragment, trip_id_delta != 0
+
+    def save_fragment(self, key, fragment, init_trip_id):
+        """Save a copy of a newly created fragment in the cache."""
+        self.misses += 1
+        fnames, n_trips, n_stop_times, n_frequencies = fragment
+        entry_dir = self._get_entry_dir(key)
+        # Write to a temporary dir first, so an interrupted run never
+        # leaves a partial entry.
+        tmp_entry_dir = entry_dir + ".tmp"
+        if os.path.exists(tmp_entry_dir):
+            shutil.rmtree(tmp_entry_dir)
+        os.makedirs(tmp_entry_dir)
+        for table_fname in gtfs_stream_writer.STREAMED_TABLE_FNAMES:
+            shutil.copyfile(fnames[table_fname],
+                os.path.join(tmp_entry_dir, table_fname))
+        meta = {
+            'init_trip_id': init_trip_id,
+            'n_trips': n_trips,
+            'n_stop_times': n_stop_times,
+            'n_frequencies': n_frequencies,
+            }
+        meta_file = open(os.path.join(tmp_entry_dir, CACHE_META_FNAME), 'w')
+        json.dump(meta, meta_file)
+        meta_file.close()
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(tmp_entry_dir, entry_dir)
+        return
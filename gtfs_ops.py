@@ -11,8 +11,15 @@ import operator
 import copy
 from datetime import time, datetime, date, timedelta
 import csv
+import codecs
 import math
+import io
+import zipfile
+import array
+import itertools
+from collections import OrderedDict
 
+import numpy
 import transitfeed
 from osgeo import ogr, osr
 
@@ -27,6 +34,11 @@ ALLOWED_ROUTE_NAME_TYPES = ['route_short_name', 'route_long_name']
 
 GTFS_EPSG = 4326
 
+# Ways of reading a GTFS file to extract route speeds and headways from.
+READER_COLUMNAR = 'columnar'
+READER_TRANSITFEED = 'transitfeed'
+ALLOWED_READERS = [READER_COLUMNAR, READER_TRANSITFEED]
+
 # GTFS time utils
 
 def secsInPeriodToTimeOfDay(secs_since_midnight):
@@ -248,56 +260,445 @@ def get_stop_ids_set_used_by_selected_routes(schedule, gtfs_route_ids):
             stop_ids_in_route)
     return stop_ids_used_by_routes
 
-def getStopVisitTimesForTripPatternByServPeriod(trips):
-    master_stops = trips[0].GetPattern()
-    master_stop_ids = [s.stop_id for s in master_stops]
-
+##############################################################################
+# Trips of routes as columns, for extracting speeds and headways.
+#
+# The extract_route_* functions below work on the trips of each pattern of a
+# route as columns, which can either be built from a loaded transitfeed
+# schedule, or read straight from a GTFS zip file with a ColumnarGTFSFeed
+# (much faster, and using much less memory, for large feeds).
+
+class Route_Pattern_Trips:
+    """A small struct of the trips of a route that all visit the same
+    sequence of stops (a trip pattern, as in transitfeed's
+    Route.GetPatternIdTripDict()), stored as columns :- the stops visited,
+    and for each trip its ID, headsign and service period, plus a trips x
+    stops array of the arrival times (in secs since midnight)."""
+    def __init__(self, stops, trip_ids, headsigns, service_ids, arrival_secs):
+        self.stops = stops
+        self.stop_ids = [stop.stop_id for stop in stops]
+        self.trip_ids = trip_ids
+        self.headsigns = headsigns
+        self.service_ids = service_ids
+        self.arrival_secs = arrival_secs
+
+    def get_trip_is_by_dir_serv_period(self):
+        """Returns a list of tuples of each (headsign, service period) pair
+        of the trips (in order first seen), and an array of the indices of
+        the trips with that pair."""
+        trip_is_by_pair = OrderedDict()
+        for trip_i, dir_period_pair in \
+                enumerate(zip(self.headsigns, self.service_ids)):
+            trip_is_by_pair.setdefault(dir_period_pair, []).append(trip_i)
+        return [(dir_period_pair, numpy.array(trip_is)) for \
+            dir_period_pair, trip_is in trip_is_by_pair.iteritems()]
+
+    def get_trip_is_by_arrival_offsets(self, trip_is):
+        """Splits the trips with indices trip_is into groups of trips with
+        the same arrival times at each stop relative to the start of the
+        trip (e.g. the same trip repeated through the day). Returns a list
+        of arrays of the indices of the trips of each group (in order first
+        seen)."""
+        trip_arr_offsets = self.arrival_secs[trip_is] \
+            - self.arrival_secs[trip_is, :1]
+        trip_is_by_offsets = OrderedDict()
+        for trip_i, arr_offsets in zip(trip_is.tolist(), trip_arr_offsets):
+            trip_is_by_offsets.setdefault(arr_offsets.tostring(),
+                []).append(trip_i)
+        return [numpy.array(group_trip_is) for group_trip_is \
+            in trip_is_by_offsets.itervalues()]
+
+class Columnar_GTFS_Route:
+    """A small struct of the fields of a GTFS route used in extracting
+    speeds and headways (named as in transitfeed's Route)."""
+    def __init__(self, route_id, route_short_name, route_long_name):
+        self.route_id = route_id
+        self.route_short_name = route_short_name
+        self.route_long_name = route_long_name
+
+class Columnar_GTFS_Stop:
+    """A small struct of the fields of a GTFS stop used in extracting
+    speeds and headways (named as in transitfeed's Stop)."""
+    def __init__(self, stop_id, stop_name, stop_lat, stop_lon):
+        self.stop_id = stop_id
+        self.stop_name = stop_name
+        self.stop_lat = stop_lat
+        self.stop_lon = stop_lon
+
+def gtfs_time_to_secs(time_str):
+    """Seconds since midnight of a GTFS time string (HH:MM:SS, where HH
+    can be past 24 for trips after midnight of the service day)."""
+    hours, mins, secs = time_str.split(':')
+    return int(hours) * 3600 + int(mins) * 60 + int(secs)
+
+# Buffer size (in bytes) for reading tables of GTFS zip files.
+GTFS_READ_BUFFER_SIZE = 1024 * 1024
+
+def open_gtfs_zip_table(gtfs_zip, table_fname):
+    """Returns a tuple of the opened table file in a GTFS zip file, a dict
+    of the index of each column by name, and a csv reader of its rows."""
+    # (Reading lines straight from the zip file is slow.)
+    table_file = io.BufferedReader(gtfs_zip.open(table_fname),
+        GTFS_READ_BUFFER_SIZE)
+    reader = csv.reader(table_file)
+    header = reader.next()
+    # Some feeds start files with a UTF-8 byte order mark.
+    if header and header[0].startswith(codecs.BOM_UTF8):
+        header[0] = header[0][len(codecs.BOM_UTF8):]
+    col_is = dict([(col_name.strip(), col_i) for col_i, col_name \
+        in enumerate(header)])
+    return table_file, col_is, reader
+
+class ColumnarGTFSFeed:
+    """The routes, stops, trips and stop times of a GTFS zip file needed to
+    extract route speeds and headways, streamed straight from the file into
+    columns (rather than loaded into a transitfeed schedule, which is much
+    slower, and doesn't validate anything). Stop times are kept in arrays
+    sorted by trip and stop sequence, with the trips of each route grouped
+    into patterns of the same stops (see get_route_pattern_trips()).
+
+    Trips with frequencies.txt entries are expanded into a trip for each run
+    (see expand_frequency_trips()).
+
+    Like a transitfeed schedule, has dicts of routes and stops, keyed by
+    GTFS ID, for the writing functions below."""
+    def __init__(self, gtfs_fname):
+        gtfs_zip = zipfile.ZipFile(gtfs_fname, 'r')
+        self.routes = self._read_routes(gtfs_zip)
+        self.stops = self._read_stops(gtfs_zip)
+        self._read_trips(gtfs_zip)
+        self._read_frequencies(gtfs_zip)
+        self._read_stop_times(gtfs_zip)
+        gtfs_zip.close()
+        self._group_route_pattern_trips()
+
+    def _read_routes(self, gtfs_zip):
+        table_file, col_is, reader = open_gtfs_zip_table(gtfs_zip,
+            'routes.txt')
+        id_i = col_is['route_id']
+        s_name_i = col_is.get('route_short_name')
+        l_name_i = col_is.get('route_long_name')
+        routes = OrderedDict()
+        for row in reader:
+            route_id = row[id_i]
+            routes[route_id] = Columnar_GTFS_Route(route_id,
+                row[s_name_i] if s_name_i is not None else '',
+                row[l_name_i] if l_name_i is not None else '')
+        table_file.close()
+        return routes
+
+    def _read_stops(self, gtfs_zip):
+        table_file, col_is, reader = open_gtfs_zip_table(gtfs_zip,
+            'stops.txt')
+        id_i = col_is['stop_id']
+        name_i = col_is['stop_name']
+        lat_i = col_is['stop_lat']
+        lon_i = col_is['stop_lon']
+        stops = {}
+        for row in reader:
+            stop_id = row[id_i]
+            stops[stop_id] = Columnar_GTFS_Stop(stop_id, row[name_i],
+                float(row[lat_i]), float(row[lon_i]))
+        table_file.close()
+        return stops
+
+    def _read_trips(self, gtfs_zip):
+        table_file, col_is, reader = open_gtfs_zip_table(gtfs_zip,
+            'trips.txt')
+        id_i = col_is['trip_id']
+        route_id_i = col_is['route_id']
+        serv_id_i = col_is['service_id']
+        headsign_i = col_is.get('trip_headsign')
+        self._trip_ids = []
+        self._trip_route_ids = []
+        self._trip_service_ids = []
+        self._trip_headsigns = []
+        for row in reader:
+            self._trip_ids.append(row[id_i])
+            self._trip_route_ids.append(row[route_id_i])
+            self._trip_service_ids.append(row[serv_id_i])
+            if headsign_i is not None:
+                self._trip_headsigns.append(row[headsign_i])
+            else:
+                self._trip_headsigns.append('')
+        table_file.close()
+        self._trip_is_by_id = dict([(trip_id, trip_i) for trip_i, trip_id \
+            in enumerate(self._trip_ids)])
+        return
+
+    def _read_frequencies(self, gtfs_zip):
+        """Reads the start times of the runs of each trip with frequencies,
+        keyed by trip index, in the same way as transitfeed's
+        Trip.GetFrequencyStartTimes()."""
+        self._trip_run_start_secs = {}
+        if 'frequencies.txt' not in gtfs_zip.namelist():
+            return
+        table_file, col_is, reader = open_gtfs_zip_table(gtfs_zip,
+            'frequencies.txt')
+        trip_id_i = col_is['trip_id']
+        start_time_i = col_is['start_time']
+        end_time_i = col_is['end_time']
+        headway_i = col_is['headway_secs']
+        for row in reader:
+            headway_secs = int(row[headway_i])
+            if headway_secs <= 0:
+                raise ValueError("Frequency of trip %s has a headway of %d "\
+                    "secs." % (row[trip_id_i], headway_secs))
+            trip_i = self._trip_is_by_id[row[trip_id_i]]
+            self._trip_run_start_secs.setdefault(trip_i, []).extend(
+                range(gtfs_time_to_secs(row[start_time_i]),
+                    gtfs_time_to_secs(row[end_time_i]), headway_secs))
+        table_file.close()
+        return
+
+    def _read_stop_times(self, gtfs_zip):
+        trip_is_by_id = self._trip_is_by_id
+        stop_ids = self.stops.keys()
+        stop_is_by_id = dict([(stop_id, stop_i) for stop_i, stop_id \
+            in enumerate(stop_ids)])
+        table_file, col_is, reader = open_gtfs_zip_table(gtfs_zip,
+            'stop_times.txt')
+        trip_id_i = col_is['trip_id']
+        stop_id_i = col_is['stop_id']
+        arr_time_i = col_is['arrival_time']
+        seq_i = col_is['stop_sequence']
+        # Build the columns as compact arrays while streaming.
+        trip_is = array.array('i')
+        stop_is = array.array('i')
+        arrival_secs = array.array('i')
+        sequences = array.array('i')
+        # Same times appear many times in a feed, so only parse each once.
+        secs_by_time_str = {}
+        # (Local names, as this loop runs for every stop time.)
+        trip_is_append = trip_is.append
+        stop_is_append = stop_is.append
+        arrival_secs_append = arrival_secs.append
+        sequences_append = sequences.append
+        for row in reader:
+            arr_time_str = row[arr_time_i]
+            try:
+                arr_secs = secs_by_time_str[arr_time_str]
+            except KeyError:
+                if not arr_time_str.strip():
+                    raise ValueError("Stop time of trip %s at stop %s has "\
+                        "no arrival time :- stop times that aren't "\
+                        "timepoints aren't supported." \
+                        % (row[trip_id_i], row[stop_id_i]))
+                arr_secs = gtfs_time_to_secs(arr_time_str)
+                secs_by_time_str[arr_time_str] = arr_secs
+            trip_is_append(trip_is_by_id[row[trip_id_i]])
+            stop_is_append(stop_is_by_id[row[stop_id_i]])
+            arrival_secs_append(arr_secs)
+            sequences_append(int(row[seq_i]))
+        table_file.close()
+        trip_is = numpy.frombuffer(trip_is, dtype=numpy.int32)
+        sequences = numpy.frombuffer(sequences, dtype=numpy.int32)
+        # Sort by trip, then stop sequence within each trip.
+        order = numpy.lexsort((sequences, trip_is))
+        self._st_trip_is = trip_is[order]
+        self._st_stop_is = numpy.frombuffer(stop_is,
+            dtype=numpy.int32)[order]
+        self._st_arrival_secs = numpy.frombuffer(arrival_secs,
+            dtype=numpy.int32)[order]
+        self._stops_by_i = [self.stops[stop_id] for stop_id in stop_ids]
+        return
+
+    def _group_route_pattern_trips(self):
+        # Stop times of trip ii are from trip_st_starts[ii] up to (but not
+        #  including) trip_st_starts[ii+1].
+        trip_st_starts = numpy.searchsorted(self._st_trip_is,
+            numpy.arange(len(self._trip_ids) + 1))
+        st_stop_is = self._st_stop_is
+        # Trip indices of each pattern of each route, in order first seen.
+        route_patterns = OrderedDict()
+        for trip_i, route_id in enumerate(self._trip_route_ids):
+            st_start = trip_st_starts[trip_i]
+            st_end = trip_st_starts[trip_i+1]
+            if st_end == st_start:
+                # Trips without stop times don't visit any stops.
+                continue
+            pattern_key = st_stop_is[st_start:st_end].tostring()
+            route_patterns.setdefault(route_id, OrderedDict()).setdefault(
+                pattern_key, []).append(trip_i)
+        self._route_pattern_trips = {}
+        for route_id, patterns in route_patterns.iteritems():
+            pattern_trips_list = []
+            for pattern_trip_is in patterns.itervalues():
+                pattern_trip_is = numpy.array(pattern_trip_is)
+                pattern_st_starts = trip_st_starts[pattern_trip_is]
+                n_stops = trip_st_starts[pattern_trip_is[0]+1] \
+                    - pattern_st_starts[0]
+                # Indices into stop time columns of each trip x stop.
+                st_is = pattern_st_starts[:, numpy.newaxis] \
+                    + numpy.arange(n_stops)
+                stops = [self._stops_by_i[stop_i] for stop_i \
+                    in st_stop_is[st_is[0]].tolist()]
+                pattern_trip_is, arrival_secs = expand_frequency_trips(
+                    pattern_trip_is, self._st_arrival_secs[st_is],
+                    self._trip_run_start_secs)
+                if len(pattern_trip_is) == 0:
+                    continue
+                pattern_trips_list.append(Route_Pattern_Trips(stops,
+                    [self._trip_ids[trip_i] for trip_i in pattern_trip_is],
+                    [self._trip_headsigns[trip_i] for trip_i \
+                        in pattern_trip_is],
+                    [self._trip_service_ids[trip_i] for trip_i \
+                        in pattern_trip_is],
+                    arrival_secs))
+            self._route_pattern_trips[route_id] = pattern_trips_list
+        return
+
+    def get_route_pattern_trips(self, gtfs_route_id):
+        """Returns a list of the Route_Pattern_Trips of each pattern of
+        route with given GTFS ID."""
+        return self._route_pattern_trips.get(gtfs_route_id, [])
+
+def expand_frequency_trips(trip_is, arrival_secs, run_start_secs_by_trip_i):
+    """Given an array of trip indices trip_is, and a trips x stops array of
+    their arrival times, replaces each trip that has runs defined by
+    frequencies (i.e. is in run_start_secs_by_trip_i, a dict of the start
+    time of each run keyed by trip index) with a trip for each run, with the
+    same arrival times relative to the start of the trip.
+    Returns a tuple of the new trip indices and arrival times."""
+    if not run_start_secs_by_trip_i:
+        return trip_is, arrival_secs
+    trip_is_list = trip_is.tolist()
+    if not [trip_i for trip_i in trip_is_list \
+            if trip_i in run_start_secs_by_trip_i]:
+        return trip_is, arrival_secs
+    run_trip_is = []
+    run_arrival_secs = []
+    for trip_ii, trip_i in enumerate(trip_is_list):
+        trip_arrival_secs = arrival_secs[trip_ii]
+        try:
+            run_start_secs = run_start_secs_by_trip_i[trip_i]
+        except KeyError:
+            run_trip_is.append(trip_i)
+            run_arrival_secs.append(trip_arrival_secs)
+            continue
+        arrival_offsets = trip_arrival_secs - trip_arrival_secs[0]
+        for run_secs in run_start_secs:
+            run_trip_is.append(trip_i)
+            run_arrival_secs.append(arrival_offsets + run_secs)
+    run_arrival_secs = numpy.array(run_arrival_secs,
+        dtype=arrival_secs.dtype).reshape(
+            (len(run_trip_is), arrival_secs.shape[1]))
+    return numpy.array(run_trip_is, dtype=trip_is.dtype), run_arrival_secs
+
+def get_route_pattern_trips(schedule, gtfs_route_id):
+    """Returns a list of the Route_Pattern_Trips of each pattern of route
+    with given GTFS ID, where schedule can be a transitfeed schedule or a
+    ColumnarGTFSFeed. Trips with frequencies are expanded into a trip for
+    each run, either way."""
+    if isinstance(schedule, ColumnarGTFSFeed):
+        return schedule.get_route_pattern_trips(gtfs_route_id)
+    gtfs_route = schedule.routes[gtfs_route_id]
+    trip_dict = gtfs_route.GetPatternIdTripDict()
+    route_pattern_trips = []
+    for trips in trip_dict.itervalues():
+        arrival_secs = numpy.array([[stop_time.arrival_secs for stop_time \
+            in trip.GetStopTimes()] for trip in trips])
+        run_start_secs_by_trip_i = {}
+        for trip_i, trip in enumerate(trips):
+            if trip.GetFrequencyTuples():
+                run_start_secs_by_trip_i[trip_i] = \
+                    trip.GetFrequencyStartTimes()
+        trip_is, arrival_secs = expand_frequency_trips(
+            numpy.arange(len(trips)), arrival_secs, run_start_secs_by_trip_i)
+        if len(trip_is) == 0:
+            continue
+        trip_is = trip_is.tolist()
+        route_pattern_trips.append(Route_Pattern_Trips(trips[0].GetPattern(),
+            [trips[trip_i].trip_id for trip_i in trip_is],
+            [trips[trip_i]['trip_headsign'] for trip_i in trip_is],
+            [trips[trip_i]['service_id'] for trip_i in trip_is],
+            arrival_secs))
+    return route_pattern_trips
+
+def load_gtfs_for_extraction(gtfs_fname, reader=READER_COLUMNAR):
+    """Load a GTFS zip file, to extract route speeds and headways from with
+    the extract_route_* functions below, using given reader (one of
+    ALLOWED_READERS)."""
+    if reader == READER_COLUMNAR:
+        return ColumnarGTFSFeed(gtfs_fname)
+    accumulator = transitfeed.SimpleProblemAccumulator()
+    problemReporter = transitfeed.ProblemReporter(accumulator)
+    loader = transitfeed.Loader(gtfs_fname, problems=problemReporter)
+    return loader.Load()
+
+def getStopVisitTimesForTripPatternByServPeriod(pattern_trips):
     stop_visit_times_by_p = {}
-    for trip in trips:
-        serv_period = trip.service_id
+    for (trip_dir, serv_period), trip_is in \
+            pattern_trips.get_trip_is_by_dir_serv_period():
         if serv_period not in stop_visit_times_by_p:
             stop_visit_times_by_p[serv_period] = {}
-            for s_id in master_stop_ids:
+            for s_id in pattern_trips.stop_ids:
                 stop_visit_times_by_p[serv_period][s_id] = []
-
-    for trip in trips:
-        serv_period = trip.service_id
-        for stop_time in trip.GetStopTimes():
-            s_id = stop_time.stop.stop_id
-            stop_visit_times_by_p[serv_period][s_id].append(
-                stop_time.arrival_secs)
+        stop_visit_times = stop_visit_times_by_p[serv_period]
+        for stop_i, s_id in enumerate(pattern_trips.stop_ids):
+            stop_visit_times[s_id].extend(
+                pattern_trips.arrival_secs[trip_is, stop_i].tolist())
     # Now sort all the visit times
     for serv_period, stop_visit_times in stop_visit_times_by_p.iteritems():
         for s_id, visit_times in stop_visit_times.iteritems():
             stop_visit_times_by_p[serv_period][s_id] = sorted(visit_times)
     return stop_visit_times_by_p
 
+def get_time_period_bounds_secs(time_periods):
+    """Returns arrays of the start and end times (in seconds since midnight)
+    of each of a list of time periods (pairs of timedeltas)."""
+    start_secs = numpy.array([misc_utils.tdToSecs(p_start) \
+        for p_start, p_end in time_periods], dtype=float)
+    end_secs = numpy.array([misc_utils.tdToSecs(p_end) \
+        for p_start, p_end in time_periods], dtype=float)
+    return start_secs, end_secs
+
+def bin_by_time_periods(times_by_group, time_periods, values_by_group=None):
+    """Counts the times (in seconds since midnight) of each group (e.g. visit
+    times of a stop), in each of the time periods. If values_by_group is
+    given (a value for each time), also sums those values in each period.
+
+    A time is in the first period it's between the start and end of
+    (inclusive), and times not in any period (e.g. before the first) are
+    skipped. The time periods must be in order, but the times in a group
+    don't have to be.
+
+    Returns a tuple of a 2D array of counts (by group, then period), and
+    a 2D array of sums (or None)."""
+    start_secs, end_secs = get_time_period_bounds_secs(time_periods)
+    n_groups = len(times_by_group)
+    n_periods = len(time_periods)
+    group_lens = [len(group_times) for group_times in times_by_group]
+    times = numpy.fromiter(itertools.chain.from_iterable(times_by_group),
+        dtype=float, count=sum(group_lens))
+    group_is = numpy.repeat(numpy.arange(n_groups), group_lens)
+    # Index of the first period that ends at or after each time.
+    period_is = numpy.searchsorted(end_secs, times, side='left')
+    in_period = period_is < n_periods
+    in_period &= times >= start_secs[numpy.minimum(period_is, n_periods-1)]
+    bin_is = group_is[in_period] * n_periods + period_is[in_period]
+    n_bins = n_groups * n_periods
+    counts = numpy.bincount(bin_is, minlength=n_bins)
+    counts = counts.reshape((n_groups, n_periods))
+    if values_by_group is None:
+        sums = None
+    else:
+        values = numpy.fromiter(
+            itertools.chain.from_iterable(values_by_group), dtype=float,
+            count=len(times))
+        sums = numpy.bincount(bin_is, weights=values[in_period],
+            minlength=n_bins)
+        sums = sums.reshape((n_groups, n_periods))
+    return counts, sums
+
 def getPeriodCountsByStopId(stop_visit_times, periods):
+    s_ids = stop_visit_times.keys()
+    counts, dummy = bin_by_time_periods(
+        [stop_visit_times[s_id] for s_id in s_ids], periods)
     period_totals = {}
-    for s_id, visit_times in stop_visit_times.iteritems():
-        period_totals[s_id] = [0] * len(periods)
-        curr_period_i = 0
-        p0, p1 = periods[0]
-        pstart_sec = misc_utils.tdToSecs(p0)
-        pend_sec = misc_utils.tdToSecs(p1)
-        for v_time_sec in visit_times:
-            if v_time_sec >= pstart_sec and v_time_sec <= pend_sec:
-                period_totals[s_id][curr_period_i] += 1
-            else:
-                curr_period_i += 1
-                if curr_period_i >= len(periods): 
-                    # We've gone through all periods of interest, so any more 
-                    # stop times must also be later, so go on to next stop.
-                    break
-                for period in periods[curr_period_i:]:
-                    p0, p1 = period
-                    pstart_sec = misc_utils.tdToSecs(p0)
-                    pend_sec = misc_utils.tdToSecs(p1)
-                    if v_time_sec >= pstart_sec and v_time_sec <= pend_sec:
-                        period_totals[s_id][curr_period_i] += 1
-                        break
-                    curr_period_i += 1    
-    return period_totals 
+    for s_id, s_period_counts in zip(s_ids, counts.tolist()):
+        period_totals[s_id] = s_period_counts
+    return period_totals
 
 def getPeriodHeadways(period_visit_counts_by_stop_id, periods):
     period_headways = {}
@@ -318,60 +719,51 @@ def calcHeadwaysMinutes(schedule, stop_visit_times, periods):
     period_headways = getPeriodHeadways(period_visit_counts, periods)
     return period_headways
 
-def build_nominal_stop_orders_by_dir_serv_period(trip_dict, p_keys,
+def build_nominal_stop_orders_by_dir_serv_period(route_pattern_trips,
         route_dir_serv_periods):
-    all_patterns_nominal_orders = {}
+    """Builds a nominal order of all stops visited for each direction and
+    service period, that is consistent with the order of stops of each
+    pattern (see misc_utils.merge_sequences_order)."""
+    stop_id_seqs_by_dir_serv_period = {}
     for dir_period_pair in route_dir_serv_periods:
-        all_patterns_nominal_orders[dir_period_pair] = []
+        stop_id_seqs_by_dir_serv_period[dir_period_pair] = OrderedDict()
 
-    for p_ii, p_key in enumerate(p_keys):
-        trips = trip_dict[p_keys[p_ii]]
-        for trip in trips:
-            trip_dir = trip['trip_headsign']
-            trip_serv_period = trip['service_id']
-            nominal_order = all_patterns_nominal_orders[\
-                (trip_dir,trip_serv_period)]
-            s_id_prev = None
-            for s_t_i, stop_time in enumerate(trip.GetStopTimes()):
-                s_id = stop_time.stop.stop_id
-                if s_id not in nominal_order:
-                    if s_t_i == 0:
-                        nominal_order.insert(0, s_id)
-                    elif s_id_prev:
-                        try:
-                            prev_i = nominal_order.index(s_id_prev)
-                            nominal_order.insert(prev_i+1, s_id)
-                        except ValueError:
-                            nominal_order.append(s_id)
-                    else:
-                        nominal_order.append(s_id)
-                s_id_prev = s_id
-    return all_patterns_nominal_orders
+    for pattern_trips in route_pattern_trips:
+        # All trips of the pattern visit the same stops, so only need each
+        #  distinct stop sequence once per direction and period.
+        for dir_period_pair, trip_is in \
+                pattern_trips.get_trip_is_by_dir_serv_period():
+            stop_id_seqs_by_dir_serv_period[dir_period_pair][
+                tuple(pattern_trips.stop_ids)] = True
 
+    all_patterns_nominal_orders = {}
+    for dir_period_pair, stop_id_seqs in \
+            stop_id_seqs_by_dir_serv_period.iteritems():
+        all_patterns_nominal_orders[dir_period_pair] = \
+            misc_utils.merge_sequences_order(stop_id_seqs.iterkeys())
+    return all_patterns_nominal_orders
 
-def build_stop_visit_times_by_dir_serv_period(trip_dict, p_keys,
+def build_stop_visit_times_by_dir_serv_period(route_pattern_trips,
         route_dir_serv_periods):
     all_patterns_stop_visit_times = {}
     for dir_period_pair in route_dir_serv_periods:
         all_patterns_stop_visit_times[dir_period_pair] = {}
 
-    for p_ii, p_key in enumerate(p_keys):
-        trips = trip_dict[p_keys[p_ii]]
+    for pattern_trips in route_pattern_trips:
         # Now add relevant info to all stop patterns list.
         # Note:- since this includes different dir, period pairs, need
         #  to do individually.
-        for trip in trips:
-            trip_dir = trip['trip_headsign']
-            trip_serv_period = trip['service_id']
+        for dir_period_pair, trip_is in \
+                pattern_trips.get_trip_is_by_dir_serv_period():
             all_patterns_entry = \
-                all_patterns_stop_visit_times[(trip_dir,trip_serv_period)]
-            for stop_time in trip.GetStopTimes():
-                s_id = stop_time.stop.stop_id
-                s_arr_time = stop_time.arrival_secs
+                all_patterns_stop_visit_times[dir_period_pair]
+            for stop_i, s_id in enumerate(pattern_trips.stop_ids):
+                s_arr_times = \
+                    pattern_trips.arrival_secs[trip_is, stop_i].tolist()
                 if s_id not in all_patterns_entry:
-                    all_patterns_entry[s_id] = [s_arr_time]
+                    all_patterns_entry[s_id] = s_arr_times
                 else:
-                    all_patterns_entry[s_id].append(s_arr_time)
+                    all_patterns_entry[s_id].extend(s_arr_times)
     # Sort results before returning
     for route_dir, serv_period in route_dir_serv_periods:
             all_patterns_entry = \
@@ -413,80 +805,99 @@ def get_update_seg_dist_m(seg_distances, stop_pair):
         seg_distances[s_id_pair] = seg_dist_m
     return seg_dist_m
 
-def calc_speed_on_segment_with_nearby_segs(trip_stop_time_pairs,
-        stop_time_pair, stop_pair_i, seg_distances, min_dist_for_speed_calc_m,
+def calc_speeds_on_segments_with_nearby_segs(trip_seg_dists_m,
+        trip_seg_trav_times_s, min_dist_for_speed_calc_m,
         min_time_for_speed_calc_s):
-    s_id_pair = (stop_time_pair[0].stop.stop_id,
-        stop_time_pair[1].stop.stop_id)
-    s_arr_time_pair = (stop_time_pair[0].arrival_secs,
-        stop_time_pair[1].arrival_secs)
-    stop_pair = (stop_time_pair[0].stop, stop_time_pair[1].stop)
-    seg_dist_m = get_update_seg_dist_m(seg_distances, stop_pair)
-    seg_trav_time_s = s_arr_time_pair[1] - s_arr_time_pair[0]
-    assert seg_trav_time_s >= (0.0 - 1e-6)
-
-    #print "In speed smoothing func:- initial seg is %d, dist %.1fm,"\
-    #    " time %.1f sec." % (stop_pair_i, seg_dist_m, seg_trav_time_s)
-
-    # Now, we have to keep adding segment speeds and times, till we reach
-    #  the min dist to calculate speed over.
-    speed_calc_total_dist_m = seg_dist_m
-    speed_calc_total_time_s = seg_trav_time_s
-    init_seg_i = stop_pair_i
-    move_magnitude = 1
-    go_forward_next = True
-    prev_at_trip_start = False
-    next_at_trip_end = False
-
-    while (speed_calc_total_dist_m < min_dist_for_speed_calc_m \
-            or speed_calc_total_time_s < min_time_for_speed_calc_s) \
-            and not (prev_at_trip_start and next_at_trip_end):
-        if go_forward_next:
-            seg_i_to_add = init_seg_i + move_magnitude
-            if seg_i_to_add >= len(trip_stop_time_pairs):
-                next_at_trip_end = True
-                go_forward_next = False
-                continue
+    """Calculates the speed on each segment of a trip, given the distances
+    and travel times of all the trip's segments, smoothed by including
+    nearby segments till the min dist and time are reached.
+
+    Nearby segments are added alternating forwards and backwards from each
+    segment (next, previous, 2nd next, 2nd previous, ...), skipping those
+    past either end of the trip, till both minimums are reached or the
+    whole trip is included. Returns a list of speeds (in km/h)."""
+    n_segs = len(trip_seg_dists_m)
+    last_seg_i = n_segs - 1
+    # Totals over any window of segments are then a difference of these.
+    cum_dists_m = [0.0] * (n_segs + 1)
+    cum_times_s = [0] * (n_segs + 1)
+    for seg_i in xrange(n_segs):
+        seg_dist_m = trip_seg_dists_m[seg_i]
+        seg_trav_time_s = trip_seg_trav_times_s[seg_i]
+        assert seg_dist_m >= (0.0 - 1e-6)
+        assert seg_trav_time_s >= (0.0 - 1e-6)
+        cum_dists_m[seg_i+1] = cum_dists_m[seg_i] + seg_dist_m
+        cum_times_s[seg_i+1] = cum_times_s[seg_i] + seg_trav_time_s
+    # Differences of the cumulative distances carry rounding errors, which
+    #  shouldn't decide if a window is long enough (e.g. a 500m segment
+    #  coming out as 499.99999m).
+    min_dist_m = min_dist_for_speed_calc_m \
+        - 1e-9 * max(cum_dists_m[-1], 1.0)
+    min_time_s = min_time_for_speed_calc_s
+
+    def get_window_ends(seg_i, n_steps):
+        # After n_steps of the moving window, it has moved forwards
+        #  (n_steps+1)/2 and backwards n_steps/2 segments.
+        first_i = seg_i - n_steps // 2
+        if first_i < 0:
+            first_i = 0
+        end_i = seg_i + (n_steps + 1) // 2 + 1
+        if end_i > n_segs:
+            end_i = n_segs
+        return first_i, end_i
+
+    def is_window_enough(seg_i, n_steps):
+        first_i, end_i = get_window_ends(seg_i, n_steps)
+        return cum_dists_m[end_i] - cum_dists_m[first_i] >= min_dist_m \
+            and cum_times_s[end_i] - cum_times_s[first_i] >= min_time_s
+
+    smoothed_seg_speeds_km_h = []
+    n_steps = 0
+    for seg_i in xrange(n_segs):
+        # Totals only grow with more steps, so search for the fewest steps
+        #  that reach both minimums, starting from the steps needed by the
+        #  previous segment (usually about the same), widening the search
+        #  by doubling, then a binary search. The most steps needed is
+        #  when the window covers the whole trip.
+        max_steps = 2 * max(seg_i, last_seg_i - seg_i)
+        if n_steps > max_steps:
+            n_steps = max_steps
+        if n_steps == max_steps or is_window_enough(seg_i, n_steps):
+            hi_steps = n_steps
+            lo_steps = n_steps
+            step_size = 1
+            while lo_steps > 0:
+                lo_steps = max(hi_steps - step_size, 0)
+                if not is_window_enough(seg_i, lo_steps):
+                    lo_steps += 1
+                    break
+                hi_steps = lo_steps
+                step_size *= 2
         else:
-            seg_i_to_add = init_seg_i - move_magnitude
-            if seg_i_to_add < 0:
-                prev_at_trip_start = True
-                go_forward_next = True
-                move_magnitude += 1
-                continue
-
-        #print "...adding time and dist for seg %d..." % seg_i_to_add
-        stop_time_pair = trip_stop_time_pairs[seg_i_to_add]
-        new_s_id_pair = (stop_time_pair[0].stop.stop_id, \
-            stop_time_pair[1].stop.stop_id)
-
-        stop_pair = (stop_time_pair[0].stop, stop_time_pair[1].stop)
-        new_seg_dist_m = get_update_seg_dist_m(seg_distances, stop_pair)
-        assert new_seg_dist_m >= (0.0 - 1e-6)
-        speed_calc_total_dist_m += new_seg_dist_m
-
-        new_seg_trav_time_s = stop_time_pair[1].arrival_secs - \
-            stop_time_pair[0].arrival_secs 
-        assert new_seg_trav_time_s >= (0.0 - 1e-6)
-        speed_calc_total_time_s += new_seg_trav_time_s 
-
-        # This handles the 'moving window' of adding segments to total,
-        #  alternating between forwards and backwards.
-        go_forward_next = not go_forward_next
-        if go_forward_next:
-            move_magnitude += 1
-        
-    #print "...for speed calc, total dist is %.1f m, total time %.1f s" % \
-    #    (speed_calc_total_dist_m, speed_calc_total_time_s)
-    # use a function here to handle units, special cases (e.g.
-    # where dist or time = 0)
-    smoothed_seg_speed_km_h = calc_seg_speed_km_h(speed_calc_total_dist_m,
-        speed_calc_total_time_s)
-    #print "...thus speed calculated as %.2f km/h" % \
-    #    (smoothed_seg_speed_km_h)
-    return smoothed_seg_speed_km_h
-
-def build_segment_speeds_by_dir_serv_period(trip_dict, p_keys,
+            lo_steps = n_steps + 1
+            hi_steps = lo_steps
+            step_size = 1
+            while hi_steps < max_steps \
+                    and not is_window_enough(seg_i, hi_steps):
+                lo_steps = hi_steps + 1
+                hi_steps = min(hi_steps + step_size, max_steps)
+                step_size *= 2
+        while lo_steps < hi_steps:
+            mid_steps = (lo_steps + hi_steps) // 2
+            if is_window_enough(seg_i, mid_steps):
+                hi_steps = mid_steps
+            else:
+                lo_steps = mid_steps + 1
+        n_steps = hi_steps
+        first_i, end_i = get_window_ends(seg_i, n_steps)
+        # use a function here to handle units, special cases (e.g.
+        # where dist or time = 0)
+        smoothed_seg_speeds_km_h.append(calc_seg_speed_km_h(
+            cum_dists_m[end_i] - cum_dists_m[first_i],
+            cum_times_s[end_i] - cum_times_s[first_i]))
+    return smoothed_seg_speeds_km_h
+
+def build_segment_speeds_by_dir_serv_period(route_pattern_trips,
         route_dir_serv_periods, min_dist_for_speed_calc_m,
         min_time_for_speed_calc_s):
     all_patterns_stop_visit_times = {}
@@ -497,42 +908,46 @@ def build_segment_speeds_by_dir_serv_period(trip_dict, p_keys,
     #  needed stop pairs (segments) for this route.
     seg_distances = {}
     
-    for p_ii, p_key in enumerate(p_keys):
-        trips = trip_dict[p_keys[p_ii]]
+    for pattern_trips in route_pattern_trips:
+        # All trips of the pattern visit the same stops, so have the same
+        #  segment distances.
+        pattern_s_id_pairs = list(misc_utils.pairs(pattern_trips.stop_ids))
+        pattern_seg_dists_m = [get_update_seg_dist_m(seg_distances,
+            stop_pair) for stop_pair in misc_utils.pairs(pattern_trips.stops)]
         # Now add relevant info to all stop patterns list.
         # Note:- since this includes different dir, period pairs, need
         #  to do individually.
-        for trip in trips:
-            trip_dir = trip['trip_headsign']
-            trip_serv_period = trip['service_id']
+        for dir_period_pair, trip_is in \
+                pattern_trips.get_trip_is_by_dir_serv_period():
             all_patterns_entry = \
-                all_patterns_stop_visit_times[(trip_dir,trip_serv_period)]
-            trip_stop_time_pairs = list(misc_utils.pairs(trip.GetStopTimes()))
-            for seg_i, stop_time_pair in enumerate(trip_stop_time_pairs):
-                s_id_pair = (stop_time_pair[0].stop.stop_id,
-                    stop_time_pair[1].stop.stop_id)
-                stop_pair = (stop_time_pair[0].stop, stop_time_pair[1].stop)
-                s_arr_time_pair = (stop_time_pair[0].arrival_secs,
-                    stop_time_pair[1].arrival_secs)
-                seg_dist_m = get_update_seg_dist_m(seg_distances,
-                    stop_pair)
-
+                all_patterns_stop_visit_times[dir_period_pair]
+            # Trips with the same times between stops have the same speeds,
+            #  so only need to calculate them once per group of these.
+            for group_trip_is in \
+                    pattern_trips.get_trip_is_by_arrival_offsets(trip_is):
+                group_arr_times = pattern_trips.arrival_secs[group_trip_is]
+                group_seg_trav_times_s = \
+                    numpy.diff(group_arr_times[0]).tolist()
                 # We need to calculate a 'smoothed' travel time and thus
                 # speed, over several segments :- since for many GTFS feeds,
                 # stop times are rounded to the minute.
-                seg_speed_km_h = calc_speed_on_segment_with_nearby_segs(
-                    trip_stop_time_pairs, stop_time_pair, seg_i,
-                    seg_distances, min_dist_for_speed_calc_m, 
-                    min_time_for_speed_calc_s)
-
-                assert seg_speed_km_h >= 0.0
-                seg_speed_tuple = (s_arr_time_pair[0], s_arr_time_pair[1],
-                    seg_speed_km_h)
-    
-                if s_id_pair not in all_patterns_entry:
-                    all_patterns_entry[s_id_pair] = [seg_speed_tuple]
-                else:
-                    all_patterns_entry[s_id_pair].append(seg_speed_tuple)
+                group_seg_speeds_km_h = \
+                    calc_speeds_on_segments_with_nearby_segs(
+                        pattern_seg_dists_m, group_seg_trav_times_s,
+                        min_dist_for_speed_calc_m, min_time_for_speed_calc_s)
+                # Arrival times at each stop, of all trips of the group.
+                stop_arr_times = group_arr_times.T.tolist()
+                for seg_i, s_id_pair in enumerate(pattern_s_id_pairs):
+                    seg_speed_km_h = group_seg_speeds_km_h[seg_i]
+                    assert seg_speed_km_h >= 0.0
+                    seg_speed_tuples = zip(stop_arr_times[seg_i],
+                        stop_arr_times[seg_i+1],
+                        [seg_speed_km_h] * len(group_trip_is))
+                    if s_id_pair not in all_patterns_entry:
+                        all_patterns_entry[s_id_pair] = seg_speed_tuples
+                    else:
+                        all_patterns_entry[s_id_pair].extend(
+                            seg_speed_tuples)
 
     # Sort results before returning
     for route_dir, serv_period in route_dir_serv_periods:
@@ -545,46 +960,51 @@ def build_segment_speeds_by_dir_serv_period(trip_dict, p_keys,
 
     return all_patterns_stop_visit_times, seg_distances
 
-def build_trav_times_by_dir_serv_period_between_selected_stops(trip_dict, p_keys,
-        route_dir_serv_periods, min_dist_for_speed_calc_m,
-        min_time_for_speed_calc_s, selected_stop_ids):
+def build_trav_times_by_dir_serv_period_between_selected_stops(
+        route_pattern_trips, route_dir_serv_periods,
+        min_dist_for_speed_calc_m, min_time_for_speed_calc_s,
+        selected_stop_ids):
     all_patterns_stop_visit_times = {}
     for dir_period_pair in route_dir_serv_periods:
         all_patterns_stop_visit_times[dir_period_pair] = {}
 
-    for p_ii, p_key in enumerate(p_keys):
-        trips = trip_dict[p_keys[p_ii]]
+    for pattern_trips in route_pattern_trips:
+        # Pairs of consecutive selected stops visited are the same for all
+        #  trips of the pattern.
+        sel_stop_is = [stop_i for stop_i, stop_id \
+            in enumerate(pattern_trips.stop_ids) \
+            if stop_id in selected_stop_ids]
+        sel_stop_i_pairs = list(misc_utils.pairs(sel_stop_is)) \
+            if sel_stop_is else []
         # Now add relevant info to all stop patterns list.
         # Note:- since this includes different dir, period pairs, need
         #  to do individually.
-        for trip in trips:
-            trip_dir = trip['trip_headsign']
-            trip_serv_period = trip['service_id']
+        for dir_period_pair, trip_is in \
+                pattern_trips.get_trip_is_by_dir_serv_period():
             all_patterns_entry = \
-                all_patterns_stop_visit_times[(trip_dir,trip_serv_period)]
-            #trip_stop_time_pairs = list(misc_utils.pairs(trip.GetStopTimes()))
-            #for seg_i, stop_time_pair in enumerate(trip_stop_time_pairs):
-            prev_sel_stop_id = None
-            prev_sel_stop_time = None
-            for stop_i, stop_time_tuple in enumerate(trip.GetStopTimes()):
-                stop_id = stop_time_tuple.stop.stop_id
-                if stop_id not in selected_stop_ids:
-                    continue
-                else:
-                    if prev_sel_stop_id:
-                        # We can save this pair's speed.
-                        curr_stop_time = stop_time_tuple.arrival_secs  
-                        trav_time_between_stops = \
-                            (curr_stop_time - prev_sel_stop_time) / 60.0
-                        s_id_pair = (prev_sel_stop_id, stop_id)
-                        seg_ttime_tuple = (prev_sel_stop_time, \
-                            curr_stop_time, trav_time_between_stops)
-                        if s_id_pair not in all_patterns_entry:
-                            all_patterns_entry[s_id_pair] = [seg_ttime_tuple]
-                        else:
-                            all_patterns_entry[s_id_pair].append(seg_ttime_tuple)
-                    prev_sel_stop_time = stop_time_tuple.arrival_secs
-                    prev_sel_stop_id = stop_id
+                all_patterns_stop_visit_times[dir_period_pair]
+            # Trips with the same times between stops have the same travel
+            #  times, so only need to calculate them once per group.
+            for group_trip_is in \
+                    pattern_trips.get_trip_is_by_arrival_offsets(trip_is):
+                group_arr_times = pattern_trips.arrival_secs[group_trip_is]
+                first_arr_times = group_arr_times[0].tolist()
+                # Arrival times at each stop, of all trips of the group.
+                stop_arr_times = group_arr_times.T.tolist()
+                for prev_sel_stop_i, sel_stop_i in sel_stop_i_pairs:
+                    trav_time_between_stops = \
+                        (first_arr_times[sel_stop_i] \
+                            - first_arr_times[prev_sel_stop_i]) / 60.0
+                    s_id_pair = (pattern_trips.stop_ids[prev_sel_stop_i],
+                        pattern_trips.stop_ids[sel_stop_i])
+                    seg_ttime_tuples = zip(stop_arr_times[prev_sel_stop_i],
+                        stop_arr_times[sel_stop_i],
+                        [trav_time_between_stops] * len(group_trip_is))
+                    if s_id_pair not in all_patterns_entry:
+                        all_patterns_entry[s_id_pair] = seg_ttime_tuples
+                    else:
+                        all_patterns_entry[s_id_pair].extend(
+                            seg_ttime_tuples)
 
     # Sort results before returning
     for route_dir, serv_period in route_dir_serv_periods:
@@ -601,66 +1021,28 @@ def calc_avg_segment_property_during_time_periods(schedule, seg_properties_dict,
         time_periods, sort_seg_stop_id_pairs=False):
     """Calculates the average of multiple values for each segment (stop ID
     pair), grouping into time periods. The 'property' could be e.g. speed, or
-    travel time.
-    Note:- assumes and requires that the seg_properties_dict is already in
-    sorted order."""
-    
-    properties_in_periods = {}
+    travel time."""
+    out_s_id_pairs = []
+    seg_properties_by_out_pair = {}
     for s_id_pair, seg_property_tuples in seg_properties_dict.iteritems():
         if sort_seg_stop_id_pairs:
             out_s_id_pair = tuple(sorted(s_id_pair))
         else:
             out_s_id_pair = s_id_pair
-        properties_in_periods[out_s_id_pair] = \
-            [[] for dummy in xrange(len(time_periods))]
-        curr_period_i = 0
-        p_start, p_end = time_periods[0]
-        pstart_sec = misc_utils.tdToSecs(p_start)
-        pend_sec = misc_utils.tdToSecs(p_end)
-        for pt_a_time, pt_b_time, seg_property in seg_property_tuples:
-            if pt_a_time < pstart_sec:
-                # This travel time pair is before any of the time periods of interest.
-                # So skip to next occurence of the day.
-                continue
-            if pt_a_time >= pstart_sec and pt_a_time <= pend_sec:
-                times_in_period = \
-                    properties_in_periods[out_s_id_pair][curr_period_i]
-                times_in_period.append(seg_property)
-            else:
-                curr_period_i += 1
-                if curr_period_i >= len(time_periods):
-                    # We've gone through all periods of interest :- go 
-                    #  on to next segment.
-                    break
-                for time_period in time_periods[curr_period_i:]:
-                    p_start, p_end = time_period
-                    pstart_sec = misc_utils.tdToSecs(p_start)
-                    pend_sec = misc_utils.tdToSecs(p_end)
-                    if pt_a_time >= pstart_sec and pt_a_time <= pend_sec:
-                        times_in_period = \
-                            properties_in_periods[out_s_id_pair][curr_period_i]
-                        times_in_period.append(seg_property)
-                        break
-                    curr_period_i += 1
+        out_s_id_pairs.append(out_s_id_pair)
+        seg_properties_by_out_pair[out_s_id_pair] = seg_property_tuples
+    # Segments are in periods by the time at the first stop of the pair.
+    counts, sums = bin_by_time_periods(
+        [[prop_tuple[0] for prop_tuple in seg_properties_by_out_pair[pair]] \
+            for pair in out_s_id_pairs], time_periods,
+        [[prop_tuple[2] for prop_tuple in seg_properties_by_out_pair[pair]] \
+            for pair in out_s_id_pairs])
     avg_properties = {}
-    property_min_maxes = {}
-    for s_id_pair in seg_properties_dict.iterkeys():
-        if sort_seg_stop_id_pairs:
-            out_s_id_pair = tuple(sorted(s_id_pair))
-        else:
-            out_s_id_pair = s_id_pair
-        avg_properties[out_s_id_pair] = []
-        property_min_maxes[out_s_id_pair] = []
-        for period_i in range(len(time_periods)):
-            s_in_p = properties_in_periods[out_s_id_pair][period_i]
-            if len(s_in_p) == 0:
-                avg_properties[out_s_id_pair].append(-1)
-                property_min_maxes[out_s_id_pair].append(None)
-            else:
-                avg_property_in_p = sum(s_in_p) / float(len(s_in_p))
-                avg_properties[out_s_id_pair].append(avg_property_in_p)
-                property_min_maxes[out_s_id_pair].append(
-                    (min(s_in_p), max(s_in_p)))
+    for out_s_id_pair, p_counts, p_sums in \
+            zip(out_s_id_pairs, counts.tolist(), sums.tolist()):
+        avg_properties[out_s_id_pair] = \
+            [p_sum / float(p_count) if p_count > 0 else -1 \
+                for p_count, p_sum in zip(p_counts, p_sums)]
     return avg_properties
 
 def extract_route_dir_serv_period_tuples(trip_patterns_dict):
@@ -676,17 +1058,26 @@ def extract_route_dir_serv_period_tuples(trip_patterns_dict):
                 route_dir_serv_periods.append(dir_period_pair)
     return route_dir_serv_periods
 
-def print_trip_start_times_for_patterns(trip_patterns_dict):   
-    for p_ii, p_key in enumerate(trip_patterns_dict.keys()):
-        trips = trip_patterns_dict[p_key]
-        n_trips = len(trips)
-        trips_headsign = trips[0].trip_headsign
-        trip_pattern = trips[0].GetPattern()
-        n_stops = len(trip_pattern)
-        for trip in trips:
-            assert trip.trip_headsign == trips_headsign
-            assert len(trip.GetPattern()) == n_stops
-        trip_start_times = [t.GetStartTime() for t in trips]
+def get_route_dir_serv_period_pairs(route_pattern_trips):
+    """As extract_route_dir_serv_period_tuples(), for a list of
+    Route_Pattern_Trips."""
+    route_dir_serv_periods = []
+    for pattern_trips in route_pattern_trips:
+        for dir_period_pair, trip_is in \
+                pattern_trips.get_trip_is_by_dir_serv_period():
+            if dir_period_pair not in route_dir_serv_periods:
+                route_dir_serv_periods.append(dir_period_pair)
+    return route_dir_serv_periods
+
+def print_trip_start_times_for_patterns(route_pattern_trips):
+    for p_ii, pattern_trips in enumerate(route_pattern_trips):
+        n_trips = len(pattern_trips.trip_ids)
+        trips_headsign = pattern_trips.headsigns[0]
+        n_stops = len(pattern_trips.stop_ids)
+        for trip_headsign in pattern_trips.headsigns:
+            assert trip_headsign == trips_headsign
+        # (Arrival at first stop.)
+        trip_start_times = pattern_trips.arrival_secs[:, 0].tolist()
         print "P %d: %d trips, to '%s', with %d stops." % \
             (p_ii, n_trips, trips_headsign, n_stops)
         sorted_start_times = sorted(trip_start_times)
@@ -703,14 +1094,12 @@ def extract_route_speed_info_by_time_periods(schedule, gtfs_route_id,
         sort_seg_stop_id_pairs=False):
     """Note: See doc for function extract_route_freq_info_by_time_periods()
     for explanation of time_periods argument format."""
-    gtfs_route = schedule.routes[gtfs_route_id]
-    trip_dict = gtfs_route.GetPatternIdTripDict()
-    p_keys = trip_dict.keys()
-
-    route_dir_serv_periods = extract_route_dir_serv_period_tuples(trip_dict)
+    route_pattern_trips = get_route_pattern_trips(schedule, gtfs_route_id)
+    route_dir_serv_periods = get_route_dir_serv_period_pairs(
+        route_pattern_trips)
 
     all_patterns_segment_speed_infos, seg_distances = \
-        build_segment_speeds_by_dir_serv_period(trip_dict, p_keys,
+        build_segment_speeds_by_dir_serv_period(route_pattern_trips,
         route_dir_serv_periods, min_dist_for_speed_calc_m,
         min_time_for_speed_calc_s)
 
@@ -744,16 +1133,16 @@ def extract_route_trav_time_info_by_time_periods_between_selected_stops(schedule
         #        " necessary in this case."
         sort_seg_stop_id_pairs = True
 
-    gtfs_route = schedule.routes[str(gtfs_route_id)]
-    trip_dict = gtfs_route.GetPatternIdTripDict()
-    p_keys = trip_dict.keys()
-
-    route_dir_serv_periods = extract_route_dir_serv_period_tuples(trip_dict)
+    route_pattern_trips = get_route_pattern_trips(schedule,
+        str(gtfs_route_id))
+    route_dir_serv_periods = get_route_dir_serv_period_pairs(
+        route_pattern_trips)
 
     all_patterns_segment_trav_time_infos = \
-        build_trav_times_by_dir_serv_period_between_selected_stops(trip_dict, p_keys,
-            route_dir_serv_periods, min_dist_for_speed_calc_m,
-            min_time_for_speed_calc_s, stop_ids_of_interest)
+        build_trav_times_by_dir_serv_period_between_selected_stops(
+            route_pattern_trips, route_dir_serv_periods,
+            min_dist_for_speed_calc_m, min_time_for_speed_calc_s,
+            stop_ids_of_interest)
 
     route_avg_trav_times_during_time_periods = {}
     if not combine_dirs:
@@ -799,27 +1188,21 @@ def extract_route_trav_time_info_by_time_periods_between_selected_stops(schedule
 def extract_route_freq_info_by_time_periods_by_pattern(schedule,
         gtfs_route_id, time_periods):
 
-    gtfs_route = schedule.routes[gtfs_route_id]
-    trip_dict = gtfs_route.GetPatternIdTripDict()
-    p_keys = trip_dict.keys()
+    route_pattern_trips = get_route_pattern_trips(schedule, gtfs_route_id)
 
     print "Printing basic info for the %d trip patterns in this route." % \
-        len(trip_dict)
-    print_trip_start_times_for_patterns(trip_dict)
-    
-    route_dir_serv_periods = extract_route_dir_serv_period_tuples(trip_dict)
+        len(route_pattern_trips)
+    print_trip_start_times_for_patterns(route_pattern_trips)
 
     route_hways_by_pattern = []
     route_stop_orders_by_pattern = []
-    for p_ii, p_key in enumerate(p_keys):
-        trips = trip_dict[p_keys[p_ii]]
-        trips_dir = trips[0]['trip_headsign']
-        for trip in trips[1:]:
-            assert trip['trip_headsign'] == trips_dir
+    for pattern_trips in route_pattern_trips:
+        trips_dir = pattern_trips.headsigns[0]
+        for trip_headsign in pattern_trips.headsigns[1:]:
+            assert trip_headsign == trips_dir
         stop_visit_times_by_p = getStopVisitTimesForTripPatternByServPeriod(
-            trips)
-        stops_order = trips[0].GetPattern()
-        stop_ids_order = [s.stop_id for s in stops_order]
+            pattern_trips)
+        stop_ids_order = list(pattern_trips.stop_ids)
         route_stop_orders_by_pattern.append(stop_ids_order)
         period_headways_by_dir_period_pair = {}
         for serv_period, stop_visit_times in stop_visit_times_by_p.iteritems(): 
@@ -839,15 +1222,14 @@ def extract_route_freq_info_by_time_periods_all_patterns(schedule,
     starts. Latter is time that the period of interest ends.
     Periods need to be sequential, and shouldn't overlap."""
 
-    gtfs_route = schedule.routes[gtfs_route_id]
-    trip_dict = gtfs_route.GetPatternIdTripDict()
-    p_keys = trip_dict.keys()
-    route_dir_serv_periods = extract_route_dir_serv_period_tuples(trip_dict)
+    route_pattern_trips = get_route_pattern_trips(schedule, gtfs_route_id)
+    route_dir_serv_periods = get_route_dir_serv_period_pairs(
+        route_pattern_trips)
 
     all_patterns_stop_order = build_nominal_stop_orders_by_dir_serv_period(
-        trip_dict, p_keys, route_dir_serv_periods)
+        route_pattern_trips, route_dir_serv_periods)
     all_patterns_stop_visit_times = build_stop_visit_times_by_dir_serv_period(
-        trip_dict, p_keys, route_dir_serv_periods)
+        route_pattern_trips, route_dir_serv_periods)
 
     route_hways_all_patterns = {}
     for dir_period_pair in route_dir_serv_periods:
@@ -884,7 +1266,6 @@ def write_route_speed_info_by_time_periods(schedule, gtfs_route_id,
         os.makedirs(output_path)
 
     gtfs_route = schedule.routes[str(gtfs_route_id)]
-    trip_dict = gtfs_route.GetPatternIdTripDict()
 
     for route_dir, serv_period in \
             route_avg_speeds_during_time_periods.iterkeys():
@@ -912,8 +1293,6 @@ def write_route_freq_info_by_time_periods_by_patterns(schedule, gtfs_route_id,
         os.makedirs(output_path)
 
     gtfs_route = schedule.routes[gtfs_route_id]
-    trip_dict = gtfs_route.GetPatternIdTripDict()
-    route_dir_serv_periods = extract_route_dir_serv_period_tuples(trip_dict)
 
     for p_ii, pattern_hways in enumerate(hways_by_patterns):
         stop_write_order = pattern_stop_orders[p_ii]
@@ -937,10 +1316,9 @@ def write_route_freq_info_by_time_periods_all_patterns(schedule, gtfs_route_id,
     if not os.path.exists(output_path):
         os.makedirs(output_path)
     gtfs_route = schedule.routes[gtfs_route_id]
-    trip_dict = gtfs_route.GetPatternIdTripDict()
-    route_dir_serv_periods = extract_route_dir_serv_period_tuples(trip_dict)
 
-    for route_dir, serv_period in route_dir_serv_periods:
+    for route_dir, serv_period in \
+            route_hways_during_time_periods_all_patterns.iterkeys():
         stop_write_order = all_patterns_nominal_stop_orders[\
             (route_dir, serv_period)]
         stop_gtfs_ids_to_names_map = build_stop_gtfs_ids_to_names_map(
@@ -0,0 +1,283 @@
+"""Functions and classes for writing large GTFS feeds without holding every
+trip and stop time in a transitfeed Schedule object graph.
+
+The small 'static' tables (agency, calendar, stops, routes) are still built
+and written using a transitfeed Schedule, so their format is exactly what the
+transitfeed library produces. But trips and stop times are written as rows
+to buffered CSV files on disk as soon as they are generated, and only copied
+into the output zip at the end. So memory use doesn't grow with the number
+of trips.
+
+Trips and stop times rows of existing GTFS zip files (e.g. partial files
+written in batches) can also be appended, copied at the CSV level without
+loading them into a schedule."""
+
+import os
+import os.path
+import codecs
+import csv
+import zipfile
+
+import transitfeed
+
+# Buffer size (in bytes) of the files trip and stop time rows are streamed to.
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+TRIPS_FNAME = 'trips.txt'
+STOP_TIMES_FNAME = 'stop_times.txt'
+FREQUENCIES_FNAME = 'frequencies.txt'
+# Tables whose rows are streamed, rather than written from the schedule.
+STREAMED_TABLE_FNAMES = [TRIPS_FNAME, STOP_TIMES_FNAME, FREQUENCIES_FNAME]
+
+FREQUENCIES_COLUMNS = ['trip_id', 'start_time', 'end_time', 'headway_secs',
+    'exact_times']
+
+def get_stream_tmp_name(output_fname, table_fname):
+    fname = output_fname + ".%s.tmp" % os.path.splitext(table_fname)[0]
+    return fname
+
+def write_file_to_archive(archive, fname, table_fname):
+    """Copy a (possibly very large) file into archive in chunks, rather
+    than reading it all into memory first."""
+    # Same -rw-rw-rw permissions transitfeed gives entries it writes.
+    os.chmod(fname, 0666)
+    archive.write(fname, table_fname, zipfile.ZIP_DEFLATED)
+    return
+
+def copy_static_tables_to_archive(schedule, archive, output_fname):
+    """Writes all tables of schedule, except the streamed ones, into archive.
+    Does this by letting transitfeed write the (small) schedule to a
+    temporary file first, so the format is identical to what it would write
+    for a complete schedule."""
+    tmp_fname = output_fname + ".static.tmp.zip"
+    schedule.WriteGoogleTransitFeed(tmp_fname)
+    tmp_archive = zipfile.ZipFile(tmp_fname, 'r')
+    for zi in tmp_archive.infolist():
+        if zi.filename in STREAMED_TABLE_FNAMES:
+            continue
+        archive.writestr(zi, tmp_archive.read(zi.filename))
+    tmp_archive.close()
+    os.unlink(tmp_fname)
+    return
+
+def csv_header_to_columns(header_line):
+    return header_line.rstrip('\r\n').split(',')
+
+def append_table_rows(in_file, out_file, out_columns):
+    """Appends all the rows after the header of CSV file in_file, to out_file.
+    If out_columns is None, the header of in_file is written to out_file
+    first. Rows are copied in chunks without parsing them, unless in_file's
+    columns differ from out_columns, in which case they are re-ordered to
+    match (with columns in_file doesn't have left empty).
+    Raises ValueError if in_file has columns that out_file doesn't, since
+    their values would be lost.
+    Returns the columns of out_file, and the number of rows appended."""
+    header_line = in_file.readline()
+    if not header_line:
+        # Empty file, e.g. a fragment with no trips.
+        return out_columns, 0
+    if header_line.startswith(codecs.BOM_UTF8):
+        header_line = header_line[len(codecs.BOM_UTF8):]
+    in_columns = csv_header_to_columns(header_line)
+    if out_columns is None:
+        out_file.write(header_line)
+        out_columns = in_columns
+    n_rows = 0
+    if in_columns == out_columns:
+        while True:
+            chunk = in_file.read(STREAM_BUFFER_SIZE)
+            if not chunk:
+                break
+            out_file.write(chunk)
+            # No field values we write contain line breaks.
+            n_rows += chunk.count('\n')
+    else:
+        extra_columns = [col for col in in_columns if col not in out_columns]
+        if extra_columns:
+            raise ValueError("Can't append rows with column(s) %s, not in "\
+                "the columns %s already written." \
+                % (", ".join(extra_columns), ", ".join(out_columns)))
+        in_col_indices = [in_columns.index(col) if col in in_columns \
+            else None for col in out_columns]
+        writer = csv.writer(out_file)
+        for row in csv.reader(in_file):
+            writer.writerow([row[ii] if ii is not None else '' \
+                for ii in in_col_indices])
+            n_rows += 1
+    return out_columns, n_rows
+
+class StreamedTrip:
+    """A lightweight stand-in for a transitfeed Trip, that writes each stop
+    time (and frequency) added to it straight out as a row of the stop
+    times (or frequencies) CSV, rather than storing it."""
+    def __init__(self, trip_id, gtfs_writer):
+        self.trip_id = trip_id
+        self._gtfs_writer = gtfs_writer
+
+    def AddStopTimeObject(self, stop_time):
+        self._gtfs_writer.write_stop_time(self.trip_id, stop_time)
+
+    def AddFrequency(self, start_time, end_time, headway_secs, exact_times=0):
+        self._gtfs_writer.write_frequency(self.trip_id, start_time, end_time,
+            headway_secs, exact_times)
+
+class GTFSStreamWriter:
+    """Writes a GTFS zip file, streaming trips, stop times and frequencies
+    rows to disk as they are added.
+    Usage is to create, call add_trip() for each trip (and add stop times
+    to the returned trip object), then call close() with a schedule holding
+    the agency, service periods, routes and stops."""
+    def __init__(self, output_fname):
+        self.output_fname = output_fname
+        self.trips_written = 0
+        self.stop_times_written = 0
+        self.frequencies_written = 0
+        # Trip columns are only known once the first trip is added.
+        self._columns = {
+            TRIPS_FNAME: None,
+            STOP_TIMES_FNAME: list(transitfeed.StopTime._FIELD_NAMES),
+            FREQUENCIES_FNAME: list(FREQUENCIES_COLUMNS),
+            }
+        self._tmp_fnames = {}
+        self._files = {}
+        self._writers = {}
+        for table_fname in STREAMED_TABLE_FNAMES:
+            self._tmp_fnames[table_fname] = get_stream_tmp_name(output_fname,
+                table_fname)
+            self._files[table_fname] = open(self._tmp_fnames[table_fname],
+                'wb', STREAM_BUFFER_SIZE)
+            self._writers[table_fname] = transitfeed.util.CsvUnicodeWriter(
+                self._files[table_fname])
+        # Like transitfeed, always write stop_times.txt, but only write the
+        # other tables (headers written with the first row) if they have rows.
+        self._headers_written = set()
+        self._write_header(STOP_TIMES_FNAME)
+
+    def _write_header(self, table_fname):
+        self._writers[table_fname].writerow(self._columns[table_fname])
+        self._headers_written.add(table_fname)
+
+    def _write_row(self, table_fname, row):
+        if table_fname not in self._headers_written:
+            self._write_header(table_fname)
+        self._writers[table_fname].writerow(row)
+
+    def add_trip(self, route, headsign, trip_id, service_period):
+        """Equivalent of transitfeed's Route.AddTrip(), but writes the trip
+        row immediately, and returns a trip object that stop times can be
+        added to."""
+        trip = transitfeed.Trip(route=route, headsign=headsign,
+            service_period=service_period, trip_id=trip_id)
+        if self._columns[TRIPS_FNAME] is None:
+            # Same column order that transitfeed's Schedule would use
+            # after adding the trip.
+            self._columns[TRIPS_FNAME] = list(trip._ColumnNames())
+        trip_columns = self._columns[TRIPS_FNAME]
+        self._write_row(TRIPS_FNAME,
+            [transitfeed.util.EncodeUnicode(trip[c]) for c in trip_columns])
+        self.trips_written += 1
+        return StreamedTrip(trip_id, self)
+
+    def write_stop_time(self, trip_id, stop_time):
+        self._write_row(STOP_TIMES_FNAME,
+            stop_time.GetFieldValuesTuple(trip_id))
+        self.stop_times_written += 1
+
+    def write_frequency(self, trip_id, start_time, end_time, headway_secs,
+            exact_times=0):
+        """start_time and end_time are seconds since midnight."""
+        freq_values = {
+            'trip_id': trip_id,
+            'start_time': \
+                transitfeed.util.FormatSecondsSinceMidnight(start_time),
+            'end_time': transitfeed.util.FormatSecondsSinceMidnight(end_time),
+            'headway_secs': headway_secs,
+            'exact_times': exact_times,
+            }
+        # Columns could be in a different order, if taken from an appended
+        # feed.
+        self._write_row(FREQUENCIES_FNAME, [freq_values.get(c, '') \
+            for c in self._columns[FREQUENCIES_FNAME]])
+        self.frequencies_written += 1
+
+    def _close_tmp_files(self):
+        for table_fname in STREAMED_TABLE_FNAMES:
+            self._files[table_fname].close()
+
+    def close_fragment(self):
+        """Finish writing, where this writer is just being used to write the
+        trips and stop times for part of a feed (e.g. by a worker process).
+        Returns a fragment tuple, to be passed to append_fragment() of the
+        writer for the complete feed."""
+        self._close_tmp_files()
+        return (dict(self._tmp_fnames), self.trips_written,
+            self.stop_times_written, self.frequencies_written)
+
+    def _append_table(self, table_fname, in_file):
+        """Append rows from in_file (a CSV file with a header) to the given
+        table. Returns the number of rows appended."""
+        if table_fname in self._headers_written:
+            out_columns = self._columns[table_fname]
+        else:
+            # append_table_rows() will write in_file's header, (unless
+            # in_file is empty).
+            out_columns = None
+        out_columns, n_rows = append_table_rows(in_file,
+            self._files[table_fname], out_columns)
+        if out_columns is not None:
+            self._columns[table_fname] = out_columns
+            self._headers_written.add(table_fname)
+        return n_rows
+
+    def append_fragment(self, fragment, delete_files=True):
+        """Append all the rows of a fragment (created by close_fragment() of
+        another writer) to those of this writer, then delete the fragment's
+        files (unless delete_files is False)."""
+        tmp_fnames, n_trips, n_stop_times, n_frequencies = fragment
+        for table_fname in STREAMED_TABLE_FNAMES:
+            in_file = open(tmp_fnames[table_fname], 'rb', STREAM_BUFFER_SIZE)
+            self._append_table(table_fname, in_file)
+            in_file.close()
+            if delete_files:
+                os.unlink(tmp_fnames[table_fname])
+        self.trips_written += n_trips
+        self.stop_times_written += n_stop_times
+        self.frequencies_written += n_frequencies
+        return
+
+    def append_feed(self, feed_fname):
+        """Append all the trips, stop times and frequencies rows of an
+        existing GTFS zip file to those of this writer, streaming them across
+        rather than loading the file. (Other tables of the file are ignored,
+        they should be in the schedule passed to close())."""
+        archive = zipfile.ZipFile(feed_fname, 'r')
+        archive_fnames = archive.namelist()
+        n_rows = {}
+        for table_fname in STREAMED_TABLE_FNAMES:
+            n_rows[table_fname] = 0
+            if table_fname in archive_fnames:
+                in_file = archive.open(table_fname)
+                n_rows[table_fname] = self._append_table(table_fname, in_file)
+                in_file.close()
+        archive.close()
+        self.trips_written += n_rows[TRIPS_FNAME]
+        self.stop_times_written += n_rows[STOP_TIMES_FNAME]
+        self.frequencies_written += n_rows[FREQUENCIES_FNAME]
+        return
+
+    def close(self, schedule):
+        """Finish writing. schedule should contain everything except the
+        trips, stop times and frequencies (which have already been
+        streamed)."""
+        self._close_tmp_files()
+        archive = zipfile.ZipFile(self.output_fname, 'w',
+            zipfile.ZIP_DEFLATED, allowZip64=True)
+        copy_static_tables_to_archive(schedule, archive, self.output_fname)
+        for table_fname in STREAMED_TABLE_FNAMES:
+            if table_fname in self._headers_written:
+                write_file_to_archive(archive, self._tmp_fnames[table_fname],
+                    table_fname)
+        archive.close()
+        for table_fname in STREAMED_TABLE_FNAMES:
+            os.unlink(self._tmp_fnames[table_fname])
+        return
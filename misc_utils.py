@@ -2,6 +2,7 @@
 
 import os, os.path
 import math
+import heapq
 import platform
 from datetime import time, datetime, date, timedelta
 
@@ -29,6 +30,58 @@ def reverse_pairs(lst, loop=False):
     if loop == True:
         yield item, first
 
+def merge_sequences_order(sequences):
+    """Returns a list of all the items in a list of sequences, each only
+    once, ordered so that each item comes after all those it follows in any
+    of the sequences (a topological order of the graph of items following
+    each other).
+    Where there's a choice, or the sequences contradict each other (e.g.
+    loops), items that first appear earlier in the sequences go first, so
+    the order is deterministic."""
+    # Items by order of first appearance.
+    items = []
+    ranks = {}
+    next_items = {}
+    n_prev_items = {}
+    follow_pairs = set()
+    for sequence in sequences:
+        prev_item = None
+        for item in sequence:
+            if item not in ranks:
+                ranks[item] = len(items)
+                items.append(item)
+                next_items[item] = []
+                n_prev_items[item] = 0
+            if prev_item is not None and prev_item != item \
+                    and (prev_item, item) not in follow_pairs:
+                follow_pairs.add((prev_item, item))
+                next_items[prev_item].append(item)
+                n_prev_items[item] += 1
+            prev_item = item
+
+    ordered_items = []
+    added = set()
+    # Ranks of items ready to add, i.e. with all previous items added.
+    ready_ranks = [ranks[item] for item in items if n_prev_items[item] == 0]
+    heapq.heapify(ready_ranks)
+    earliest_rank = 0
+    while len(ordered_items) < len(items):
+        if ready_ranks:
+            item = items[heapq.heappop(ready_ranks)]
+        else:
+            # Only items in loops left :- break the loop at the item that
+            #  appears first.
+            while items[earliest_rank] in added:
+                earliest_rank += 1
+            item = items[earliest_rank]
+        added.add(item)
+        ordered_items.append(item)
+        for next_item in next_items[item]:
+            n_prev_items[next_item] -= 1
+            if n_prev_items[next_item] == 0 and next_item not in added:
+                heapq.heappush(ready_ranks, ranks[next_item])
+    return ordered_items
+
 #################################################
 # Handy time conversions - esp relevant for GTFS
 
@@ -42,6 +95,18 @@ def tdToSecs(td):
     secs = td.days * SECS_PER_DAY + td.seconds + td.microseconds / float(1e6)
     return secs
 
+def timeOfDayToSecs(time_of_day):
+    """Convert a Python time object to integer seconds since midnight
+    (ignoring any microseconds)."""
+    return time_of_day.hour * SECS_PER_HOUR + time_of_day.minute * 60 \
+        + time_of_day.second
+
+def secsToTimeOfDay(secs):
+    """Convert seconds since midnight (possibly past the next midnight, as
+    GTFS allows) to a Python time object."""
+    secs = int(secs) % SECS_PER_DAY
+    return time(secs // SECS_PER_HOUR, (secs % SECS_PER_HOUR) // 60, secs % 60)
+
 def tdToHours(td):
     return tdToSecs(td) / float(SECS_PER_HOUR)
 
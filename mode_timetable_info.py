@@ -1,5 +1,7 @@
 from datetime import datetime, date, time, timedelta
 
+import misc_utils
+
 TODAY = date.today()
 
 #Format:
@@ -218,6 +220,46 @@ def calc_service_time_elapsed_end_period(serv_headways, period_num):
         serv_headways[period_num][TP_END_COL])
     return tdiff
 
+def calc_total_service_secs_elapsed(first_period_start_secs, curr_secs):
+    """Seconds equivalent of calc_total_service_time_elapsed(), where
+    curr_secs is seconds since midnight (and may be past the next
+    midnight)."""
+    return (curr_secs - first_period_start_secs) % misc_utils.SECS_PER_DAY
+
+class ServiceHeadwaysSecs:
+    """Pre-calculated arrays of the period boundaries of a list of service
+    headways, as integer seconds since midnight. Built once per list of
+    service headways, so trips can be created without any datetime
+    arithmetic."""
+    def __init__(self, serv_headways):
+        self.serv_headways = serv_headways
+        self.first_start_secs = misc_utils.timeOfDayToSecs(
+            serv_headways[0][TP_START_COL])
+        self.start_secs = []
+        self.duration_secs = []
+        # Service time elapsed at end of each period.
+        self.end_elapsed_secs = []
+        # Headways are kept in microseconds, since average headways can be
+        # fractions of a second.
+        self.hway_usecs = []
+        self.peak_statuses = []
+        for period_info in serv_headways:
+            start_secs = misc_utils.timeOfDayToSecs(period_info[TP_START_COL])
+            end_secs = misc_utils.timeOfDayToSecs(period_info[TP_END_COL])
+            self.start_secs.append(start_secs)
+            # Handles periods that cross midnight.
+            self.duration_secs.append(
+                (end_secs - start_secs) % misc_utils.SECS_PER_DAY)
+            self.end_elapsed_secs.append(calc_total_service_secs_elapsed(
+                self.first_start_secs, end_secs))
+            hway_td = timedelta(minutes=period_info[HWAY_COL])
+            self.hway_usecs.append((hway_td.days * misc_utils.SECS_PER_DAY \
+                + hway_td.seconds) * 1000000 + hway_td.microseconds)
+            self.peak_statuses.append(period_info[PEAK_STATUS_COL])
+
+    def __len__(self):
+        return len(self.serv_headways)
+
 def get_freq_at_time(service_headways, time_of_day):
     for headway_period in service_headways:
         if time_of_day >= headway_period[TP_START_COL] and \
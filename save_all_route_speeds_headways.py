@@ -10,7 +10,6 @@ import csv
 from datetime import time, datetime, date, timedelta
 from optparse import OptionParser
 
-import transitfeed
 import gtfs_ops
 import route_segs
 
@@ -41,11 +40,20 @@ def main():
     parser.add_option('--time_period_max_hours',
         dest='time_period_max_hours',
         help='Maximum time period hours to use.')
+    parser.add_option('--gtfs_reader', dest='gtfs_reader',
+        help='How to read the input GTFS file, one of %s. \'%s\' streams '\
+            'just the needed tables from the file into columns, which is '\
+            'much faster for large feeds (but skips transitfeed '\
+            'validation). Either way, trips with frequencies.txt entries are '\
+            'expanded into a trip for each run (every headway_secs from '\
+            'start_time, up to end_time).' \
+            % (', '.join(gtfs_ops.ALLOWED_READERS), gtfs_ops.READER_COLUMNAR))
     parser.set_defaults(
         time_period_width_hours=2,
         time_period_max_hours=28,
         speed_calc_min_mins=4,
-        speed_calc_min_dist_m=0)
+        speed_calc_min_dist_m=0,
+        gtfs_reader=gtfs_ops.READER_COLUMNAR)
     (options, args) = parser.parse_args()
 
     if options.inputgtfs is None:
@@ -60,6 +68,10 @@ def main():
     if options.time_period_width_hours is None:
         parser.print_help()
         parser.error("No time period width (in hours) given.")
+    if options.gtfs_reader not in gtfs_ops.ALLOWED_READERS:
+        parser.print_help()
+        parser.error("GTFS reader option requested '%s' not in allowed set, "\
+            "of %s" % (options.gtfs_reader, gtfs_ops.ALLOWED_READERS))
     
     speed_smooth_min_mins = float(options.speed_calc_min_mins)
     speed_smooth_min_dist_m = float(options.speed_calc_min_dist_m)
@@ -91,12 +103,9 @@ def main():
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-    accumulator = transitfeed.SimpleProblemAccumulator()
-    problemReporter = transitfeed.ProblemReporter(accumulator)
-
-    loader = transitfeed.Loader(gtfs_input_fname, problems=problemReporter)
     print "Loading schedule ..."
-    schedule = loader.Load()
+    schedule = gtfs_ops.load_gtfs_for_extraction(gtfs_input_fname,
+        options.gtfs_reader)
     print "... done."
 
     time_periods = []
@@ -9,7 +9,6 @@ import operator
 from datetime import time, datetime, date, timedelta
 from optparse import OptionParser
 
-import transitfeed
 import gtfs_ops
 import route_segs
 import time_periods_hways_model as tps_hways_model
@@ -36,10 +35,19 @@ def main():
     parser.add_option('--round_places',
         dest='round_places',
         help='Number of places to round output minutes to.')
+    parser.add_option('--gtfs_reader', dest='gtfs_reader',
+        help='How to read the input GTFS file, one of %s. \'%s\' streams '\
+            'just the needed tables from the file into columns, which is '\
+            'much faster for large feeds (but skips transitfeed '\
+            'validation). Either way, trips with frequencies.txt entries are '\
+            'expanded into a trip for each run (every headway_secs from '\
+            'start_time, up to end_time).' \
+            % (', '.join(gtfs_ops.ALLOWED_READERS), gtfs_ops.READER_COLUMNAR))
     parser.set_defaults(
         time_period_width_hours=2,
         time_period_max_hours=28,
-        round_places=2)
+        round_places=2,
+        gtfs_reader=gtfs_ops.READER_COLUMNAR)
     (options, args) = parser.parse_args()
 
     if options.inputgtfs is None:
@@ -51,6 +59,10 @@ def main():
     if options.time_period_width_hours is None:
         parser.print_help()
         parser.error("No time period width (in hours) given.")
+    if options.gtfs_reader not in gtfs_ops.ALLOWED_READERS:
+        parser.print_help()
+        parser.error("GTFS reader option requested '%s' not in allowed set, "\
+            "of %s" % (options.gtfs_reader, gtfs_ops.ALLOWED_READERS))
     
     tp_width_hrs = float(options.time_period_width_hours)
     if tp_width_hrs <= 0 or tp_width_hrs > MAX_SERV_PERIOD_HRS:
@@ -72,12 +84,9 @@ def main():
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-    accumulator = transitfeed.SimpleProblemAccumulator()
-    problemReporter = transitfeed.ProblemReporter(accumulator)
-
-    loader = transitfeed.Loader(gtfs_input_fname, problems=problemReporter)
     print "Loading schedule ..."
-    schedule = loader.Load()
+    schedule = gtfs_ops.load_gtfs_for_extraction(gtfs_input_fname,
+        options.gtfs_reader)
     print "... done."
 
     time_periods = []
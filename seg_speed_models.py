@@ -2,14 +2,20 @@
 """A module for different speed models and functions for public transport in
 defining and writing timetables."""
 
+import os.path
 import sys
 import itertools
+import bisect
 from datetime import datetime, date, time, timedelta
 
+import numpy
 import osgeo.ogr
 from osgeo import ogr, osr
 
+import misc_utils
 import route_segs
+import route_geom_ops
+import motorway_calcs
 import topology_shapefile_data_model as tp_model
 import time_periods_speeds_model as tps_speeds_model
 import speed_funcs_location_based
@@ -33,6 +39,40 @@ class SpeedModel:
     def setup_for_route(self, route_def, serv_periods):
         return True
 
+    def get_setup_state(self):
+        """Returns the state set up by setup(), as plain dicts, lists and
+        numbers (no OGR features), so it can be saved to a speed model
+        snapshot (see speed_model_snapshot). Returns None if setup() is
+        cheap enough not to bother, which is the default."""
+        return None
+
+    def set_setup_state(self, setup_state):
+        """Restores state returned by get_setup_state(), instead of calling
+        setup()."""
+        raise NotImplementedError("Error, this is a base class abstract "
+            "method. Needs to be over-ridden by implementations that "
+            "override get_setup_state().")
+
+    def get_route_input_fnames(self, route_def, serv_periods):
+        """Returns a list of the input files (if any) this model reads speeds
+        for a route from, besides the segments shapefile. (So we can tell if
+        a route's speeds may have changed since last run.)"""
+        return []
+
+    def get_params_signature(self):
+        """Returns a (repr-able) signature of any parameters the model was
+        created with that affect speeds, besides the mode config. (Also so
+        we can tell if a route's speeds may have changed since last run.)"""
+        return None
+
+    def get_route_input_signature(self, route_def):
+        """Returns a (repr-able) signature of anything read in setup() that
+        affects the speeds of a route, besides its segments' fields (e.g.
+        stop IDs matched from the stops layer). Only valid after setup().
+        (Also so we can tell if a route's speeds may have changed since last
+        run.)"""
+        return None
+
     def setup_for_trip_set(self, route_def, serv_period, dir_id):
         # By default, do nothing.
         return True
@@ -40,6 +80,22 @@ class SpeedModel:
     def save_extra_seg_speed_info(self, next_segment, serv_period, travel_dir):
         # By default, do nothing :- as not all sub-classes use this.
         return
+
+    def get_stop_list_signature(self, route_def, serv_period, dir_id):
+        """Returns a (hashable) signature of what the extra seg speed info
+        saved for a trip set of the current route depends on. Trip sets of
+        the route in the same direction with equal signatures can share the
+        same stop list and extra seg speed info, rather than re-reading it
+        from the segments. Called after setup_for_trip_set().
+        By default, the service period, so it is saved again for each one."""
+        return serv_period
+
+    def reuse_extra_seg_speed_infos(self, seg_speed_infos):
+        """Called after setup_for_trip_set(), instead of
+        save_extra_seg_speed_info() for each segment, when re-using the stop
+        list of an earlier trip set with the same signature."""
+        # By default, do nothing :- as not all sub-classes use this.
+        return
     
     def add_extra_needed_speed_fields(self, segments_layer):
         # By default, do nothing :- as not all sub-classes use this.
@@ -50,6 +106,25 @@ class SpeedModel:
         raise NotImplementedError("Error, this is a base class abstract "
             "method. Needs to be over-ridden by implementations.")
 
+    def get_speeds_time_band(self, curr_time):
+        """For the current trip set, returns a tuple of (band key, band end
+        time), where for all times from curr_time up to (but not including)
+        band end time, get_speed_on_next_segment() is guaranteed to return
+        the same speed for a given segment and peak status. A band end time
+        of None means speeds don't change with time at all.
+        Returns None if no such guarantee can be given, which is the
+        safe default. (Used to share stop time offsets between trips.)"""
+        return None
+
+    def calc_trip_stop_offsets(self, seq_stop_infos, trip_start_secs):
+        """Models whose speeds don't depend on peak status can override this
+        to calculate the time (in integer secs) from the start of a trip to
+        each of its stops, for the whole trip in one call. seq_stop_infos are
+        the trip's stops, with their dist_km_to_next and extra_speed_info
+        (see create_gtfs_from_basicinfo.Seq_Stop_Info).
+        Returns None if not supported, which is the default."""
+        return None
+
     
 ############################################
 # Constant speed for entire mode model
@@ -66,6 +141,12 @@ class ConstantSpeedPerModeModel(SpeedModel):
             peak_status):
         return self._mode_avg_speed
 
+    def get_stop_list_signature(self, route_def, serv_period, dir_id):
+        return None
+
+    def get_speeds_time_band(self, curr_time):
+        return (None, None)
+
 #############################################
 # Peak and Off-Peak speeds per segment model.
 
@@ -111,6 +192,10 @@ class PerSegmentPeakOffPeakSpeedModel(SpeedModel):
         speed_ext = PeakOffPeakSegSpeedInfo(peak_speed_next, free_speed_next)
         return speed_ext
 
+    def get_stop_list_signature(self, route_def, serv_period, dir_id):
+        # Speeds are read from the segment, the same in all service periods.
+        return None
+
     def get_speed_on_next_segment(self, seg_speed_info, curr_time,
             peak_status):
         """Calculates travel time between two stops. Current algorithm is
@@ -123,16 +208,26 @@ class PerSegmentPeakOffPeakSpeedModel(SpeedModel):
             seg_speed = seg_speed_info.free_speed_next
         return seg_speed
 
+    def get_speeds_time_band(self, curr_time):
+        # Speeds only depend on peak status, not time.
+        return (None, None)
+
     def assign_speeds_to_all_segments(self, segments_layer, mode_config,
-            prelim_check_func, free_speed_func, peak_speed_func):
+            prelim_check_func, free_speed_func, peak_speed_func,
+            write_batch_size=None):
         if prelim_check_func:
-            prelim_check_func(segments_layer, mode_config)    
-        assign_speeds_to_segs(segments_layer, mode_config,
-            free_speed_func, SEG_FREE_SPEED_FIELD)
-        assign_speeds_to_segs(segments_layer, mode_config,
-            peak_speed_func, SEG_PEAK_SPEED_FIELD)
+            prelim_check_func(segments_layer, mode_config)
+        # Both speeds in one pass, so each segment is only written once.
+        assign_speeds_to_segs_all_fields(segments_layer, mode_config,
+            [(SEG_FREE_SPEED_FIELD, free_speed_func),
+             (SEG_PEAK_SPEED_FIELD, peak_speed_func)],
+            write_batch_size)
         return
 
+# Number of segments written per transaction, when assigning speeds to a
+#  segments layer whose driver supports transactions.
+DEFAULT_SPEEDS_WRITE_BATCH_SIZE = 5000
+
 def ensure_speed_field_exists(route_segments_lyr, speed_field_name):
     tp_model.ensure_field_exists(route_segments_lyr, speed_field_name,
         ogr.OFTReal, 24, 15)
@@ -145,27 +240,203 @@ def assign_speed_to_seg(route_segments_lyr, route_segment, speed_field_name,
     route_segments_lyr.SetFeature(route_segment)
 
 def assign_speeds_to_segs(route_segments_lyr, mode_config, speed_func,
-        speed_field_name):
-    ensure_speed_field_exists(route_segments_lyr, speed_field_name)
+        speed_field_name, write_batch_size=None):
+    assign_speeds_to_segs_all_fields(route_segments_lyr, mode_config,
+        [(speed_field_name, speed_func)], write_batch_size)
+    return
+
+def assign_speeds_to_segs_all_fields(route_segments_lyr, mode_config,
+        fields_and_speed_funcs, write_batch_size=None):
+    """Assigns speeds to every segment, for each (speed field name, speed
+    func) pair in fields_and_speed_funcs, in a single pass over the segments
+    (so each is written once).
+    If all the speed funcs have array versions (see ARRAY_SPEED_FUNCS), all
+    speeds are calculated at once first, from columns of segment properties
+    read in one pass, rather than per segment.
+    If the layer's driver supports transactions, writes are committed in
+    transactions of write_batch_size segments (default
+    DEFAULT_SPEEDS_WRITE_BATCH_SIZE). Otherwise (e.g. shapefiles) each
+    segment is just written back as it is read."""
+    if write_batch_size is None:
+        write_batch_size = DEFAULT_SPEEDS_WRITE_BATCH_SIZE
+    for speed_field_name, speed_func in fields_and_speed_funcs:
+        ensure_speed_field_exists(route_segments_lyr, speed_field_name)
+    array_speed_funcs = [ARRAY_SPEED_FUNCS.get(speed_func) for \
+        speed_field_name, speed_func in fields_and_speed_funcs]
+    seg_columns = None
+    speed_arrays = None
+    if None not in array_speed_funcs:
+        with_cbd_dists = bool(ARRAY_SPEED_FUNCS_USING_CBD_DISTS.intersection(
+            array_speed_funcs))
+        seg_columns = read_seg_speed_columns(route_segments_lyr,
+            with_cbd_dists)
+        speed_arrays = calc_seg_speeds_arrays(seg_columns, mode_config,
+            array_speed_funcs)
+    use_transactions = route_segments_lyr.TestCapability(
+        ogr.OLCTransactions)
     segs_total = route_segments_lyr.GetFeatureCount()
-    print "Assigning speed to all %d route segments:" % segs_total
+    print "Assigning speed to all %d route segments (fields %s):" \
+        % (segs_total, ", ".join([speed_field_name for speed_field_name, \
+            speed_func in fields_and_speed_funcs]))
     one_tenth = segs_total / 10.0
     segs_since_print = 0
-    for seg_num, route_segment in enumerate(route_segments_lyr):
-        if segs_since_print / one_tenth > 1:
-            print "...assigning to segment number %d ..." % (seg_num)
-            segs_since_print = 0
-        else:
-            segs_since_print += 1
-        speed = speed_func(route_segment, mode_config)
-        assign_speed_to_seg(route_segments_lyr, route_segment,
-            speed_field_name, speed)
-        route_segment.Destroy()    
-    print "...finished assigning speeds to segments."    
+    segs_in_batch = 0
+    if use_transactions:
+        route_segments_lyr.StartTransaction()
+    try:
+        for seg_num, route_segment in enumerate(route_segments_lyr):
+            if segs_since_print / one_tenth > 1:
+                print "...assigning to segment number %d ..." % (seg_num)
+                segs_since_print = 0
+            else:
+                segs_since_print += 1
+            if speed_arrays is not None:
+                assert route_segment.GetFID() == seg_columns.fids[seg_num]
+                speeds = [float(seg_speeds[seg_num]) for seg_speeds \
+                    in speed_arrays]
+            else:
+                speeds = [speed_func(route_segment, mode_config) for \
+                    speed_field_name, speed_func in fields_and_speed_funcs]
+            for field_ii, speed in enumerate(speeds):
+                route_segment.SetField(fields_and_speed_funcs[field_ii][0],
+                    speed)
+            # This SetFeature() call is necessary to actually write the
+            # changes back to the layer itself.
+            route_segments_lyr.SetFeature(route_segment)
+            route_segment.Destroy()
+            segs_in_batch += 1
+            if use_transactions and segs_in_batch >= write_batch_size:
+                route_segments_lyr.CommitTransaction()
+                route_segments_lyr.StartTransaction()
+                segs_in_batch = 0
+    except:
+        if use_transactions:
+            route_segments_lyr.RollbackTransaction()
+        raise
+    if use_transactions:
+        route_segments_lyr.CommitTransaction()
+    print "...finished assigning speeds to segments."
     route_segments_lyr.ResetReading()
     return
 
 
+##################################################################################
+# Speeds calculated from segment lengths, and a vehicle's acceleration and
+#  dwell time at stops.
+
+# Segment lengths are rounded into buckets of this size (in m), so speeds
+#  calculated can be cached and shared between segments of similar length.
+DEFAULT_SEG_LENGTH_BUCKET_M = 1.0
+
+def get_vehicle_params_from_mode_config(mode_config):
+    """The vehicle params (as in speed_funcs_vehicle_based.
+    VEHICLE_CLASS_PARAMS) for the vehicle given in a mode config."""
+    return {
+        'full_speed': mode_config['maxspeed'],
+        'accel': mode_config['accel'],
+        'stop_dwell_time': mode_config['stop_dwell_time'],
+        }
+
+class VehicleAccelDwellSpeedModel(SpeedModel):
+    """Speeds on each segment are the average speed of a vehicle that stops
+    at each end of it :- accelerating to (at most) its full speed, slowing to
+    stop at the next stop, then waiting there for its dwell time. So the
+    travel time on the segment includes acceleration and deceleration ramps
+    and dwell time. (See speed_funcs_vehicle_based.)
+
+    Speeds are the same at all times of day. They are calculated for all
+    segments of a route at once, and cached for each segment length bucket
+    and vehicle, so are shared between all routes of a run."""
+    def __init__(self, vehicle_params=None,
+            length_bucket_m=DEFAULT_SEG_LENGTH_BUCKET_M):
+        """vehicle_params are as in VEHICLE_CLASS_PARAMS :- if None, the
+        vehicle params of the mode config passed to setup() are used."""
+        self.vehicle_params = vehicle_params
+        self.length_bucket_m = float(length_bucket_m)
+        self._vehicle_key = None
+        self._seg_lengths_m = None
+        # Speeds calculated so far, keyed by (length bucket, vehicle key).
+        self._bucket_speeds = {}
+        if vehicle_params is not None:
+            self._set_vehicle(vehicle_params)
+
+    def _set_vehicle(self, vehicle_params):
+        self.vehicle_params = vehicle_params
+        self._vehicle_key = (float(vehicle_params['full_speed']),
+            float(vehicle_params['accel']),
+            float(vehicle_params['stop_dwell_time']))
+
+    def setup(self, route_defs, segs_layer, stops_layer, mode_config):
+        if self.vehicle_params is None:
+            self._set_vehicle(get_vehicle_params_from_mode_config(mode_config))
+        # Just keep lengths of segments, rather than features, read in one
+        #  pass over the segs_layer.
+        self._seg_lengths_m = {}
+        for seg_feature in segs_layer:
+            seg_id = int(seg_feature.GetField(tp_model.SEG_ID_FIELD))
+            self._seg_lengths_m[seg_id] = tp_model.get_distance_km(
+                seg_feature) * tp_model.ROUTE_DIST_RATIO_TO_KM
+            seg_feature.Destroy()
+        segs_layer.ResetReading()
+        return
+
+    def get_setup_state(self):
+        return {'vehicle_params': dict(self.vehicle_params),
+            'seg_lengths_m': self._seg_lengths_m}
+
+    def set_setup_state(self, setup_state):
+        self._set_vehicle(setup_state['vehicle_params'])
+        self._seg_lengths_m = setup_state['seg_lengths_m']
+        return
+
+    def _get_length_bucket(self, seg_length_m):
+        return int(seg_length_m // self.length_bucket_m)
+
+    def calc_speeds_for_lengths(self, seg_lengths_m):
+        """Returns a list of the speeds (in km/h) on segments of each of the
+        given lengths, calculating those not already cached all at once."""
+        buckets = [self._get_length_bucket(seg_length_m) for seg_length_m \
+            in seg_lengths_m]
+        new_buckets = sorted(set([bucket for bucket in buckets \
+            if (bucket, self._vehicle_key) not in self._bucket_speeds]))
+        if new_buckets:
+            # Speed of each bucket is that at the middle of its range, so is
+            # never for a zero length.
+            bucket_lengths_m = (numpy.array(new_buckets) + 0.5) \
+                * self.length_bucket_m
+            full_speed, accel, stop_dwell_time = self._vehicle_key
+            bucket_speeds = \
+                speed_funcs_vehicle_based.calc_vehicle_speed_bw_stops_array(
+                    bucket_lengths_m, full_speed, accel, stop_dwell_time)
+            for bucket, speed in zip(new_buckets, bucket_speeds):
+                self._bucket_speeds[(bucket, self._vehicle_key)] = float(speed)
+        return [self._bucket_speeds[(bucket, self._vehicle_key)] for bucket \
+            in buckets]
+
+    def get_params_signature(self):
+        return self._vehicle_key, self.length_bucket_m
+
+    def setup_for_route(self, route_def, serv_periods):
+        seg_lengths_m = [self._seg_lengths_m[seg_id] for seg_id \
+            in route_def.ordered_seg_ids if seg_id in self._seg_lengths_m]
+        self.calc_speeds_for_lengths(seg_lengths_m)
+        return True
+
+    def save_extra_seg_speed_info(self, next_segment, serv_period, travel_dir):
+        seg_id = int(next_segment.GetField(tp_model.SEG_ID_FIELD))
+        return self.calc_speeds_for_lengths([self._seg_lengths_m[seg_id]])[0]
+
+    def get_stop_list_signature(self, route_def, serv_period, dir_id):
+        # Speeds only depend on segment lengths.
+        return None
+
+    def get_speed_on_next_segment(self, seg_speed_info, curr_time,
+            peak_status):
+        return seg_speed_info
+
+    def get_speeds_time_band(self, curr_time):
+        return (None, None)
+
 ##################################################################################
 # Segments with multiple speeds in different time periods, in different directions 
 
@@ -194,6 +465,83 @@ def get_time_period_index(time_periods, last_time_period_found_i, curr_time):
             break
     return tp_found_i
 
+def get_time_period_band(time_periods, curr_time):
+    """Returns a tuple of the index of the time period curr_time is in, and
+    the end of that period (None for the last period, since times beyond it
+    also use it).
+    Returns None if curr_time is on a boundary between periods (or in a gap),
+    since which period get_time_period_index() returns there depends on the
+    last period found."""
+    if curr_time > time_periods[-1][0]:
+        return len(time_periods) - 1, None
+    for tp_i, tp in enumerate(time_periods):
+        if curr_time > tp[0] and curr_time < tp[1]:
+            return tp_i, tp[1]
+    return None
+
+class TimePeriodIndex:
+    """An index of a list of time periods, for quickly finding which period
+    a time (in seconds since midnight) is in. Gives the same results as
+    get_time_period_index() and get_time_period_band() on the list, but
+    using a binary search of the period end times (as long as periods are
+    in order, which they normally are), rather than checking each period.
+    Create with get_shared_time_period_index(), so identical lists of time
+    periods (e.g. read from many speeds files) share the same index."""
+    def __init__(self, time_periods):
+        self.time_periods = time_periods
+        self.start_secs = [misc_utils.tdToSecs(tp[0]) for tp in time_periods]
+        self.end_secs = [misc_utils.tdToSecs(tp[1]) for tp in time_periods]
+        self._ends_in_order = self.end_secs == sorted(self.end_secs)
+
+    def __len__(self):
+        return len(self.time_periods)
+
+    def _find_first_ending_after(self, curr_secs):
+        """Returns the index of the first period that ends at or after
+        curr_secs (or len(self), if none)."""
+        if self._ends_in_order:
+            return bisect.bisect_left(self.end_secs, curr_secs)
+        for tp_i, end_secs in enumerate(self.end_secs):
+            if end_secs >= curr_secs and self.start_secs[tp_i] <= curr_secs:
+                return tp_i
+        return len(self.end_secs)
+
+    def get_index(self, last_time_period_found_i, curr_secs):
+        """Equivalent of get_time_period_index()."""
+        if last_time_period_found_i is not None \
+                and last_time_period_found_i < len(self.start_secs) \
+                and curr_secs >= self.start_secs[last_time_period_found_i] \
+                and curr_secs <= self.end_secs[last_time_period_found_i]:
+            return last_time_period_found_i
+        tp_i = self._find_first_ending_after(curr_secs)
+        if tp_i < len(self.start_secs) and curr_secs >= self.start_secs[tp_i]:
+            return tp_i
+        return None
+
+    def get_band(self, curr_secs):
+        """Equivalent of get_time_period_band()."""
+        if curr_secs > self.start_secs[-1]:
+            return len(self.start_secs) - 1, None
+        tp_i = self._find_first_ending_after(curr_secs)
+        if tp_i < len(self.start_secs) \
+                and curr_secs > self.start_secs[tp_i] \
+                and curr_secs < self.end_secs[tp_i]:
+            return tp_i, self.time_periods[tp_i][1]
+        return None
+
+# Time period indices already created, keyed by their periods in seconds.
+_shared_time_period_indices = {}
+
+def get_shared_time_period_index(time_periods):
+    tps_key = tuple([(misc_utils.tdToSecs(tp[0]), misc_utils.tdToSecs(tp[1])) \
+        for tp in time_periods])
+    try:
+        tp_index = _shared_time_period_indices[tps_key]
+    except KeyError:
+        tp_index = TimePeriodIndex(time_periods)
+        _shared_time_period_indices[tps_key] = tp_index
+    return tp_index
+
 def find_valid_speed_nearest_to_period(tp_speeds, tp_i):
     """Find the nearest seg speed to this TP index, that is not -1.
     First try tp_i index, then progressively search 1 spot forward,
@@ -228,6 +576,7 @@ class MultipleTimePeriodsSegSpeedInfo:
 class MultipleTimePeriodsSpeedModel(SpeedModel):
     def __init__(self, time_periods):
         self.time_periods = time_periods
+        self._tp_index = get_shared_time_period_index(time_periods)
         self._last_time_period_found_i = None
 
     def add_extra_needed_speed_fields(self, segments_layer):
@@ -257,6 +606,9 @@ class MultipleTimePeriodsSpeedModel(SpeedModel):
         speed_ext = MultipleTimePeriodSegSpeedInfo(time_period_speeds)
         return speed_ext
 
+    def get_stop_list_signature(self, route_def, serv_period, dir_id):
+        return None
+
     def setup_for_trip_set(self, route_def, serv_period, dir_id):
         self._last_time_period_found_i = None
         return True
@@ -264,19 +616,23 @@ class MultipleTimePeriodsSpeedModel(SpeedModel):
     def get_speed_on_next_segment(self, seg_speed_info, curr_time,
             peak_status):
         tp_speeds = seg_speed_info.time_period_speeds
-        tp_i = get_time_period_index(self.time_periods, 
-            self._last_time_period_found_i, curr_time)
+        curr_secs = misc_utils.tdToSecs(curr_time)
+        tp_i = self._tp_index.get_index(self._last_time_period_found_i,
+            curr_secs)
         if tp_i is None:
             # If curr_time is beyond end of all time periods, its possibly
             # that this is a trip that started in last TP but continues beyond
             # it, which is OK.
-            if curr_time > self.time_periods[-1][1]:
+            if curr_secs > self._tp_index.end_secs[-1]:
                 tp_i = len(self.time_periods) - 1
         assert tp_i is not None
         self._last_time_period_found_i = tp_i
         seg_speed = find_valid_speed_nearest_to_period(tp_speeds, tp_i)
         return seg_speed
 
+    def get_speeds_time_band(self, curr_time):
+        return self._tp_index.get_band(misc_utils.tdToSecs(curr_time))
+
 
 ##############################################################################
 # Segments with multiple speeds in different time periods, in different
@@ -285,20 +641,67 @@ class MultipleTimePeriodsSpeedModel(SpeedModel):
 class MultipleTimePeriodsPerRouteSegSpeedInfo:
     """A small struct to store needed extra per-stop speed info read in
     from shapefiles - to be added to a Seq_Stop_Info."""
-    def __init__(self, time_periods, time_period_speeds):
+    def __init__(self, tp_index, time_period_speeds):
         # We only need to worry about one direction, serv period at a time.
-        self.time_periods = time_periods
+        self.tp_index = tp_index
         self.time_period_speeds = time_period_speeds
 
+def fill_speeds_with_nearest_valid(tp_speeds, n_tps):
+    """Returns an array of the speed to use in each of n_tps time periods,
+    given speeds read in for each (with -1 where there was no valid speed),
+    using find_valid_speed_nearest_to_period() to fill the gaps."""
+    filled_speeds = numpy.empty(n_tps)
+    for tp_i in range(n_tps):
+        filled_speeds[tp_i] = find_valid_speed_nearest_to_period(tp_speeds,
+            tp_i)
+    return filled_speeds
+
+class RouteSpeedMatrices:
+    """The speeds on each segment of a route (in route order) in each time
+    period, for one direction and service period, with gaps already filled
+    by the nearest valid speed. Stored as a segments x time periods array
+    per time period index, since segments whose speeds had to be read from
+    another direction or service period can use different time periods.
+    (Rows of segments using another time period index are NaN.)"""
+    def __init__(self, n_segs):
+        self.speed_matrices = {}
+        self.seg_tp_indices = [None] * n_segs
+
+    def set_seg_speeds(self, seg_ii, tp_index, tp_speeds):
+        try:
+            speed_matrix = self.speed_matrices[tp_index]
+        except KeyError:
+            speed_matrix = numpy.empty((len(self.seg_tp_indices),
+                len(tp_index)))
+            speed_matrix.fill(numpy.nan)
+            self.speed_matrices[tp_index] = speed_matrix
+        speed_matrix[seg_ii] = fill_speeds_with_nearest_valid(tp_speeds,
+            len(tp_index))
+        self.seg_tp_indices[seg_ii] = tp_index
+
+    def get_seg_speeds(self, seg_ii):
+        """Returns a tuple of the time period index used by the segment, and
+        the (filled) speeds on it in each period. Both are None if no speeds
+        were found for the segment."""
+        tp_index = self.seg_tp_indices[seg_ii]
+        if tp_index is None:
+            return None, None
+        return tp_index, self.speed_matrices[tp_index][seg_ii]
+
 class MultipleTimePeriodsPerRouteSpeedModel(MultipleTimePeriodsSpeedModel):
     def __init__(self, avg_speeds_dir):
         self.input_avg_speeds_dir = avg_speeds_dir
         self._last_time_period_found_i = None
-        self._curr_time_periods = None
+        self._curr_tp_indices = None
         self._curr_route_def = None
         self._curr_route_seg_speeds = None
+        self._curr_route_speed_matrices = None
+        self._curr_route_seg_positions = None
+        self._curr_route_dir_indices = None
+        self._curr_route_seg_gtfs_stop_pairs = None
         self._stop_id_to_gtfs_stop_id_map = None
-        self._segs_lookup_table = None
+        self._seg_stop_ids = None
+        self._curr_trip_set_tp_indices = []
 
     def add_extra_needed_speed_fields(self, segments_layer):
         # override to do nothing :- we don't store anything on segs lyr,
@@ -308,18 +711,66 @@ class MultipleTimePeriodsPerRouteSpeedModel(MultipleTimePeriodsSpeedModel):
     def setup(self, route_defs, segs_layer, stops_layer, mode_config):
         self._stop_id_to_gtfs_stop_id_map = \
             tp_model.build_stop_id_to_gtfs_stop_id_map(stops_layer)
-        # NOTE: This is not ideal to have to keep this open. Implies the
-        #  segs_layer isn't altered/closed while the seg_speed_model is working.
-        self._segs_lookup_table = tp_model.build_segs_lookup_table(segs_layer)
+        # Just keep the stop IDs of each segment, rather than features, so
+        #  the segs_layer doesn't need to stay open.
+        self._seg_stop_ids = {}
+        for seg_feature in segs_layer:
+            seg_id = int(seg_feature.GetField(tp_model.SEG_ID_FIELD))
+            self._seg_stop_ids[seg_id] = \
+                tp_model.get_stop_ids_of_seg(seg_feature)
+        segs_layer.ResetReading()
         return
 
+    def get_setup_state(self):
+        return {'stop_id_to_gtfs_stop_id_map': \
+                self._stop_id_to_gtfs_stop_id_map,
+            'seg_stop_ids': self._seg_stop_ids}
+
+    def set_setup_state(self, setup_state):
+        self._stop_id_to_gtfs_stop_id_map = \
+            setup_state['stop_id_to_gtfs_stop_id_map']
+        self._seg_stop_ids = setup_state['seg_stop_ids']
+        return
+
+    def get_route_input_signature(self, route_def):
+        # Speeds are looked up in the speeds files by the GTFS IDs of the
+        #  stops of each segment.
+        route_gtfs_stop_ids = []
+        for seg_id in route_def.ordered_seg_ids:
+            for stop_id in self._seg_stop_ids.get(seg_id, ()):
+                route_gtfs_stop_ids.append(
+                    self._stop_id_to_gtfs_stop_id_map.get(stop_id))
+        return route_gtfs_stop_ids
+
+    def _create_ordered_seg_refs(self, ordered_seg_ids):
+        ordered_seg_refs = []
+        for seg_id in ordered_seg_ids:
+            stop_id_a, stop_id_b = self._seg_stop_ids[seg_id]
+            ordered_seg_refs.append(
+                route_segs.Seg_Reference(seg_id, stop_id_a, stop_id_b))
+        return ordered_seg_refs
+
     def setup_for_route(self, route_def, serv_periods):
         success_flag = True
         self._curr_route_def = route_def
-        self._curr_route_seg_refs = route_segs.create_ordered_seg_refs_from_ids(
-            route_def.ordered_seg_ids, self._segs_lookup_table)
+        self._curr_route_seg_refs = self._create_ordered_seg_refs(
+            route_def.ordered_seg_ids)
+        # Position of each segment in the route (its first, if repeated).
+        self._curr_route_seg_positions = {}
+        for seg_ii, seg_id in enumerate(route_def.ordered_seg_ids):
+            self._curr_route_seg_positions.setdefault(seg_id, seg_ii)
+        self._curr_route_dir_indices = {}
+        for dir_i, dir_name in enumerate(route_def.dir_names):
+            self._curr_route_dir_indices.setdefault(dir_name, dir_i)
+        # GTFS IDs of each segment's stops, in order of travel in each
+        # direction.
+        self._curr_route_seg_gtfs_stop_pairs = []
+        for dir_i in range(len(route_def.dir_names)):
+            self._curr_route_seg_gtfs_stop_pairs.append(
+                [self._calc_seg_gtfs_stop_pair(seg_ii, dir_i) for seg_ii \
+                    in range(len(self._curr_route_seg_refs))])
         self._curr_route_seg_speeds = {}
-        self._curr_time_periods = {}
+        self._curr_tp_indices = {}
         at_least_one_dir_opened = False
         for serv_period, trips_dir in \
                 itertools.product(serv_periods, route_def.dir_names):
@@ -341,13 +792,60 @@ class MultipleTimePeriodsPerRouteSpeedModel(MultipleTimePeriodsSpeedModel):
                 at_least_one_dir_opened = True
                 self._curr_route_seg_speeds[(trips_dir, serv_period)] = \
                     route_avg_speeds        
-                self._curr_time_periods[(trips_dir, serv_period)] = time_periods
+                self._curr_tp_indices[(trips_dir, serv_period)] = \
+                    get_shared_time_period_index(time_periods)
         if not at_least_one_dir_opened:
             success_flag = False
+            return success_flag
+        self._curr_route_speed_matrices = {}
+        for serv_period, trips_dir in \
+                itertools.product(serv_periods, route_def.dir_names):
+            self._curr_route_speed_matrices[(trips_dir, serv_period)] = \
+                self._build_route_speed_matrices((trips_dir, serv_period))
         return success_flag
 
+    def _build_route_speed_matrices(self, dir_period_pair):
+        travel_dir = self._curr_route_dir_indices[dir_period_pair[0]]
+        route_speed_matrices = RouteSpeedMatrices(
+            len(self._curr_route_seg_refs))
+        for seg_ii in range(len(self._curr_route_seg_refs)):
+            gtfs_stop_pair = self._get_seg_gtfs_stop_pair(seg_ii, travel_dir)
+            tp_speeds, tp_index = self._get_speeds_on_seg_in_period(
+                dir_period_pair, gtfs_stop_pair, seg_ii)
+            if tp_speeds and tp_index:
+                route_speed_matrices.set_seg_speeds(seg_ii, tp_index,
+                    tp_speeds)
+        return route_speed_matrices
+
+    def _calc_seg_gtfs_stop_pair(self, seg_ii, travel_dir):
+        stop_ids_ordered = route_segs.get_stop_ids_in_travel_dir(
+            self._curr_route_seg_refs, seg_ii, travel_dir)
+        gtfs_stop_pair = tp_model.get_gtfs_stop_ids(stop_ids_ordered,
+            self._stop_id_to_gtfs_stop_id_map, to_str=True)
+        return gtfs_stop_pair
+
+    def _get_seg_gtfs_stop_pair(self, seg_ii, travel_dir):
+        return self._curr_route_seg_gtfs_stop_pairs[travel_dir][seg_ii]
+
+    def get_route_speed_matrices(self, serv_period, travel_dir):
+        """Returns the RouteSpeedMatrices of the current route, for given
+        service period and direction (index)."""
+        dir_name = self._curr_route_def.dir_names[travel_dir]
+        return self._curr_route_speed_matrices[(dir_name, serv_period)]
+
+    def get_route_input_fnames(self, route_def, serv_periods):
+        fnames = []
+        for serv_period, trips_dir in \
+                itertools.product(serv_periods, route_def.dir_names):
+            fname = tps_speeds_model.get_route_avg_speeds_for_dir_period_fname(
+                route_def.short_name, route_def.long_name, serv_period,
+                trips_dir)
+            fnames.append(os.path.join(self.input_avg_speeds_dir, fname))
+        return fnames
+
     def setup_for_trip_set(self, route_def, serv_period, dir_id):
         self._last_time_period_found_i = None
+        self._curr_trip_set_tp_indices = []
         self._curr_serv_period = serv_period
         self._curr_dir_name = route_def.dir_names[dir_id]
         dir_name = route_def.dir_names[dir_id]
@@ -361,17 +859,12 @@ class MultipleTimePeriodsPerRouteSpeedModel(MultipleTimePeriodsSpeedModel):
         # We will look up relevant data for current serv period and direction,
         #  and save.
         seg_ref = route_segs.seg_ref_from_feature(next_segment)
-        seg_ii = self._curr_route_def.ordered_seg_ids.index(seg_ref.seg_id)
-        stop_ids_ordered = route_segs.get_stop_ids_in_travel_dir(
-            self._curr_route_seg_refs, seg_ii, travel_dir)
-        gtfs_stop_pair = tp_model.get_gtfs_stop_ids(stop_ids_ordered,
-            self._stop_id_to_gtfs_stop_id_map, to_str=True)
-        dir_name = self._curr_route_def.dir_names[travel_dir]
-  
-        tp_speeds, tps = self._get_speeds_on_seg_in_period(
-            (dir_name, serv_period), gtfs_stop_pair, seg_ii)
+        seg_ii = self._curr_route_seg_positions[seg_ref.seg_id]
+        tp_index, tp_speeds = self.get_route_speed_matrices(serv_period,
+            travel_dir).get_seg_speeds(seg_ii)
 
-        if not (tp_speeds and tps):
+        if tp_index is None:
+            gtfs_stop_pair = self._get_seg_gtfs_stop_pair(seg_ii, travel_dir)
             print "While curr_route is id %s, name %s:- "\
                 "Error for segment %s: can't find a matching set of "\
                 "avg speeds for this segment in any allowed service period. "\
@@ -379,41 +872,83 @@ class MultipleTimePeriodsPerRouteSpeedModel(MultipleTimePeriodsSpeedModel):
                 % (self._curr_route_def.id, \
                    route_segs.get_print_name(self._curr_route_def), \
                    seg_ref.seg_id, gtfs_stop_pair[0], gtfs_stop_pair[1])
-            assert tp_speeds and tps
-        speed_ext = MultipleTimePeriodsPerRouteSegSpeedInfo(tps, tp_speeds)
+            assert tp_index is not None
+        # Segments can use time periods read from different files. Need to
+        # know each set used by this trip set, in get_speeds_time_band().
+        if not [True for tp_index_b in self._curr_trip_set_tp_indices \
+                if tp_index_b is tp_index]:
+            self._curr_trip_set_tp_indices.append(tp_index)
+        speed_ext = MultipleTimePeriodsPerRouteSegSpeedInfo(tp_index,
+            tp_speeds)
         return speed_ext
 
+    def get_stop_list_signature(self, route_def, serv_period, dir_id):
+        dir_name = route_def.dir_names[dir_id]
+        if (dir_name, serv_period) in self._curr_route_seg_speeds:
+            return serv_period
+        else:
+            # All segments will fall back to speeds of other dir-period
+            # pairs, which is the same for all periods without their own.
+            return None
+
+    def reuse_extra_seg_speed_infos(self, seg_speed_infos):
+        for speed_ext in seg_speed_infos:
+            if speed_ext is None:
+                # E.g. the final stop.
+                continue
+            tp_index = speed_ext.tp_index
+            if not [True for tp_index_b in self._curr_trip_set_tp_indices \
+                    if tp_index_b is tp_index]:
+                self._curr_trip_set_tp_indices.append(tp_index)
+        return
+
     def get_speed_on_next_segment(self, seg_speed_info, curr_time,
             peak_status):
         dir_period_pair = (self._curr_dir_name, self._curr_serv_period)
         # Now need to read this off the seg speed info, since if that segment
         # doesn't exist in the 'main' time period, we could be reading a
         # version that used different TPs.
-        tps = seg_speed_info.time_periods
-        assert tps
-        tp_i = get_time_period_index(tps, self._last_time_period_found_i,
-            curr_time)
+        tp_index = seg_speed_info.tp_index
+        assert tp_index
+        curr_secs = misc_utils.tdToSecs(curr_time)
+        tp_i = tp_index.get_index(self._last_time_period_found_i, curr_secs)
         if tp_i is None:
             # If curr_time is beyond end of all time periods, its possibly
             # that this is a trip that started in last TP but continues beyond
             # it, which is OK.
-            if curr_time > tps[-1][1]:
-                tp_i = len(tps) - 1
+            if curr_secs > tp_index.end_secs[-1]:
+                tp_i = len(tp_index) - 1
         assert tp_i is not None
         self._last_time_period_found_i = tp_i
-        tp_speeds = seg_speed_info.time_period_speeds
-        seg_speed = find_valid_speed_nearest_to_period(tp_speeds, tp_i)
+        # Gaps were already filled with the nearest valid speed.
+        seg_speed = seg_speed_info.time_period_speeds[tp_i]
         return seg_speed
 
+    def get_speeds_time_band(self, curr_time):
+        if not self._curr_trip_set_tp_indices:
+            return None
+        curr_secs = misc_utils.tdToSecs(curr_time)
+        band_key = []
+        band_end = None
+        for tp_index in self._curr_trip_set_tp_indices:
+            tp_band = tp_index.get_band(curr_secs)
+            if tp_band is None:
+                return None
+            band_key.append(tp_band[0])
+            if tp_band[1] is not None:
+                if band_end is None or tp_band[1] < band_end:
+                    band_end = tp_band[1]
+        return tuple(band_key), band_end
+
     def _get_speeds_on_seg_in_period(self, dir_period_pair, seg_gtfs_stop_ids,
             seg_ii, allow_rev_order_fallback=True,
             allow_other_dpp_fallback=True):
-        tps = None
+        tp_index = None
         tp_speeds = None
 
         speeds_in_dpp_found = False
         try:
-            tps = self._curr_time_periods[dir_period_pair]
+            tp_index = self._curr_tp_indices[dir_period_pair]
             sp_dir_speeds = self._curr_route_seg_speeds[dir_period_pair]
         except KeyError:
             speeds_in_dpp_found = False
@@ -437,15 +972,13 @@ class MultipleTimePeriodsPerRouteSpeedModel(MultipleTimePeriodsSpeedModel):
             # Fall-back to searching all the other days and directions.
             for dir_period_pair_b, sp_dir_speeds \
                     in self._curr_route_seg_speeds.iteritems():
-                # Need to recalc seg_gtfs_stop_ids to be in order
+                # Need seg_gtfs_stop_ids to be in order
                 # of dir_period_pair
                 curr_dir_name = dir_period_pair_b[0]
-                curr_dir_i = self._curr_route_def.dir_names.index(curr_dir_name)
-                curr_stop_ids = route_segs.get_stop_ids_in_travel_dir(
-                    self._curr_route_seg_refs, seg_ii, curr_dir_i)
-                curr_gtfs_stop_ids = tp_model.get_gtfs_stop_ids(curr_stop_ids,
-                    self._stop_id_to_gtfs_stop_id_map, to_str=True)
-                tps = self._curr_time_periods[dir_period_pair_b]
+                curr_dir_i = self._curr_route_dir_indices[curr_dir_name]
+                curr_gtfs_stop_ids = self._get_seg_gtfs_stop_pair(seg_ii,
+                    curr_dir_i)
+                tp_index = self._curr_tp_indices[dir_period_pair_b]
                 try:
                     tp_speeds = sp_dir_speeds[curr_gtfs_stop_ids]
                 except KeyError:
@@ -463,7 +996,180 @@ class MultipleTimePeriodsPerRouteSpeedModel(MultipleTimePeriodsSpeedModel):
                     # We've got a workable speed set to use.
                     break
 
-        return tp_speeds, tps
+        return tp_speeds, tp_index
+
+##############################################################################
+# As above, but speeds change smoothly over the day :- linearly interpolated
+# between the middle of each time period, rather than stepping at period
+# boundaries.
+
+class SpeedProfileTimeIndex:
+    """The times (in secs since midnight) of the middle of each of a set of
+    time periods, in time order, with a lookup table of which piece of a
+    piecewise-linear profile through them (i.e. which pair of middles) each
+    minute of the day starts in. So the piece a time is in can be found in
+    constant time.
+    Raises ValueError if two periods have the same middle (e.g. a period
+    repeated in a speeds file), since there's no slope between them.
+    Create with get_shared_speed_profile_time_index()."""
+    def __init__(self, tp_index):
+        mid_secs = numpy.array([(start_secs + end_secs) / 2.0 for \
+            start_secs, end_secs in zip(tp_index.start_secs,
+                tp_index.end_secs)])
+        # Order to put the periods' speeds in, to match mid_secs.
+        self.order = numpy.argsort(mid_secs, kind='mergesort')
+        self.mid_secs = mid_secs[self.order]
+        same_mid_is = numpy.flatnonzero(numpy.diff(self.mid_secs) == 0)
+        if len(same_mid_is):
+            tp_names = misc_utils.get_time_period_name_strings(
+                tp_index.time_periods)
+            sorted_i = same_mid_is[0]
+            raise ValueError("Time periods %s and %s have the same middle, "\
+                "so speeds can't be interpolated between them (is a period "\
+                "repeated?)." % (tp_names[self.order[sorted_i]],
+                    tp_names[self.order[sorted_i+1]]))
+        n_minutes = int(self.mid_secs[-1] // 60) + 1
+        minute_start_secs = numpy.arange(n_minutes) * 60.0
+        self._minute_pieces = (numpy.searchsorted(self.mid_secs,
+            minute_start_secs, side='right') - 1).tolist()
+        self._mid_secs_list = self.mid_secs.tolist()
+
+    def __len__(self):
+        return len(self._mid_secs_list)
+
+    def get_piece(self, curr_secs):
+        """Returns the index of the last period middle at or before
+        curr_secs :- -1 if before the first one."""
+        mid_secs = self._mid_secs_list
+        if curr_secs >= mid_secs[-1]:
+            return len(mid_secs) - 1
+        if curr_secs < mid_secs[0]:
+            return -1
+        piece_i = self._minute_pieces[int(curr_secs // 60)]
+        # There can be more than one period middle in a minute.
+        while curr_secs >= mid_secs[piece_i+1]:
+            piece_i += 1
+        return piece_i
+
+# Speed profile time indices already created, keyed by time period index.
+_shared_speed_profile_time_indices = {}
+
+def get_shared_speed_profile_time_index(tp_index):
+    try:
+        profile_index = _shared_speed_profile_time_indices[tp_index]
+    except KeyError:
+        profile_index = SpeedProfileTimeIndex(tp_index)
+        _shared_speed_profile_time_indices[tp_index] = profile_index
+    return profile_index
+
+class Route_Speed_Profiles:
+    """A small struct of the piecewise-linear speed profiles of all segments
+    of a route (for one direction and service period) using one time period
+    index :- arrays of segments x period middles of the speeds at each
+    middle, and of segments x pieces of the slope and intercept (in km/h per
+    second, and km/h at midnight) of the line between consecutive middles."""
+    def __init__(self, profile_index, speed_matrix):
+        self.profile_index = profile_index
+        self.speeds = speed_matrix[:, profile_index.order]
+        mid_secs = profile_index.mid_secs
+        self.slopes = numpy.diff(self.speeds, axis=1) / numpy.diff(mid_secs)
+        self.intercepts = self.speeds[:, :-1] - self.slopes * mid_secs[:-1]
+
+class InterpolatedSegSpeedInfo:
+    """A small struct to store the speed profile of a segment (as lists, for
+    fast evaluation one time at a time), to be added to a Seq_Stop_Info."""
+    def __init__(self, tp_index, profile_index, speeds, slopes, intercepts):
+        self.tp_index = tp_index
+        self.profile_index = profile_index
+        self.speeds = speeds
+        self.slopes = slopes
+        self.intercepts = intercepts
+
+def calc_interpolated_speed(seg_speed_info, curr_secs):
+    piece_i = seg_speed_info.profile_index.get_piece(curr_secs)
+    if piece_i < 0:
+        return seg_speed_info.speeds[0]
+    if piece_i >= len(seg_speed_info.slopes):
+        return seg_speed_info.speeds[-1]
+    return seg_speed_info.slopes[piece_i] * curr_secs \
+        + seg_speed_info.intercepts[piece_i]
+
+class InterpolatedTimePeriodsPerRouteSpeedModel(
+        MultipleTimePeriodsPerRouteSpeedModel):
+    """Reads per-route speeds in each time period, as
+    MultipleTimePeriodsPerRouteSpeedModel, but treats the speed of each
+    period as that at the middle of it, interpolating linearly between
+    them (and keeping the first and last speeds constant before and after
+    the first and last middles). Avoids speeds, and so trip travel times,
+    jumping at period boundaries."""
+    def __init__(self, avg_speeds_dir):
+        MultipleTimePeriodsPerRouteSpeedModel.__init__(self, avg_speeds_dir)
+        self._curr_route_speed_profiles = None
+
+    def setup_for_route(self, route_def, serv_periods):
+        success_flag = MultipleTimePeriodsPerRouteSpeedModel.setup_for_route(
+            self, route_def, serv_periods)
+        if not success_flag:
+            return success_flag
+        self._curr_route_speed_profiles = {}
+        for dir_period_pair, route_speed_matrices in \
+                self._curr_route_speed_matrices.iteritems():
+            speed_profiles = {}
+            for tp_index, speed_matrix in \
+                    route_speed_matrices.speed_matrices.iteritems():
+                speed_profiles[tp_index] = Route_Speed_Profiles(
+                    get_shared_speed_profile_time_index(tp_index),
+                    speed_matrix)
+            self._curr_route_speed_profiles[dir_period_pair] = speed_profiles
+        return success_flag
+
+    def save_extra_seg_speed_info(self, next_segment, serv_period, travel_dir):
+        period_speed_ext = \
+            MultipleTimePeriodsPerRouteSpeedModel.save_extra_seg_speed_info(
+                self, next_segment, serv_period, travel_dir)
+        tp_index = period_speed_ext.tp_index
+        seg_ref = route_segs.seg_ref_from_feature(next_segment)
+        seg_ii = self._curr_route_seg_positions[seg_ref.seg_id]
+        dir_name = self._curr_route_def.dir_names[travel_dir]
+        speed_profiles = \
+            self._curr_route_speed_profiles[(dir_name, serv_period)][tp_index]
+        speed_ext = InterpolatedSegSpeedInfo(tp_index,
+            speed_profiles.profile_index,
+            speed_profiles.speeds[seg_ii].tolist(),
+            speed_profiles.slopes[seg_ii].tolist(),
+            speed_profiles.intercepts[seg_ii].tolist())
+        return speed_ext
+
+    def get_speed_on_next_segment(self, seg_speed_info, curr_time,
+            peak_status):
+        return calc_interpolated_speed(seg_speed_info,
+            misc_utils.tdToSecs(curr_time))
+
+    def get_speeds_time_band(self, curr_time):
+        # Speeds change continuously.
+        return None
+
+    def calc_trip_stop_offsets(self, seq_stop_infos, trip_start_secs):
+        # Speeds don't depend on peak status, so the whole trip can be
+        # calculated here in one go.
+        stop_offsets = [0] * len(seq_stop_infos)
+        cumulative_time_on_trip = 0
+        for stop_seq in range(len(seq_stop_infos)-1):
+            stop_offsets[stop_seq] = cumulative_time_on_trip
+            s_info = seq_stop_infos[stop_seq]
+            if s_info.dist_km_to_next < (1 / 1000.0):
+                # As in Seq_Stop_Info.calc_time_on_next_segment().
+                time_inc = 1
+            else:
+                seg_speed = calc_interpolated_speed(s_info.extra_speed_info,
+                    trip_start_secs + cumulative_time_on_trip)
+                assert seg_speed > 0
+                time_inc = int(round(
+                    s_info.dist_km_to_next / float(seg_speed) * 3600))
+            cumulative_time_on_trip += time_inc
+        if seq_stop_infos:
+            stop_offsets[-1] = cumulative_time_on_trip
+        return stop_offsets
 
 ##################################################
 
@@ -555,7 +1261,148 @@ def calc_speed_based_on_segment_length(route_segment, time_period, mode_config):
     stop_dwell_time_s = mode_config['stop_dwell_time']
     spd = speed_funcs_vehicle_based.calc_vehicle_speed_bw_stops(seg_dist_m,
         max_spd_km_h, accel_m_s2, stop_dwell_time_s)
-    return spd    
+    return spd
+
+##################################################################################
+# Array versions of the speed functions above :- computing the speeds of all
+#  segments of a layer at once, from columns of segment properties read in
+#  one pass over the layer.
+
+class Seg_Speed_Columns:
+    """A small struct of numpy arrays of the properties of all segments of
+    a layer that speed functions use, in the layer's feature order.
+    Columns of fields the layer doesn't have are None."""
+    def __init__(self, fids, seg_lengths, on_motorway, route_counts,
+            cbd_dists_km):
+        self.fids = fids
+        self.seg_lengths = seg_lengths
+        self.on_motorway = on_motorway
+        self.route_counts = route_counts
+        self.cbd_dists_km = cbd_dists_km
+
+    def __len__(self):
+        return len(self.fids)
+
+def get_melb_origin_in_comparison_srs():
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromEPSG(route_geom_ops.COMPARISON_EPSG)
+    origin_srs = osr.SpatialReference()
+    origin_srs.ImportFromEPSG(4326)
+    transform_origin = osr.CoordinateTransformation(origin_srs, target_srs)
+    origin_coords = speed_funcs_location_based.MELB_ORIGIN_LAT_LON
+    # Func takes lon,lat
+    return transform_origin.TransformPoint(origin_coords[1],
+        origin_coords[0])[:2]
+
+def read_seg_speed_columns(route_segments_lyr, with_cbd_dists=True):
+    """Reads a Seg_Speed_Columns of all segments in route_segments_lyr.
+    Distances from the CBD (as calc_peak_speed_melb_bus() uses) are only
+    calculated if with_cbd_dists is True, since they need each segment's
+    geometry."""
+    lyr_defn = route_segments_lyr.GetLayerDefn()
+    length_i = lyr_defn.GetFieldIndex(tp_model.SEG_ROUTE_DIST_FIELD)
+    mway_i = lyr_defn.GetFieldIndex(tp_model.ON_MOTORWAY_FIELD)
+    route_list_i = lyr_defn.GetFieldIndex(tp_model.SEG_ROUTE_LIST_FIELD)
+    fids = []
+    seg_lengths = []
+    on_motorway = []
+    route_counts = []
+    midpoints = []
+    route_segments_lyr.ResetReading()
+    for route_segment in route_segments_lyr:
+        fids.append(route_segment.GetFID())
+        if length_i >= 0:
+            seg_lengths.append(route_segment.GetField(length_i))
+        if mway_i >= 0:
+            on_motorway.append(route_segment.GetField(mway_i) == 1)
+        if route_list_i >= 0:
+            route_list = route_segment.GetField(route_list_i)
+            route_counts.append(len(route_list.split(',')) if route_list \
+                else 0)
+        if with_cbd_dists:
+            seg_geom = route_segment.GetGeometryRef()
+            # See calc_peak_speed_melb_bus() re zero length segments.
+            if seg_geom.GetPoint(0) == seg_geom.GetPoint(1):
+                midpoints.append(seg_geom.GetPoint(0)[:2])
+            else:
+                midpoints.append(seg_geom.Centroid().GetPoint(0)[:2])
+        route_segment.Destroy()
+    route_segments_lyr.ResetReading()
+
+    cbd_dists_km = None
+    if with_cbd_dists:
+        target_srs = osr.SpatialReference()
+        target_srs.ImportFromEPSG(route_geom_ops.COMPARISON_EPSG)
+        transform_seg = osr.CoordinateTransformation(
+            route_segments_lyr.GetSpatialRef(), target_srs)
+        if midpoints:
+            midpoints_tr = numpy.array(
+                transform_seg.TransformPoints(midpoints))[:, :2]
+        else:
+            midpoints_tr = numpy.empty((0, 2))
+        origin = get_melb_origin_in_comparison_srs()
+        cbd_dists_km = numpy.hypot(midpoints_tr[:, 0] - origin[0],
+            midpoints_tr[:, 1] - origin[1]) / 1000.0
+
+    seg_columns = Seg_Speed_Columns(
+        numpy.array(fids, dtype=int),
+        numpy.array(seg_lengths, dtype=float) if length_i >= 0 else None,
+        numpy.array(on_motorway, dtype=bool) if mway_i >= 0 else None,
+        numpy.array(route_counts, dtype=int) if route_list_i >= 0 else None,
+        cbd_dists_km)
+    return seg_columns
+
+def get_on_motorway_column(seg_columns):
+    if seg_columns.on_motorway is None:
+        raise ValueError("Segments layer is missing field '%s'." \
+            % tp_model.ON_MOTORWAY_FIELD)
+    return seg_columns.on_motorway
+
+def get_seg_lengths_column(seg_columns):
+    if seg_columns.seg_lengths is None:
+        raise ValueError("Segments layer is missing field '%s'." \
+            % tp_model.SEG_ROUTE_DIST_FIELD)
+    return seg_columns.seg_lengths
+
+def get_bus_mode_configs(mode_config):
+    """Returns a tuple of the mode configs to use for buses on-street, and
+    on motorways."""
+    if 'on_motorway' in mode_config:
+        return mode_config, mode_config['on_motorway']
+    else:
+        return mode_config['on_street'], mode_config
+
+def constant_speed_max_array(seg_columns, mode_config):
+    return numpy.repeat(float(mode_config['avespeed']), len(seg_columns))
+
+def constant_speed_max_peak_array(seg_columns, mode_config):
+    return numpy.repeat(float(mode_config['avespeed-peak']), len(seg_columns))
+
+def ratio_max_speed_array(seg_columns, mode_config):
+    return numpy.repeat(mode_config['avespeed'] * PEAK_RATIO,
+        len(seg_columns))
+
+def constant_speed_offpeak_mway_check_array(seg_columns, mode_config):
+    mode_config_bus, mode_config_bus_mway = get_bus_mode_configs(mode_config)
+    return numpy.where(get_on_motorway_column(seg_columns),
+        constant_speed_max_array(seg_columns, mode_config_bus_mway),
+        constant_speed_max_array(seg_columns, mode_config_bus))
+
+def buses_peak_with_mway_check_array(seg_columns, mode_config):
+    mode_config_bus, mode_config_bus_mway = get_bus_mode_configs(mode_config)
+    return numpy.where(get_on_motorway_column(seg_columns),
+        constant_speed_max_peak_array(seg_columns, mode_config_bus_mway),
+        calc_peak_speed_melb_bus_array(seg_columns, mode_config_bus))
+
+def calc_peak_speed_melb_bus_array(seg_columns, mode_config):
+    assert mode_config['system'] == 'Bus'
+    return speed_funcs_location_based.peak_speed_func_array(
+        seg_columns.cbd_dists_km)
+
+def calc_speed_based_on_segment_length_array(seg_columns, mode_config):
+    return speed_funcs_vehicle_based.calc_vehicle_speed_bw_stops_array(
+        get_seg_lengths_column(seg_columns), mode_config['maxspeed'],
+        mode_config['accel'], mode_config['stop_dwell_time'])
 
 # TODO:- name functions individually in the register?
 #  Then will allow user from the cmd-line to name these, and 
@@ -575,3 +1422,28 @@ SPEED_FUNC_SETS_REGISTER = {
 SPEED_FUNCS_REGISTER = {
     "segment_length_dependent": calc_speed_based_on_segment_length,
     }
+
+# Array version of each per-segment speed function that has one.
+ARRAY_SPEED_FUNCS = {
+    constant_speed_max: constant_speed_max_array,
+    constant_speed_max_peak: constant_speed_max_peak_array,
+    ratio_max_speed: ratio_max_speed_array,
+    constant_speed_offpeak_mway_check: \
+        constant_speed_offpeak_mway_check_array,
+    buses_peak_with_mway_check: buses_peak_with_mway_check_array,
+    calc_peak_speed_melb_bus: calc_peak_speed_melb_bus_array,
+    calc_speed_based_on_segment_length: \
+        calc_speed_based_on_segment_length_array,
+    }
+
+# Array speed functions that need segment distances from the CBD.
+ARRAY_SPEED_FUNCS_USING_CBD_DISTS = set([
+    buses_peak_with_mway_check_array,
+    calc_peak_speed_melb_bus_array,
+    ])
+
+def calc_seg_speeds_arrays(seg_columns, mode_config, array_speed_funcs):
+    """Returns a list of the array of speeds of all segments, given by each
+    of array_speed_funcs."""
+    return [speed_func(seg_columns, mode_config) for speed_func \
+        in array_speed_funcs]
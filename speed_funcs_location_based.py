@@ -1,3 +1,5 @@
+import numpy
+
 
 # Lat, long of Melbourne's origin in EPSG:4326 (WGS 84 on WGS 84 datum)
 # Cnr of Bourke & Swanston
@@ -16,4 +18,10 @@ def peak_speed_func(Z_km):
         + 5.0/(Z_km/50.0+1)
     return peak_speed
 
-
+def peak_speed_func_array(Z_km):
+    """Array version of peak_speed_func(), for a numpy array of distances
+    from the city centre."""
+    Z_km = numpy.minimum(Z_km, 50)
+    peak_speed = (230 + 15 * Z_km - 0.13 * Z_km**2) * 60/1000.0 * (2/3.0) \
+        + 5.0/(Z_km/50.0+1)
+    return peak_speed
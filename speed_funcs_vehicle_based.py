@@ -1,5 +1,40 @@
 #!/usr/bin/env python
 
+import numpy
+
+# These values are set based on examples from HiTrans book:
+# Nielsen, G., Nelson, J., Mulley, C., Tegner, G., Lind, G., & Lange, T. 2005,
+# Public transport - Planning the networks. HiTrans Best practice guide No. 2., ,  . 
+# p126-127.
+
+VEHICLE_CLASS_PARAMS = {
+    'slow_bus': {
+        'full_speed': 40,
+        'accel': 1.0,
+        'stop_dwell_time': 20.0,
+        },
+    'tram': {
+        'full_speed': 80,
+        'accel': 1.0,
+        'stop_dwell_time': 20.0,
+        },
+    'fast_tram': {
+        'full_speed': 80,
+        'accel': 1.2,
+        'stop_dwell_time': 15.0,
+        },
+    'melb_train': {
+        'full_speed': 100,
+        'accel': 1.0,
+        'stop_dwell_time': 30.0,
+        },
+    'fast_train': {
+        'full_speed': 120,
+        'accel': 1.0,
+        'stop_dwell_time': 20.0,
+        },
+    }
+
 def dist_trav_rest_to_max_speed(max_speed, accel):
     # Use re-arranged 5th law of motion
     # Assume max speed in m/s.
@@ -37,3 +72,28 @@ def calc_vehicle_speed_bw_stops(seg_dist_m,
     avg_speed_inc_dwell_km_h = (seg_dist_m / tot_time) * 3.6
     return avg_speed_inc_dwell_km_h
 
+def calc_vehicle_trav_time_bw_stops_array(stop_dists_m, max_spd_m_s,
+        accel_m_s2):
+    """Array version of calc_vehicle_trav_time_bw_stops(), for a numpy array
+    of distances between stops."""
+    stop_dists_m = numpy.asarray(stop_dists_m, dtype=float)
+    dist_rest_to_max = dist_trav_rest_to_max_speed(max_spd_m_s, accel_m_s2)
+    # Never reaching full speed :- full accel/decel over half the distance
+    #  each.
+    times_no_max = 2 * numpy.sqrt(stop_dists_m / float(accel_m_s2))
+    # Otherwise, accel to and decel from full speed, with constant speed
+    #  between.
+    times_max = 2 * (max_spd_m_s / float(accel_m_s2)) \
+        + (stop_dists_m - dist_rest_to_max * 2) / float(max_spd_m_s)
+    return numpy.where(dist_rest_to_max * 2 >= stop_dists_m, times_no_max,
+        times_max)
+
+def calc_vehicle_speed_bw_stops_array(seg_dists_m,
+        max_spd_km_h, accel_m_s2, stop_dwell_time_s):
+    """Array version of calc_vehicle_speed_bw_stops()."""
+    seg_dists_m = numpy.asarray(seg_dists_m, dtype=float)
+    max_spd_m_s = max_spd_km_h / 3.6
+    trav_times = calc_vehicle_trav_time_bw_stops_array(seg_dists_m,
+        max_spd_m_s, accel_m_s2)
+    tot_times = stop_dwell_time_s + trav_times
+    return (seg_dists_m / tot_times) * 3.6
@@ -0,0 +1,120 @@
+"""Snapshots of set up speed models (see seg_speed_models), so that runs
+whose inputs haven't changed since the snapshot was saved can skip setting up
+the speed model (reading all the segments and stops) at start-up.
+
+A snapshot stores what the model's get_setup_state() returns, along with
+a key of the model's class and parameters, and the mode config used, and
+fingerprints (size and modification time) of the input files. It's only
+loaded if all of these still match."""
+
+import os
+import os.path
+import cPickle
+
+import gtfs_build_cache
+
+# Change this whenever the state saved by any speed model changes, so that
+#  old snapshots aren't loaded.
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Files that make up a shapefile.
+SHAPEFILE_EXTS = ['.shp', '.shx', '.dbf', '.prj']
+
+def get_input_fingerprints(input_fnames):
+    """Returns a list of the path, size and modification time of each input
+    file (and for shapefiles, each of the files that make it up)."""
+    fingerprints = []
+    for input_fname in input_fnames:
+        base_fname, ext = os.path.splitext(input_fname)
+        if ext.lower() == '.shp':
+            fnames = [base_fname + shp_ext for shp_ext in SHAPEFILE_EXTS]
+        else:
+            fnames = [input_fname]
+        for fname in fnames:
+            try:
+                file_stat = os.stat(fname)
+            except OSError:
+                fingerprints.append((os.path.abspath(fname), None, None))
+            else:
+                fingerprints.append((os.path.abspath(fname),
+                    file_stat.st_size, file_stat.st_mtime))
+    return fingerprints
+
+def get_speed_model_key(seg_speed_model, mode_config):
+    return (SNAPSHOT_FORMAT_VERSION, seg_speed_model.__class__.__name__,
+        repr(seg_speed_model.get_params_signature()),
+        repr(gtfs_build_cache.get_mode_config_items(mode_config)))
+
+class SpeedModelSnapshot:
+    """A snapshot file of a set up speed model, for given input files."""
+    def __init__(self, snapshot_fname, input_fnames):
+        self.snapshot_fname = snapshot_fname
+        self.input_fnames = input_fnames
+        self.loaded = False
+
+    def _get_header(self, seg_speed_model, mode_config):
+        return {'key': get_speed_model_key(seg_speed_model, mode_config),
+            'input_fingerprints': get_input_fingerprints(self.input_fnames)}
+
+    def _load(self, seg_speed_model, header):
+        if not os.path.exists(self.snapshot_fname):
+            return False
+        snapshot_file = open(self.snapshot_fname, 'rb')
+        try:
+            # The header is stored first, so state of a stale snapshot
+            #  doesn't have to be read.
+            if cPickle.load(snapshot_file) != header:
+                return False
+            setup_state = cPickle.load(snapshot_file)
+        except (EOFError, cPickle.UnpicklingError):
+            print "Warning: speed model snapshot %s is corrupt, ignoring." \
+                % self.snapshot_fname
+            return False
+        finally:
+            snapshot_file.close()
+        seg_speed_model.set_setup_state(setup_state)
+        return True
+
+    def _save(self, seg_speed_model, header):
+        setup_state = seg_speed_model.get_setup_state()
+        if setup_state is None:
+            # Nothing worth saving for this model.
+            return
+        # Write to a temporary file first, so worker processes saving at the
+        #  same time never load a partly written snapshot.
+        tmp_fname = "%s.%d.tmp" % (self.snapshot_fname, os.getpid())
+        snapshot_file = open(tmp_fname, 'wb')
+        cPickle.dump(header, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(setup_state, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        snapshot_file.close()
+        try:
+            os.rename(tmp_fname, self.snapshot_fname)
+        except OSError:
+            # E.g. on Windows, if another process saved it first.
+            os.remove(tmp_fname)
+        return
+
+    def setup_speed_model(self, seg_speed_model, route_defs, segs_layer,
+            stops_layer, mode_config):
+        """Sets up seg_speed_model from the snapshot, if it exists and is for
+        the same model and inputs. Otherwise sets it up as usual, and saves
+        a new snapshot of it."""
+        # Before setup, as that can fill in some of the model's parameters.
+        header = self._get_header(seg_speed_model, mode_config)
+        self.loaded = self._load(seg_speed_model, header)
+        if not self.loaded:
+            seg_speed_model.setup(route_defs, segs_layer, stops_layer,
+                mode_config)
+            self._save(seg_speed_model, header)
+        return
+
+def setup_speed_model(seg_speed_model, route_defs, segs_layer, stops_layer,
+        mode_config, speed_model_snapshot=None):
+    """Sets up seg_speed_model, using speed_model_snapshot if given."""
+    if speed_model_snapshot is None:
+        seg_speed_model.setup(route_defs, segs_layer, stops_layer,
+            mode_config)
+    else:
+        speed_model_snapshot.setup_speed_model(seg_speed_model, route_defs,
+            segs_layer, stops_layer, mode_config)
+    return
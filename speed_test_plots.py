@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 
 from speed_funcs_location_based import peak_speed_func
 from speed_funcs_vehicle_based import *
+from speed_funcs_vehicle_based import VEHICLE_CLASS_PARAMS
 
 def plot_melb_bus_dist_based():
     X = numpy.arange(0, 50, 0.1)
@@ -27,38 +28,8 @@ def plot_melb_bus_dist_based():
     plt.ylabel("Average speed (km/h)")
     plt.savefig('speed-distance-bus-peak-Melb')
 
-# These values are set based on examples from HiTrans book:
-# Nielsen, G., Nelson, J., Mulley, C., Tegner, G., Lind, G., & Lange, T. 2005,
-# Public transport - Planning the networks. HiTrans Best practice guide No. 2., ,  . 
-# p126-127.
-
-speed_func_params = {
-    'slow_bus': {
-        'full_speed': 40,
-        'accel': 1.0,
-        'stop_dwell_time': 20.0,
-        },
-    'tram': {
-        'full_speed': 80,
-        'accel': 1.0,
-        'stop_dwell_time': 20.0,
-        },
-    'fast_tram': {
-        'full_speed': 80,
-        'accel': 1.2,
-        'stop_dwell_time': 15.0,
-        },
-    'melb_train': {
-        'full_speed': 100,
-        'accel': 1.0,
-        'stop_dwell_time': 30.0,
-        },
-    'fast_train': {
-        'full_speed': 120,
-        'accel': 1.0,
-        'stop_dwell_time': 20.0,
-        },
-    }
+# Moved to speed_funcs_vehicle_based, so speed models can use them too.
+speed_func_params = VEHICLE_CLASS_PARAMS
 
 def plot_mode_speeds_for_segment_lengths(min_dist, max_dist, dist_inc):
 
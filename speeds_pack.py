@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+
+"""Packing a directory of per-route average speed CSV files (as written by
+time_periods_speeds_model) into a single indexed SQLite file.
+
+A speeds dir for a whole metro network can have tens of thousands of small
+files, so reading them is dominated by filesystem latency. A pack file can
+be given anywhere a speeds dir is read from (the --gtfs_speeds_dir of
+create_gtfs_from_basicinfo.py, the input speeds dirs of break_routes.py,
+change_avg_speeds_by_ratio.py and the route extension scripts) :- the
+functions of time_periods_speeds_model read from it directly, treating
+<pack file>/<speeds CSV file name> as the path of each packed file.
+
+Usage:
+  speeds_pack.py pack --speeds_dir=<dir> --output=<pack file>"""
+
+import os
+import os.path
+import glob
+import sqlite3
+from optparse import OptionParser
+
+import misc_utils
+
+SQLITE_HEADER = 'SQLite format 3\x00'
+PACK_TABLE = 'speeds_files'
+SPEEDS_FNAME_MATCH = "*-speeds-*-all.csv"
+
+# Packs already opened, and paths already checked if they are a pack.
+_open_packs = {}
+_is_pack_cache = {}
+
+def get_info_from_speeds_fname(speeds_fname):
+    """Returns the (file-ready) route name, service period, and direction
+    of a speeds file name."""
+    rname_file_ready, rest = \
+        os.path.basename(speeds_fname).rsplit('-speeds-', 1)
+    serv_period, rdir_str = rest.split('-')[:2]
+    return rname_file_ready, serv_period, rdir_str
+
+class SpeedsPack:
+    """A packed speeds file, opened for reading."""
+    def __init__(self, pack_fname):
+        self.pack_fname = pack_fname
+        self._conn = sqlite3.connect(pack_fname)
+        self._conn.text_factory = str
+
+    def get_fnames_matching(self, fname_match):
+        """Names of the packed files that match shell-style pattern
+        fname_match (as glob.glob() would in a speeds dir)."""
+        cursor = self._conn.execute("SELECT fname FROM %s WHERE fname GLOB ? "\
+            "ORDER BY fname" % PACK_TABLE, (fname_match,))
+        return [row[0] for row in cursor]
+
+    def get_contents(self, fname):
+        """Contents of the packed file with name fname, or None if there
+        isn't one."""
+        cursor = self._conn.execute("SELECT contents FROM %s WHERE fname = ?" \
+            % PACK_TABLE, (fname,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def close(self):
+        self._conn.close()
+
+def is_speeds_pack(path):
+    try:
+        return _is_pack_cache[path]
+    except KeyError:
+        pass
+    is_pack = False
+    if os.path.isfile(path):
+        pack_file = open(path, 'rb')
+        is_pack = pack_file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+        pack_file.close()
+    _is_pack_cache[path] = is_pack
+    return is_pack
+
+def open_speeds_pack(pack_fname):
+    """Returns the SpeedsPack for pack_fname, opening it if not already."""
+    try:
+        speeds_pack = _open_packs[pack_fname]
+    except KeyError:
+        speeds_pack = SpeedsPack(pack_fname)
+        _open_packs[pack_fname] = speeds_pack
+    return speeds_pack
+
+def close_all_packs():
+    """Closes all opened packs, and forgets which paths are packs. Must be
+    called in processes forked from one that had packs open (e.g. in worker
+    process initialisers), since SQLite connections can't be used across a
+    fork :- packs are then re-opened in the new process as needed."""
+    for speeds_pack in _open_packs.itervalues():
+        speeds_pack.close()
+    _open_packs.clear()
+    _is_pack_cache.clear()
+    return
+
+def get_pack_entry(fname):
+    """If fname is the path of a file in a pack (i.e. <pack file>/<speeds
+    CSV file name>), returns a tuple of the opened SpeedsPack and the name
+    of the file in it. Otherwise, returns None."""
+    pack_fname, entry_fname = os.path.split(fname)
+    if not is_speeds_pack(pack_fname):
+        return None
+    return open_speeds_pack(pack_fname), entry_fname
+
+def pack_speeds_dir(speeds_dir, pack_fname):
+    """Packs all the speeds CSV files in speeds_dir into a new pack file
+    pack_fname. Returns the number of files packed."""
+    if os.path.exists(pack_fname):
+        os.unlink(pack_fname)
+    conn = sqlite3.connect(pack_fname)
+    conn.text_factory = str
+    # (Files are looked up by name, or by name GLOB patterns, which SQLite
+    #  can also answer from the primary key index when they start with the
+    #  route name.)
+    conn.execute("CREATE TABLE %s (fname TEXT PRIMARY KEY, "\
+        "route_name TEXT, serv_period TEXT, trips_dir TEXT, contents TEXT)" \
+        % PACK_TABLE)
+    speeds_fnames = sorted(glob.glob(os.path.join(speeds_dir,
+        SPEEDS_FNAME_MATCH)))
+    for ii, speeds_fname in enumerate(speeds_fnames):
+        csv_file = open(misc_utils.get_win_safe_path(speeds_fname), 'rb')
+        contents = csv_file.read()
+        csv_file.close()
+        rname_file_ready, serv_period, rdir_str = \
+            get_info_from_speeds_fname(speeds_fname)
+        conn.execute("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % PACK_TABLE,
+            (os.path.basename(speeds_fname), rname_file_ready, serv_period,
+                rdir_str, contents))
+        if (ii+1) % 1000 == 0:
+            print "...packed %d files ..." % (ii+1)
+    conn.commit()
+    conn.close()
+    return len(speeds_fnames)
+
+def main():
+    parser = OptionParser(usage="%prog pack --speeds_dir=<dir> "\
+        "--output=<pack file>")
+    parser.add_option('--speeds_dir', dest='speeds_dir',
+        help='Directory of avg speed files to pack.')
+    parser.add_option('--output', dest='output',
+        help='Pack file to create (any existing one is replaced).')
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] != 'pack':
+        parser.print_help()
+        parser.error("Command should be 'pack'.")
+    if options.speeds_dir is None:
+        parser.print_help()
+        parser.error("No speeds dir given.")
+    if not os.path.isdir(options.speeds_dir):
+        parser.print_help()
+        parser.error("Speeds dir given %s doesn't exist." \
+            % options.speeds_dir)
+    if options.output is None:
+        parser.print_help()
+        parser.error("No output pack file given.")
+
+    print "Packing speed files in dir %s into file %s ..." \
+        % (options.speeds_dir, options.output)
+    n_packed = pack_speeds_dir(options.speeds_dir, options.output)
+    print "... done (packed %d speed files)." % n_packed
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Recording of how long each stage of a long-running script (such as
+creating a GTFS file) takes, how much memory it uses, and how many items
+(routes, trips, stop times, shapefile features read, etc) it processes :-
+so we can tell where the time of a slow run actually went.
+
+Usage is to create a StageStatsRecorder, make it the active one with
+set_active_recorder(), and then call the module-level start_stage(),
+end_stage() and add_count() functions around and within each stage. These
+do nothing if there's no active recorder, so can be called from anywhere
+without checks (e.g. in worker processes, whose counts aren't recorded).
+
+Stages are meant to be run one after another, not nested. A stage can be
+started and ended many times (e.g. once per batch of routes), its stats
+are accumulated.
+
+Memory is measured as the peak RSS of the process (all that's available
+without polling), so a stage's peak_rss_so_far_mb includes the peaks of
+all stages before it. Its peak_rss_increase_mb is how much the peak grew
+while the stage was running, i.e. the extra memory that stage needed."""
+
+import os
+import os.path
+import sys
+import time
+import json
+import resource
+import cProfile
+
+class Stage_Stats:
+    """A small struct to store the accumulated stats of a stage."""
+    def __init__(self, name):
+        self.name = name
+        self.n_calls = 0
+        self.wall_secs = 0.0
+        self.cpu_secs = 0.0
+        self.child_cpu_secs = 0.0
+        self.peak_rss_so_far_mb = 0.0
+        self.peak_rss_increase_mb = 0.0
+        self.counts = {}
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'n_calls': self.n_calls,
+            'wall_secs': self.wall_secs,
+            'cpu_secs': self.cpu_secs,
+            'child_cpu_secs': self.child_cpu_secs,
+            'peak_rss_so_far_mb': self.peak_rss_so_far_mb,
+            'peak_rss_increase_mb': self.peak_rss_increase_mb,
+            'counts': self.counts,
+            }
+
+def get_peak_rss_mb():
+    """Peak resident memory used by this process so far, in MB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes on Mac OS X, KB elsewhere.
+        return max_rss / (1024.0 * 1024.0)
+    return max_rss / 1024.0
+
+def get_cpu_secs():
+    """Returns a tuple of CPU (user + system) seconds used so far by this
+    process, and by its child processes that have finished."""
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+class StageStatsRecorder:
+    def __init__(self, profile_dir=None):
+        """If profile_dir is given, each stage is also profiled with
+        cProfile, and its stats dumped there as <stage name>.prof."""
+        self.profile_dir = profile_dir
+        self.stages = []
+        self._stages_by_name = {}
+        self._profiles = {}
+        self._curr_stage = None
+        self._curr_stage_start = None
+        self.totals = {}
+        self._start_wall = time.time()
+
+    def start_stage(self, name):
+        assert self._curr_stage is None, \
+            "Stage '%s' started while stage '%s' still running." \
+            % (name, self._curr_stage.name)
+        try:
+            stage = self._stages_by_name[name]
+        except KeyError:
+            stage = Stage_Stats(name)
+            self._stages_by_name[name] = stage
+            self.stages.append(stage)
+        self._curr_stage = stage
+        self._curr_stage_start = (time.time(), get_cpu_secs(),
+            get_peak_rss_mb())
+        if self.profile_dir:
+            if name not in self._profiles:
+                self._profiles[name] = cProfile.Profile()
+            self._profiles[name].enable()
+
+    def end_stage(self, name):
+        stage = self._curr_stage
+        assert stage is not None and stage.name == name
+        if self.profile_dir:
+            self._profiles[name].disable()
+        start_wall, start_cpu, start_peak_rss = self._curr_stage_start
+        end_cpu = get_cpu_secs()
+        end_peak_rss = get_peak_rss_mb()
+        stage.n_calls += 1
+        stage.wall_secs += time.time() - start_wall
+        stage.cpu_secs += end_cpu[0] - start_cpu[0]
+        stage.child_cpu_secs += end_cpu[1] - start_cpu[1]
+        stage.peak_rss_so_far_mb = max(stage.peak_rss_so_far_mb,
+            end_peak_rss)
+        stage.peak_rss_increase_mb += end_peak_rss - start_peak_rss
+        self._curr_stage = None
+        self._curr_stage_start = None
+
+    def add_count(self, count_name, n=1):
+        """Adds n to the named count of the current stage (if any), and of
+        the whole run."""
+        if self._curr_stage is not None:
+            counts = self._curr_stage.counts
+            counts[count_name] = counts.get(count_name, 0) + n
+        self.totals[count_name] = self.totals.get(count_name, 0) + n
+
+    def get_report(self):
+        report = {
+            'stages': [stage.to_dict() for stage in self.stages],
+            'totals': self.totals,
+            'total_wall_secs': time.time() - self._start_wall,
+            'peak_rss_mb': get_peak_rss_mb(),
+            }
+        return report
+
+    def write_json(self, fname):
+        out_file = open(fname, 'w')
+        json.dump(self.get_report(), out_file, indent=2, sort_keys=True)
+        out_file.close()
+
+    def dump_profiles(self):
+        if not self.profile_dir:
+            return
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        for name, profile in self._profiles.iteritems():
+            profile.dump_stats(os.path.join(self.profile_dir,
+                "%s.prof" % name))
+
+    def print_summary(self):
+        report = self.get_report()
+        print "Stage stats:"
+        print "%-20s %6s %10s %10s %10s %10s %10s  %s" % ("stage", "calls",
+            "wall (s)", "cpu (s)", "child cpu", "peak (MB)", "+peak (MB)",
+            "counts")
+        for stage in self.stages:
+            counts_str = ", ".join(["%s=%d" % (count_name, n) for \
+                count_name, n in sorted(stage.counts.iteritems())])
+            print "%-20s %6d %10.2f %10.2f %10.2f %10.1f %10.1f  %s" \
+                % (stage.name, stage.n_calls, stage.wall_secs,
+                   stage.cpu_secs, stage.child_cpu_secs,
+                   stage.peak_rss_so_far_mb, stage.peak_rss_increase_mb,
+                   counts_str)
+        print "Total wall time %.2f secs, peak RSS %.1f MB." \
+            % (report['total_wall_secs'], report['peak_rss_mb'])
+
+_active_recorder = None
+
+def set_active_recorder(recorder):
+    global _active_recorder
+    _active_recorder = recorder
+
+def start_stage(name):
+    if _active_recorder is not None:
+        _active_recorder.start_stage(name)
+
+def end_stage(name):
+    if _active_recorder is not None:
+        _active_recorder.end_stage(name)
+
+def add_count(count_name, n=1):
+    if _active_recorder is not None:
+        _active_recorder.add_count(count_name, n)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python2
+
+import unittest
+import inspect
+
+import numpy
+
+import seg_speed_models
+import speed_funcs_vehicle_based
+
+MODE_CONFIG = {'system': 'Bus', 'avespeed': 30.0, 'avespeed-peak': 20.0,
+    'maxspeed': 60.0, 'accel': 1.0, 'stop_dwell_time': 20}
+
+def get_test_seg_columns():
+    return seg_speed_models.Seg_Speed_Columns(numpy.arange(4),
+        numpy.array([50.0, 300.0, 800.0, 2500.0]),
+        numpy.array([False, True, False, True]), None,
+        numpy.array([1.0, 5.0, 12.0, 30.0]))
+
+class TestArraySpeedFuncs(unittest.TestCase):
+    def test_all_take_columns_and_mode_config(self):
+        # As calc_seg_speeds_arrays() calls them.
+        for array_speed_func in seg_speed_models.ARRAY_SPEED_FUNCS.values():
+            self.assertEqual(inspect.getargspec(array_speed_func).args,
+                ['seg_columns', 'mode_config'], array_speed_func.__name__)
+
+    def test_segment_length_speeds(self):
+        seg_columns = get_test_seg_columns()
+        speeds = seg_speed_models.calc_seg_speeds_arrays(seg_columns,
+            MODE_CONFIG,
+            [seg_speed_models.calc_speed_based_on_segment_length_array])[0]
+        for seg_length, speed in zip(seg_columns.seg_lengths, speeds):
+            self.assertAlmostEqual(speed,
+                speed_funcs_vehicle_based.calc_vehicle_speed_bw_stops(
+                    seg_length, MODE_CONFIG['maxspeed'],
+                    MODE_CONFIG['accel'], MODE_CONFIG['stop_dwell_time']))
+
+    def test_missing_length_field(self):
+        seg_columns = get_test_seg_columns()
+        seg_columns.seg_lengths = None
+        self.assertRaises(ValueError,
+            seg_speed_models.calc_speed_based_on_segment_length_array,
+            seg_columns, MODE_CONFIG)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python2
+
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+import zipfile
+
+import gtfs_ops
+
+GTFS_TABLES = {
+    'agency.txt': [
+        "agency_id,agency_name,agency_url,agency_timezone",
+        "A,Test Agency,http://example.com,Australia/Melbourne"],
+    'calendar.txt': [
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,"\
+            "sunday,start_date,end_date",
+        "WD,1,1,1,1,1,0,0,20150101,20151231",
+        "WE,0,0,0,0,0,1,1,20150101,20151231"],
+    'routes.txt': [
+        "route_id,agency_id,route_short_name,route_long_name,route_type",
+        "R1,A,1,Route One,3",
+        "R2,A,2,Route Two,3"],
+    'stops.txt': [
+        "stop_id,stop_name,stop_lat,stop_lon",
+        "S1,Stop 1,-37.800,144.960",
+        "S2,Stop 2,-37.805,144.965",
+        "S3,Stop 3,-37.810,144.970"],
+    'trips.txt': [
+        "route_id,service_id,trip_id,trip_headsign",
+        "R1,WD,T1,Outbound",
+        "R1,WD,T2,Outbound",
+        "R1,WE,T3,Inbound",
+        "R2,WD,T4,Outbound"],
+    # Out of order, to check stop times are sorted by sequence.
+    'stop_times.txt': [
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence",
+        "T1,08:05:00,08:05:00,S2,2",
+        "T1,08:00:00,08:00:00,S1,1",
+        "T1,08:12:00,08:12:00,S3,3",
+        "T2,09:00:00,09:00:00,S1,1",
+        "T2,09:06:00,09:06:00,S2,2",
+        "T2,09:13:30,09:13:30,S3,3",
+        "T3,10:00:00,10:00:00,S3,1",
+        "T3,10:10:00,10:10:00,S1,2",
+        "T4,06:00:00,06:00:00,S1,1",
+        "T4,06:04:00,06:04:00,S2,2",
+        "T4,06:10:00,06:10:00,S3,3"],
+    }
+
+FREQUENCIES_TABLE = [
+    "trip_id,start_time,end_time,headway_secs,exact_times",
+    "T4,06:00:00,07:00:00,1200,1",
+    "T4,17:00:00,17:30:00,900,1"]
+
+def write_gtfs_zip(gtfs_fname, tables):
+    gtfs_zip = zipfile.ZipFile(gtfs_fname, 'w')
+    for table_fname, lines in tables.iteritems():
+        gtfs_zip.writestr(table_fname, "\r\n".join(lines) + "\r\n")
+    gtfs_zip.close()
+
+def get_pattern_trips_rows(pattern_trips_list):
+    """Returns each pattern's trips as a dict, keyed by the pattern's stop
+    IDs, of sorted (trip ID, headsign, service ID, arrival times) tuples
+    (since the readers needn't put patterns or trips in the same order)."""
+    rows_by_pattern = {}
+    for pattern_trips in pattern_trips_list:
+        rows_by_pattern[tuple(pattern_trips.stop_ids)] = sorted(
+            zip(pattern_trips.trip_ids, pattern_trips.headsigns,
+                pattern_trips.service_ids,
+                [tuple(trip_arrival_secs) for trip_arrival_secs \
+                    in pattern_trips.arrival_secs.tolist()]))
+    return rows_by_pattern
+
+class TestColumnarGTFSFeed(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gtfs_fname = os.path.join(self.tmp_dir, "gtfs.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_same_as_transitfeed(self, tables):
+        write_gtfs_zip(self.gtfs_fname, tables)
+        columnar_feed = gtfs_ops.load_gtfs_for_extraction(self.gtfs_fname,
+            gtfs_ops.READER_COLUMNAR)
+        schedule = gtfs_ops.load_gtfs_for_extraction(self.gtfs_fname,
+            gtfs_ops.READER_TRANSITFEED)
+        self.assertEqual(sorted(columnar_feed.routes.keys()),
+            sorted(schedule.routes.keys()))
+        rows_by_route = {}
+        for route_id in schedule.routes.iterkeys():
+            rows_by_pattern = get_pattern_trips_rows(
+                gtfs_ops.get_route_pattern_trips(columnar_feed, route_id))
+            self.assertEqual(rows_by_pattern, get_pattern_trips_rows(
+                gtfs_ops.get_route_pattern_trips(schedule, route_id)))
+            rows_by_route[route_id] = rows_by_pattern
+        return rows_by_route
+
+    def test_same_as_transitfeed(self):
+        rows_by_route = self.check_same_as_transitfeed(GTFS_TABLES)
+        self.assertEqual(rows_by_route['R1'], {
+            ('S1', 'S2', 'S3'): [
+                ('T1', 'Outbound', 'WD', (28800, 29100, 29520)),
+                ('T2', 'Outbound', 'WD', (32400, 32760, 33210))],
+            ('S3', 'S1'): [
+                ('T3', 'Inbound', 'WE', (36000, 36600))]})
+
+    def test_frequencies_expanded(self):
+        tables = dict(GTFS_TABLES)
+        tables['frequencies.txt'] = FREQUENCIES_TABLE
+        rows_by_route = self.check_same_as_transitfeed(tables)
+        run_start_secs = [21600, 22800, 24000, 61200, 62100]
+        self.assertEqual(rows_by_route['R2'], {
+            ('S1', 'S2', 'S3'): [('T4', 'Outbound', 'WD',
+                (run_secs, run_secs + 240, run_secs + 600)) \
+                    for run_secs in run_start_secs]})
+        # Trips without frequencies are unchanged.
+        self.assertEqual(rows_by_route['R1'],
+            self.check_same_as_transitfeed(GTFS_TABLES)['R1'])
+
+if __name__ == "__main__":
+    unittest.main()
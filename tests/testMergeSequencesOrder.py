@@ -0,0 +1,36 @@
+#!/usr/bin/env python2
+
+import unittest
+
+import misc_utils
+
+class TestMergeSequencesOrder(unittest.TestCase):
+    def test_branching(self):
+        # Two patterns of a route that split after B and rejoin at D.
+        sequences = [['A', 'B', 'C', 'D'], ['A', 'B', 'X', 'D']]
+        self.assertEqual(misc_utils.merge_sequences_order(sequences),
+            ['A', 'B', 'C', 'X', 'D'])
+
+    def test_branching_later_pattern_extends(self):
+        sequences = [['B', 'C'], ['A', 'B', 'C', 'E']]
+        self.assertEqual(misc_utils.merge_sequences_order(sequences),
+            ['A', 'B', 'C', 'E'])
+
+    def test_loop(self):
+        # A loop route, that ends back at its first stop.
+        sequences = [['A', 'B', 'C', 'A']]
+        self.assertEqual(misc_utils.merge_sequences_order(sequences),
+            ['A', 'B', 'C'])
+
+    def test_revisit(self):
+        # A pattern that goes out to C and back to B before continuing.
+        sequences = [['A', 'B', 'C', 'B', 'D']]
+        self.assertEqual(misc_utils.merge_sequences_order(sequences),
+            ['A', 'B', 'C', 'D'])
+
+    def test_empty(self):
+        self.assertEqual(misc_utils.merge_sequences_order([]), [])
+        self.assertEqual(misc_utils.merge_sequences_order([[]]), [])
+
+if __name__ == "__main__":
+    unittest.main()
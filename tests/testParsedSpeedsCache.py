@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+
+import unittest
+import os
+import os.path
+import copy
+import pickle
+import shutil
+import tempfile
+from datetime import timedelta
+
+import time_periods_speeds_model as tps_speeds_model
+
+PERIODS = [(timedelta(hours=6), timedelta(hours=9)),
+    (timedelta(hours=9), timedelta(hours=12))]
+
+def write_speeds_file(csv_fname, speeds):
+    tps_speeds_model.write_avg_speeds_on_segments({1: "A", 2: "B", 3: "C"},
+        {('1', '2'): speeds, ('3', '2'): (25.0, 30.0)},
+        {('1', '2'): 500.0, ('3', '2'): 750.0}, PERIODS, csv_fname, 2)
+
+class TestParsedSpeedsCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fnames = []
+        for file_i in range(3):
+            fname = os.path.join(self.tmp_dir, "speeds%d.csv" % file_i)
+            write_speeds_file(fname, (20.0 + file_i, 40.0))
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hit(self):
+        speeds_cache = tps_speeds_model.ParsedSpeedsCache()
+        parsed_info = speeds_cache.get(self.fnames[0], False)
+        time_periods, avg_speeds, seg_distances, stop_names = parsed_info
+        self.assertEqual(list(time_periods), PERIODS)
+        self.assertEqual(avg_speeds[('1', '2')], (20.0, 40.0))
+        self.assertEqual(seg_distances[('3', '2')], 750.0)
+        self.assertEqual(stop_names[3], "C")
+        self.assertTrue(speeds_cache.get(self.fnames[0], False) \
+            is parsed_info)
+        self.assertEqual((speeds_cache.hits, speeds_cache.misses), (1, 1))
+
+    def test_sorted_pairs_cached_separately(self):
+        speeds_cache = tps_speeds_model.ParsedSpeedsCache()
+        avg_speeds = speeds_cache.get(self.fnames[0], False)[1]
+        sorted_avg_speeds = speeds_cache.get(self.fnames[0], True)[1]
+        self.assertTrue(('3', '2') in avg_speeds)
+        self.assertTrue(('2', '3') in sorted_avg_speeds)
+        self.assertEqual(len(speeds_cache), 2)
+
+    def test_changed_file_reparsed(self):
+        speeds_cache = tps_speeds_model.ParsedSpeedsCache()
+        speeds_cache.get(self.fnames[0], False)
+        # A different size, so changed even if the mod time isn't.
+        write_speeds_file(self.fnames[0], (21.25, 40.0))
+        avg_speeds = speeds_cache.get(self.fnames[0], False)[1]
+        self.assertEqual(avg_speeds[('1', '2')], (21.25, 40.0))
+        self.assertEqual((speeds_cache.hits, speeds_cache.misses), (0, 2))
+
+    def test_least_recently_used_evicted(self):
+        speeds_cache = tps_speeds_model.ParsedSpeedsCache(max_entries=2)
+        speeds_cache.get(self.fnames[0], False)
+        speeds_cache.get(self.fnames[1], False)
+        speeds_cache.get(self.fnames[0], False)
+        speeds_cache.get(self.fnames[2], False)
+        self.assertEqual(len(speeds_cache), 2)
+        self.assertEqual(speeds_cache.hits, 1)
+        speeds_cache.get(self.fnames[0], False)
+        self.assertEqual(speeds_cache.hits, 2)
+        speeds_cache.get(self.fnames[1], False)
+        self.assertEqual(speeds_cache.hits, 2)
+
+    def test_missing_file(self):
+        speeds_cache = tps_speeds_model.ParsedSpeedsCache()
+        self.assertRaises(IOError, speeds_cache.get,
+            os.path.join(self.tmp_dir, "missing.csv"), False)
+        self.assertEqual(len(speeds_cache), 0)
+
+class TestReadOnlyDict(unittest.TestCase):
+    def setUp(self):
+        self.ro_dict = tps_speeds_model.ReadOnlyDict(
+            {('1', '2'): (20.0, 40.0)})
+
+    def check_read_only(self, ro_dict):
+        self.assertTrue(isinstance(ro_dict, tps_speeds_model.ReadOnlyDict))
+        self.assertEqual(ro_dict, {('1', '2'): (20.0, 40.0)})
+        self.assertRaises(TypeError, ro_dict.__setitem__, ('2', '3'), ())
+        self.assertRaises(TypeError, ro_dict.__delitem__, ('1', '2'))
+        self.assertRaises(TypeError, ro_dict.update, {})
+        self.assertRaises(TypeError, ro_dict.pop, ('1', '2'))
+        self.assertRaises(TypeError, ro_dict.setdefault, ('2', '3'), ())
+        self.assertRaises(TypeError, ro_dict.clear)
+
+    def test_read_only(self):
+        self.check_read_only(self.ro_dict)
+
+    def test_copies(self):
+        self.check_read_only(copy.copy(self.ro_dict))
+        self.check_read_only(copy.deepcopy(self.ro_dict))
+
+    def test_pickle(self):
+        for protocol in [0, 1, 2, pickle.HIGHEST_PROTOCOL]:
+            self.check_read_only(
+                pickle.loads(pickle.dumps(self.ro_dict, protocol)))
+
+    def test_dict_copy_changeable(self):
+        changeable = dict(self.ro_dict)
+        changeable[('2', '3')] = (30.0, 30.0)
+        self.assertEqual(len(changeable), 2)
+        self.assertEqual(len(self.ro_dict), 1)
+
+if __name__ == "__main__":
+    unittest.main()
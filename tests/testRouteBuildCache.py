@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+
+import gtfs_build_cache
+
+KEY = 'a' * 40
+
+TABLES = {
+    'trips.txt': "route_id,service_id,trip_id\r\nR1,SP1,100\r\nR1,SP1,101\r\n",
+    'stop_times.txt': "trip_id,arrival_time,stop_id\r\n"\
+        "100,01:00:00,1\r\n100,01:02:00,2\r\n101,01:10:00,1\r\n",
+    'frequencies.txt': "",
+    }
+
+def read_file(fname):
+    in_file = open(fname, 'rb')
+    contents = in_file.read()
+    in_file.close()
+    return contents
+
+def write_file(fname, contents):
+    out_file = open(fname, 'wb')
+    out_file.write(contents)
+    out_file.close()
+
+class TestCopyTableRenumberingTrips(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_fname = os.path.join(self.tmp_dir, "in.txt")
+        self.out_fname = os.path.join(self.tmp_dir, "out.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_renumber(self):
+        write_file(self.in_fname, TABLES['stop_times.txt'])
+        gtfs_build_cache.copy_table_renumbering_trips(self.in_fname,
+            self.out_fname, 50)
+        self.assertEqual(read_file(self.out_fname),
+            "trip_id,arrival_time,stop_id\r\n"\
+            "150,01:00:00,1\r\n150,01:02:00,2\r\n151,01:10:00,1\r\n")
+
+    def test_trip_id_not_first_column(self):
+        write_file(self.in_fname, TABLES['trips.txt'])
+        gtfs_build_cache.copy_table_renumbering_trips(self.in_fname,
+            self.out_fname, -100)
+        self.assertEqual(read_file(self.out_fname),
+            "route_id,service_id,trip_id\r\nR1,SP1,0\r\nR1,SP1,1\r\n")
+
+    def test_empty_table(self):
+        write_file(self.in_fname, "")
+        gtfs_build_cache.copy_table_renumbering_trips(self.in_fname,
+            self.out_fname, 50)
+        self.assertEqual(read_file(self.out_fname), "")
+
+class TestRouteBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.build_cache = gtfs_build_cache.RouteBuildCache(
+            os.path.join(self.tmp_dir, "cache"))
+        fnames = {}
+        for table_fname, contents in TABLES.iteritems():
+            fnames[table_fname] = os.path.join(self.tmp_dir, table_fname)
+            write_file(fnames[table_fname], contents)
+        self.build_cache.save_fragment(KEY, (fnames, 2, 3, 0), 100)
+        self.tmp_prefix = os.path.join(self.tmp_dir, "out.zip.route0")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_trip_ids(self):
+        fragment, delete_files = self.build_cache.get_fragment(KEY, 100,
+            self.tmp_prefix)
+        self.assertFalse(delete_files)
+        fnames, n_trips, n_stop_times, n_frequencies = fragment
+        self.assertEqual((n_trips, n_stop_times, n_frequencies), (2, 3, 0))
+        for table_fname, contents in TABLES.iteritems():
+            self.assertEqual(read_file(fnames[table_fname]), contents)
+
+    def test_trip_id_delta(self):
+        fragment, delete_files = self.build_cache.get_fragment(KEY, 120,
+            self.tmp_prefix)
+        # Renumbered copies, rather than the cached files themselves.
+        self.assertTrue(delete_files)
+        fnames = fragment[0]
+        for table_fname in TABLES:
+            self.assertTrue(fnames[table_fname].startswith(self.tmp_prefix))
+        self.assertEqual(read_file(fnames['trips.txt']),
+            "route_id,service_id,trip_id\r\nR1,SP1,120\r\nR1,SP1,121\r\n")
+        self.assertEqual(read_file(fnames['stop_times.txt']),
+            "trip_id,arrival_time,stop_id\r\n"\
+            "120,01:00:00,1\r\n120,01:02:00,2\r\n121,01:10:00,1\r\n")
+        self.assertEqual(read_file(fnames['frequencies.txt']), "")
+        # Cached entry unchanged, so can be re-used with its own IDs.
+        fragment, delete_files = self.build_cache.get_fragment(KEY, 100,
+            self.tmp_prefix)
+        self.assertEqual(read_file(fragment[0]['trips.txt']),
+            TABLES['trips.txt'])
+
+    def test_missing_entry(self):
+        self.assertFalse(self.build_cache.contains('b' * 40))
+        self.assertRaises(KeyError, self.build_cache.get_fragment, 'b' * 40,
+            100, self.tmp_prefix)
+
+    def test_prune(self):
+        self.assertEqual(self.build_cache.prune(set([KEY])), 0)
+        self.assertTrue(self.build_cache.contains(KEY))
+        self.assertEqual(self.build_cache.prune(set()), 1)
+        self.assertFalse(self.build_cache.contains(KEY))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,23 @@
+#!/usr/bin/env python2
+
+import unittest
+
+import gtfs_ops
+
+class TestCalcSpeedsWithNearbySegs(unittest.TestCase):
+    def test_segment_long_enough_alone(self):
+        # Exactly the min dist, which rounding shouldn't push below it.
+        speeds = gtfs_ops.calc_speeds_on_segments_with_nearby_segs(
+            [5.0, 123.7, 5.0], [1, 60, 1], 123.7, 0)
+        self.assertAlmostEqual(speeds[1], 123.7 / 60.0 * 3.6)
+
+    def test_nearby_segments_added(self):
+        # The next segment is added first, then the previous one.
+        speeds = gtfs_ops.calc_speeds_on_segments_with_nearby_segs(
+            [100.0, 200.0, 300.0], [10, 40, 30], 250, 0)
+        self.assertAlmostEqual(speeds[0], 300 / 50.0 * 3.6)
+        self.assertAlmostEqual(speeds[1], 500 / 70.0 * 3.6)
+        self.assertAlmostEqual(speeds[2], 300 / 30.0 * 3.6)
+
+if __name__ == "__main__":
+    unittest.main()
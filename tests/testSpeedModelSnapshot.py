@@ -0,0 +1,112 @@
+#!/usr/bin/env python2
+
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+
+import speed_model_snapshot
+
+MODE_CONFIG = {'name': 'Bus', 'avespeed': 30.0}
+
+class CountingSpeedModel:
+    """A speed model that just counts how often it's set up."""
+    def __init__(self, param=1):
+        self.param = param
+        self.n_setups = 0
+        self.setup_state = None
+
+    def setup(self, route_defs, segs_layer, stops_layer, mode_config):
+        self.n_setups += 1
+        self.setup_state = {'route_ids': [r_id for r_id in route_defs]}
+
+    def get_setup_state(self):
+        return self.setup_state
+
+    def set_setup_state(self, setup_state):
+        self.setup_state = setup_state
+
+    def get_params_signature(self):
+        return self.param
+
+def write_file(fname, contents):
+    out_file = open(fname, 'wb')
+    out_file.write(contents)
+    out_file.close()
+
+class TestSpeedModelSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_fname = os.path.join(self.tmp_dir, "model.snapshot")
+        self.segs_fname = os.path.join(self.tmp_dir, "segs.shp")
+        for ext in speed_model_snapshot.SHAPEFILE_EXTS:
+            write_file(os.path.splitext(self.segs_fname)[0] + ext, "data")
+        self.speeds_fname = os.path.join(self.tmp_dir, "speeds.csv")
+        write_file(self.speeds_fname, "speeds")
+        self.input_fnames = [self.segs_fname, self.speeds_fname]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_setup(self, speed_model, mode_config=MODE_CONFIG):
+        """Returns whether the model was loaded from the snapshot."""
+        snapshot = speed_model_snapshot.SpeedModelSnapshot(
+            self.snapshot_fname, self.input_fnames)
+        speed_model_snapshot.setup_speed_model(speed_model, [1, 2], None,
+            None, mode_config, snapshot)
+        return snapshot.loaded
+
+    def test_unchanged_inputs_loaded(self):
+        self.assertFalse(self.run_setup(CountingSpeedModel()))
+        self.assertTrue(os.path.exists(self.snapshot_fname))
+        speed_model = CountingSpeedModel()
+        self.assertTrue(self.run_setup(speed_model))
+        self.assertEqual(speed_model.n_setups, 0)
+        self.assertEqual(speed_model.setup_state, {'route_ids': [1, 2]})
+
+    def test_changed_input_file(self):
+        self.run_setup(CountingSpeedModel())
+        write_file(self.speeds_fname, "changed speeds")
+        speed_model = CountingSpeedModel()
+        self.assertFalse(self.run_setup(speed_model))
+        self.assertEqual(speed_model.n_setups, 1)
+        # Saved again, for the changed inputs.
+        self.assertTrue(self.run_setup(CountingSpeedModel()))
+
+    def test_changed_shapefile_part(self):
+        self.run_setup(CountingSpeedModel())
+        write_file(os.path.splitext(self.segs_fname)[0] + '.dbf', "more data")
+        self.assertFalse(self.run_setup(CountingSpeedModel()))
+
+    def test_removed_input_file(self):
+        self.run_setup(CountingSpeedModel())
+        os.remove(self.speeds_fname)
+        self.assertFalse(self.run_setup(CountingSpeedModel()))
+
+    def test_changed_params_or_mode_config(self):
+        self.run_setup(CountingSpeedModel())
+        self.assertFalse(self.run_setup(CountingSpeedModel(param=2)))
+        self.assertFalse(self.run_setup(CountingSpeedModel(param=2),
+            dict(MODE_CONFIG, avespeed=35.0)))
+        self.assertTrue(self.run_setup(CountingSpeedModel(param=2),
+            dict(MODE_CONFIG, avespeed=35.0)))
+
+    def test_corrupt_snapshot(self):
+        self.run_setup(CountingSpeedModel())
+        snapshot_file = open(self.snapshot_fname, 'rb')
+        contents = snapshot_file.read()
+        snapshot_file.close()
+        write_file(self.snapshot_fname, contents[:len(contents) - 10])
+        speed_model = CountingSpeedModel()
+        self.assertFalse(self.run_setup(speed_model))
+        self.assertEqual(speed_model.n_setups, 1)
+
+    def test_no_state_not_saved(self):
+        speed_model = CountingSpeedModel()
+        speed_model.get_setup_state = lambda: None
+        self.assertFalse(self.run_setup(speed_model))
+        self.assertFalse(os.path.exists(self.snapshot_fname))
+
+if __name__ == "__main__":
+    unittest.main()
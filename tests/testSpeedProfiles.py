@@ -0,0 +1,41 @@
+#!/usr/bin/env python2
+
+import unittest
+from datetime import timedelta
+
+import numpy
+
+import seg_speed_models
+
+def hrs(hours):
+    return timedelta(hours=hours)
+
+class TestSpeedProfiles(unittest.TestCase):
+    def test_interpolated_between_middles(self):
+        tp_index = seg_speed_models.TimePeriodIndex(
+            [(hrs(6), hrs(8)), (hrs(8), hrs(10))])
+        profile_index = seg_speed_models.SpeedProfileTimeIndex(tp_index)
+        profiles = seg_speed_models.Route_Speed_Profiles(profile_index,
+            numpy.array([[20.0, 40.0]]))
+        seg_speed_info = seg_speed_models.InterpolatedSegSpeedInfo(tp_index,
+            profile_index, profiles.speeds[0].tolist(),
+            profiles.slopes[0].tolist(), profiles.intercepts[0].tolist())
+        for hours, speed in [(5, 20.0), (7, 20.0), (8, 30.0), (9, 40.0),
+                (11, 40.0)]:
+            self.assertAlmostEqual(seg_speed_models.calc_interpolated_speed(
+                seg_speed_info, hours * 3600), speed)
+
+    def test_repeated_period(self):
+        tp_index = seg_speed_models.TimePeriodIndex(
+            [(hrs(6), hrs(8)), (hrs(8), hrs(10)), (hrs(6), hrs(8))])
+        self.assertRaises(ValueError,
+            seg_speed_models.SpeedProfileTimeIndex, tp_index)
+
+    def test_periods_with_same_middle(self):
+        tp_index = seg_speed_models.TimePeriodIndex(
+            [(hrs(6), hrs(10)), (hrs(7), hrs(9))])
+        self.assertRaises(ValueError,
+            seg_speed_models.SpeedProfileTimeIndex, tp_index)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+
+import unittest
+import codecs
+from StringIO import StringIO
+
+import gtfs_stream_writer
+
+class TestAppendTableRows(unittest.TestCase):
+    def test_same_columns(self):
+        out_file = StringIO()
+        out_columns, n_rows = gtfs_stream_writer.append_table_rows(
+            StringIO("a,b\r\n1,2\r\n3,4\r\n"), out_file, None)
+        self.assertEqual(out_columns, ['a', 'b'])
+        self.assertEqual(n_rows, 2)
+        out_columns, n_rows = gtfs_stream_writer.append_table_rows(
+            StringIO(codecs.BOM_UTF8 + "a,b\r\n5,6\r\n"), out_file,
+            out_columns)
+        self.assertEqual(n_rows, 1)
+        self.assertEqual(out_file.getvalue(), "a,b\r\n1,2\r\n3,4\r\n5,6\r\n")
+
+    def test_column_reorder(self):
+        out_file = StringIO()
+        out_columns, n_rows = gtfs_stream_writer.append_table_rows(
+            StringIO("b,a\r\n2,1\r\n4,3\r\n"), out_file, ['a', 'b', 'c'])
+        self.assertEqual(out_columns, ['a', 'b', 'c'])
+        self.assertEqual(n_rows, 2)
+        self.assertEqual(out_file.getvalue(), "1,2,\r\n3,4,\r\n")
+
+    def test_extra_column(self):
+        # Rather than silently dropping the values of column 'c'.
+        out_file = StringIO()
+        self.assertRaises(ValueError, gtfs_stream_writer.append_table_rows,
+            StringIO("b,c,a\r\n2,5,1\r\n"), out_file, ['a', 'b'])
+        self.assertEqual(out_file.getvalue(), "")
+
+    def test_empty_fragment(self):
+        out_file = StringIO()
+        out_columns, n_rows = gtfs_stream_writer.append_table_rows(
+            StringIO(""), out_file, None)
+        self.assertEqual(out_columns, None)
+        self.assertEqual(n_rows, 0)
+        out_columns, n_rows = gtfs_stream_writer.append_table_rows(
+            StringIO(""), out_file, ['a', 'b'])
+        self.assertEqual(out_columns, ['a', 'b'])
+        self.assertEqual(n_rows, 0)
+        self.assertEqual(out_file.getvalue(), "")
+
+    def test_header_only_fragment(self):
+        out_file = StringIO()
+        out_columns, n_rows = gtfs_stream_writer.append_table_rows(
+            StringIO("a,b\r\n"), out_file, None)
+        self.assertEqual(out_columns, ['a', 'b'])
+        self.assertEqual(n_rows, 0)
+        self.assertEqual(out_file.getvalue(), "a,b\r\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python2
+
+import unittest
+from datetime import timedelta
+
+import gtfs_ops
+
+def hrs(hours):
+    return timedelta(hours=hours)
+
+# Periods with a gap between 12:00 and 14:00.
+TIME_PERIODS = [(hrs(6), hrs(9)), (hrs(9), hrs(12)), (hrs(14), hrs(16))]
+
+class TestBinByTimePeriods(unittest.TestCase):
+    def test_boundary_time(self):
+        # A time on the boundary of two periods goes in the first.
+        counts, sums = gtfs_ops.bin_by_time_periods([[9 * 3600]],
+            TIME_PERIODS)
+        self.assertEqual(counts.tolist(), [[1, 0, 0]])
+        self.assertEqual(sums, None)
+
+    def test_before_first_period(self):
+        counts, sums = gtfs_ops.bin_by_time_periods(
+            [[5 * 3600, 6 * 3600 - 1, 6 * 3600]], TIME_PERIODS)
+        self.assertEqual(counts.tolist(), [[1, 0, 0]])
+
+    def test_gap_between_periods(self):
+        counts, sums = gtfs_ops.bin_by_time_periods(
+            [[12 * 3600 + 1, 13 * 3600, 15 * 3600]], TIME_PERIODS)
+        self.assertEqual(counts.tolist(), [[0, 0, 1]])
+
+    def test_groups_and_sums(self):
+        # Times in a group don't have to be in order.
+        times_by_group = [[15 * 3600, 7 * 3600, 8 * 3600], [], [10 * 3600]]
+        values_by_group = [[1.5, 2.0, 3.0], [], [4.0]]
+        counts, sums = gtfs_ops.bin_by_time_periods(times_by_group,
+            TIME_PERIODS, values_by_group)
+        self.assertEqual(counts.tolist(), [[2, 0, 1], [0, 0, 0], [0, 1, 0]])
+        self.assertEqual(sums.tolist(),
+            [[5.0, 0.0, 1.5], [0.0, 0.0, 0.0], [0.0, 4.0, 0.0]])
+
+if __name__ == "__main__":
+    unittest.main()
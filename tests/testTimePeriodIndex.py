@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+
+import unittest
+from datetime import timedelta
+
+import misc_utils
+import seg_speed_models
+
+def mins(minutes):
+    return timedelta(minutes=minutes)
+
+# Contiguous periods, then a gap, then a period past midnight.
+TIME_PERIODS = [(mins(300), mins(420)), (mins(420), mins(600)),
+    (mins(600), mins(900)), (mins(960), mins(1500))]
+# Periods not in order of end times, so can't be searched by bisection.
+UNORDERED_TIME_PERIODS = [(mins(600), mins(900)), (mins(300), mins(420)),
+    (mins(420), mins(600))]
+
+def get_test_times(time_periods):
+    """Times on and either side of every period boundary, and outside all
+    the periods."""
+    test_times = [mins(0), mins(1600), mins(1500) + timedelta(seconds=0.5)]
+    for tp in time_periods:
+        for bound in tp:
+            for delta_secs in [-1, -0.000001, 0, 0.000001, 1]:
+                test_times.append(bound + timedelta(seconds=delta_secs))
+    return test_times
+
+class TestTimePeriodIndex(unittest.TestCase):
+    def check_same_as_list(self, time_periods):
+        tp_index = seg_speed_models.TimePeriodIndex(time_periods)
+        last_found_is = [None] + range(len(time_periods))
+        for curr_time in get_test_times(time_periods):
+            curr_secs = misc_utils.tdToSecs(curr_time)
+            for last_found_i in last_found_is:
+                self.assertEqual(
+                    tp_index.get_index(last_found_i, curr_secs),
+                    seg_speed_models.get_time_period_index(time_periods,
+                        last_found_i, curr_time),
+                    "Different index at %s, last found %s" \
+                        % (curr_time, last_found_i))
+            band = tp_index.get_band(curr_secs)
+            expected_band = seg_speed_models.get_time_period_band(
+                time_periods, curr_time)
+            self.assertEqual(band, expected_band,
+                "Different band at %s" % curr_time)
+
+    def test_ordered_periods(self):
+        self.check_same_as_list(TIME_PERIODS)
+
+    def test_unordered_periods(self):
+        self.check_same_as_list(UNORDERED_TIME_PERIODS)
+
+    def test_boundary_uses_last_found(self):
+        # Boundaries are in both periods, so the last one found is kept.
+        tp_index = seg_speed_models.TimePeriodIndex(TIME_PERIODS)
+        boundary_secs = 420 * 60
+        self.assertEqual(tp_index.get_index(None, boundary_secs), 0)
+        self.assertEqual(tp_index.get_index(0, boundary_secs), 0)
+        self.assertEqual(tp_index.get_index(1, boundary_secs), 1)
+        self.assertEqual(tp_index.get_band(boundary_secs), None)
+
+    def test_gap_and_outside(self):
+        tp_index = seg_speed_models.TimePeriodIndex(TIME_PERIODS)
+        self.assertEqual(tp_index.get_index(2, 930 * 60), None)
+        self.assertEqual(tp_index.get_index(None, 0), None)
+        self.assertEqual(tp_index.get_band(930 * 60), None)
+        # Times after the start of the last period all use it.
+        self.assertEqual(tp_index.get_band(1600 * 60), (3, None))
+
+    def test_shared_index(self):
+        tp_index = seg_speed_models.get_shared_time_period_index(
+            TIME_PERIODS)
+        self.assertTrue(tp_index is
+            seg_speed_models.get_shared_time_period_index(list(TIME_PERIODS)))
+
+if __name__ == "__main__":
+    unittest.main()
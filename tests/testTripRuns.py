@@ -0,0 +1,97 @@
+#!/usr/bin/env python2
+
+import unittest
+import os
+import os.path
+import csv
+import shutil
+import tempfile
+
+import transitfeed
+
+import create_gtfs_from_basicinfo
+import gtfs_stream_writer
+
+Trip_Run = create_gtfs_from_basicinfo.Trip_Run
+
+class TestTripRunTryExtend(unittest.TestCase):
+    def test_constant_headway(self):
+        trip_run = Trip_Run(100, 0, 3600, [0, 60, 150])
+        self.assertTrue(trip_run.try_extend(0, 4200, [0, 60, 150]))
+        self.assertTrue(trip_run.try_extend(0, 4800, [0, 60, 150]))
+        self.assertEqual(trip_run.n_trips, 3)
+        self.assertEqual(trip_run.hway_secs, 600)
+        self.assertEqual(trip_run.start_secs, 3600)
+        self.assertEqual(trip_run.last_start_secs, 4800)
+
+    def test_headway_changes(self):
+        trip_run = Trip_Run(100, 0, 3600, [0, 60])
+        self.assertTrue(trip_run.try_extend(0, 4200, [0, 60]))
+        self.assertFalse(trip_run.try_extend(0, 4700, [0, 60]))
+        self.assertEqual(trip_run.n_trips, 2)
+        self.assertEqual(trip_run.last_start_secs, 4200)
+
+    def test_other_period_or_offsets(self):
+        trip_run = Trip_Run(100, 0, 3600, [0, 60])
+        self.assertFalse(trip_run.try_extend(1, 4200, [0, 60]))
+        self.assertFalse(trip_run.try_extend(0, 4200, [0, 61]))
+        self.assertFalse(trip_run.try_extend(0, 3600, [0, 60]))
+        self.assertEqual(trip_run.n_trips, 1)
+        self.assertEqual(trip_run.hway_secs, None)
+
+class TestFrequenciesOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gtfs_writer = gtfs_stream_writer.GTFSStreamWriter(
+            os.path.join(self.tmp_dir, "out.zip"))
+        self.route = transitfeed.Route(short_name="1", long_name="Test",
+            route_type="Bus", route_id="R1")
+        self.period = transitfeed.ServicePeriod("SP1")
+        self.stop_infos = []
+        for stop_i in range(3):
+            gtfs_stop = transitfeed.Stop(lat=-37.8, lng=145.0 + stop_i / 100.0,
+                name="Stop %d" % stop_i, stop_id=str(stop_i))
+            self.stop_infos.append(
+                create_gtfs_from_basicinfo.Seq_Stop_Info(gtfs_stop))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_runs(self, trip_runs):
+        for trip_run in trip_runs:
+            create_gtfs_from_basicinfo.create_gtfs_trip_run(trip_run,
+                self.route, "Out", self.period, self.stop_infos, None,
+                self.gtfs_writer)
+        fnames = self.gtfs_writer.close_fragment()[0]
+        tables = {}
+        for table_fname, fname in fnames.iteritems():
+            in_file = open(fname, 'rb')
+            tables[table_fname] = list(csv.DictReader(in_file))
+            in_file.close()
+        return tables
+
+    def test_run_written_as_frequency(self):
+        trip_run = Trip_Run(100, 0, 3600, [0, 60, 150])
+        trip_run.try_extend(0, 4200, [0, 60, 150])
+        trip_run.try_extend(0, 4800, [0, 60, 150])
+        tables = self.write_runs([trip_run])
+        self.assertEqual([row['trip_id'] for row in tables['trips.txt']],
+            ['100'])
+        self.assertEqual(
+            [row['arrival_time'] for row in tables['stop_times.txt']],
+            ['01:00:00', '01:01:00', '01:02:30'])
+        self.assertEqual(tables['frequencies.txt'], [{'trip_id': '100',
+            'start_time': '01:00:00', 'end_time': '01:30:00',
+            'headway_secs': '600', 'exact_times': '1'}])
+        self.assertEqual(self.gtfs_writer.frequencies_written, 1)
+
+    def test_single_trip_run(self):
+        # Written as a plain trip, without a frequencies entry.
+        trip_run = Trip_Run(100, 0, 3600, [0, 60, 150])
+        tables = self.write_runs([trip_run])
+        self.assertEqual(len(tables['trips.txt']), 1)
+        self.assertEqual(len(tables['stop_times.txt']), 3)
+        self.assertEqual(tables['frequencies.txt'], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python2
+
+import unittest
+
+import topology_shapefile_data_model as tp_model
+import seg_speed_models
+import speed_funcs_vehicle_based
+
+class FakeSegFeature:
+    """Just enough of an OGR feature for reading segment lengths."""
+    def __init__(self, seg_id, length_m):
+        self.fields = {tp_model.SEG_ID_FIELD: str(seg_id),
+            tp_model.SEG_ROUTE_DIST_FIELD: length_m}
+        self.destroyed = False
+
+    def GetField(self, field_name):
+        assert not self.destroyed
+        return self.fields[field_name]
+
+    def Destroy(self):
+        self.destroyed = True
+
+class FakeSegsLayer:
+    def __init__(self, seg_lengths_m):
+        self.seg_lengths_m = seg_lengths_m
+        self.n_reads = 0
+
+    def __iter__(self):
+        self.n_reads += 1
+        for seg_id, length_m in sorted(self.seg_lengths_m.iteritems()):
+            yield FakeSegFeature(seg_id, length_m)
+
+    def ResetReading(self):
+        pass
+
+class TestVehicleAccelDwellSpeedModel(unittest.TestCase):
+    def setUp(self):
+        self.vehicle_params = \
+            speed_funcs_vehicle_based.VEHICLE_CLASS_PARAMS['slow_bus']
+        self.seg_lengths_m = {1: 150.0, 2: 820.0, 3: 2400.0}
+        self.segs_layer = FakeSegsLayer(self.seg_lengths_m)
+        self.speed_model = seg_speed_models.VehicleAccelDwellSpeedModel(
+            self.vehicle_params, length_bucket_m=10)
+        self.speed_model.setup([], self.segs_layer, None, {})
+
+    def test_setup_reads_lengths_once(self):
+        self.assertEqual(self.segs_layer.n_reads, 1)
+        self.assertEqual(self.speed_model.get_setup_state()['seg_lengths_m'],
+            self.seg_lengths_m)
+
+    def test_segment_speeds(self):
+        for seg_id, length_m in self.seg_lengths_m.iteritems():
+            # Speed at the middle of the segment's length bucket.
+            expected_speed = \
+                speed_funcs_vehicle_based.calc_vehicle_speed_bw_stops(
+                    (length_m // 10 + 0.5) * 10,
+                    self.vehicle_params['full_speed'],
+                    self.vehicle_params['accel'],
+                    self.vehicle_params['stop_dwell_time'])
+            speed = self.speed_model.save_extra_seg_speed_info(
+                FakeSegFeature(seg_id, length_m), None, None)
+            self.assertAlmostEqual(speed, expected_speed)
+            self.assertEqual(self.speed_model.get_speed_on_next_segment(
+                speed, None, False), speed)
+
+    def test_restored_setup_state(self):
+        # Lengths come from setup, not the segment features.
+        speed_model = seg_speed_models.VehicleAccelDwellSpeedModel(
+            length_bucket_m=10)
+        speed_model.set_setup_state(self.speed_model.get_setup_state())
+        seg_feature = FakeSegFeature(2, None)
+        self.assertAlmostEqual(
+            speed_model.save_extra_seg_speed_info(seg_feature, None, None),
+            self.speed_model.calc_speeds_for_lengths([820.0])[0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,12 +5,107 @@ from datetime import time, datetime, date, timedelta
 import csv
 import glob
 import shutil
+import copy
+from collections import OrderedDict
+from StringIO import StringIO
 
 import misc_utils
+import speeds_pack
 
 AVG_SPEED_HEADERS = ['Stop_a_id','Stop_a_name','Stop_b_id','Stop_b_name',\
         'seg_dist_m'] # then time periods follow.
 
+# Max number of parsed speed files kept in the parsed speeds cache.
+DEFAULT_SPEEDS_CACHE_SIZE = 256
+
+class ReadOnlyDict(dict):
+    """A dict that can't be changed after creation, so parsed speed file
+    contents can be safely shared by everything that reads them. (Copies,
+    deep copies and pickles of it are read-only too :- use dict() on it to
+    get a copy that can be changed.)"""
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Parsed speeds info is read-only, copy it with "\
+            "dict() first.")
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+    # The default ways of copying and pickling dict sub-classes fill in the
+    #  new dict item by item, so would fail.
+    def __reduce__(self):
+        return (ReadOnlyDict, (dict(self),))
+
+    def __copy__(self):
+        return ReadOnlyDict(self)
+
+    def __deepcopy__(self, memo):
+        return ReadOnlyDict(copy.deepcopy(dict(self), memo))
+
+class ParsedSpeedsCache:
+    """A bounded LRU cache of parsed speed files, keyed by file path (and
+    whether stop ID pairs were sorted). Entries are only re-used if the
+    file's modification time and size are still the same as when it was
+    parsed."""
+    def __init__(self, max_entries=DEFAULT_SPEEDS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, csv_fname, sort_seg_stop_id_pairs):
+        stamp = get_speeds_file_stamp(csv_fname)
+        if stamp is None:
+            # Doesn't exist :- parsing raises the right error.
+            self.misses += 1
+            return parse_avg_speeds_file(csv_fname, sort_seg_stop_id_pairs)
+        key = (csv_fname, sort_seg_stop_id_pairs)
+        try:
+            entry_stamp, parsed_info = self._entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            if entry_stamp == stamp:
+                self.hits += 1
+                # Re-insert as most recently used.
+                self._entries[key] = (entry_stamp, parsed_info)
+                return parsed_info
+        self.misses += 1
+        parsed_info = parse_avg_speeds_file(csv_fname, sort_seg_stop_id_pairs)
+        self._entries[key] = (stamp, parsed_info)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return parsed_info
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_parsed_speeds_cache = ParsedSpeedsCache()
+
+def get_parsed_speeds_cache():
+    """The cache shared by all reads of speed files in this process."""
+    return _parsed_speeds_cache
+
+def get_speeds_file_stamp(csv_fname):
+    """Returns a tuple of modification time and size of a speeds file (of
+    the whole pack file, for one in a pack), or None if it doesn't exist."""
+    pack_entry = speeds_pack.get_pack_entry(csv_fname)
+    if pack_entry:
+        stat_fname = pack_entry[0].pack_fname
+    else:
+        stat_fname = misc_utils.get_win_safe_path(csv_fname)
+    try:
+        file_stat = os.stat(stat_fname)
+    except OSError:
+        return None
+    return file_stat.st_mtime, file_stat.st_size
+
 def get_route_avg_speeds_for_dir_period_fname(r_short_name, r_long_name,
         serv_period, route_dir):
     rname_file_ready = misc_utils.routeNameFileReady(r_short_name, r_long_name)
@@ -37,6 +132,19 @@ def get_info_from_fname(route_speeds_fname, r_s_name=None, r_l_name=None):
             name_a = None
     return name_a, name_b, trips_dir_file_ready, serv_period 
 
+def glob_speeds_dir(speeds_dir, fname_match):
+    """Paths of the files in speeds_dir matching fname_match, where
+    speeds_dir can also be a speeds pack file (see speeds_pack), in which case
+    the paths are of files in the pack."""
+    if speeds_pack.is_speeds_pack(speeds_dir):
+        pack = speeds_pack.open_speeds_pack(speeds_dir)
+        return [os.path.join(speeds_dir, fname) for fname in \
+            pack.get_fnames_matching(fname_match)]
+    return glob.glob("%s%s%s" % (speeds_dir, os.sep, fname_match))
+
+def get_all_avg_speeds_fnames(speeds_dir):
+    return glob_speeds_dir(speeds_dir, speeds_pack.SPEEDS_FNAME_MATCH)
+
 def get_avg_speeds_fnames(speeds_dir, r_short_name, r_long_name):
     # The match depends on if we've specified both old route short
     # and long names. If only one specified, need looser search.
@@ -44,34 +152,35 @@ def get_avg_speeds_fnames(speeds_dir, r_short_name, r_long_name):
         r_short_name, r_long_name)
     match_exps = []
     if r_short_name and r_long_name:
-        match_exps.append("%s%s%s-speeds-*-all.csv" \
-            % (speeds_dir, os.sep, route_print_name))
+        match_exps.append("%s-speeds-*-all.csv" % route_print_name)
     elif r_short_name:
-        match_exps.append("%s%s%s-speeds-*-all.csv" \
-            % (speeds_dir, os.sep, route_print_name))
-        match_exps.append("%s%s%s-*-speeds-*-all.csv" \
-            % (speeds_dir, os.sep, route_print_name))
+        match_exps.append("%s-speeds-*-all.csv" % route_print_name)
+        match_exps.append("%s-*-speeds-*-all.csv" % route_print_name)
     elif r_long_name:            
-        match_exps.append("%s%s%s-speeds-*-all.csv" \
-            % (speeds_dir, os.sep, route_print_name))
-        match_exps.append("%s%s*-%s-speeds-*-all.csv" \
-            % (speeds_dir, os.sep, route_print_name))
+        match_exps.append("%s-speeds-*-all.csv" % route_print_name)
+        match_exps.append("*-%s-speeds-*-all.csv" % route_print_name)
     route_speeds_fnames = []
     for match_exp in match_exps:    
-        route_speeds_fnames += glob.glob(match_exp)
+        route_speeds_fnames += glob_speeds_dir(speeds_dir, match_exp)
     return route_speeds_fnames
 
 def copy_route_speeds(r_short_name, r_long_name, speeds_dir_in,
         speeds_dir_out):
     route_print_name = misc_utils.routeNameFileReady(
         r_short_name, r_long_name)
-    route_speeds_fnames = glob.glob(
-        "%s%s%s-speeds-*-all.csv" % (speeds_dir_in, os.sep, \
-            route_print_name))
+    route_speeds_fnames = glob_speeds_dir(speeds_dir_in,
+        "%s-speeds-*-all.csv" % route_print_name)
     copy_path_out = misc_utils.get_win_safe_path(speeds_dir_out)
     for speeds_fname in route_speeds_fnames:
-        copy_path_in = misc_utils.get_win_safe_path(speeds_fname)
-        shutil.copy(copy_path_in, copy_path_out)
+        pack_entry = speeds_pack.get_pack_entry(speeds_fname)
+        if pack_entry:
+            pack, entry_fname = pack_entry
+            out_file = open(os.path.join(copy_path_out, entry_fname), 'wb')
+            out_file.write(pack.get_contents(entry_fname))
+            out_file.close()
+        else:
+            copy_path_in = misc_utils.get_win_safe_path(speeds_fname)
+            shutil.copy(copy_path_in, copy_path_out)
     return
 
 
@@ -105,7 +214,7 @@ def write_avg_speeds_on_segments(stop_gtfs_ids_to_names_map, period_avg_speeds,
             [s_id_pair[0], stop_gtfs_ids_to_names_map[int(s_id_pair[0])], \
             s_id_pair[1],  stop_gtfs_ids_to_names_map[int(s_id_pair[1])], \
             dist] \
-            + avg_speeds_on_seg_output)
+            + list(avg_speeds_on_seg_output))
     csv_file.close()
     return
 
@@ -127,8 +236,23 @@ def read_route_speed_info_by_time_periods(read_dir, r_short_name, r_long_name,
         stop_gtfs_ids_to_names_map
 
 def read_avg_speeds_on_segments(csv_fname, sort_seg_stop_id_pairs=False):
-    safe_fpath = misc_utils.get_win_safe_path(csv_fname)
-    csv_file = open(safe_fpath, 'r')
+    """Returns a tuple of the time periods, speeds in each period (keyed by
+    stop ID pair), segment distances, and stop names by GTFS ID, read from
+    a speeds file. Results are cached, and read-only."""
+    return _parsed_speeds_cache.get(csv_fname, sort_seg_stop_id_pairs)
+
+def parse_avg_speeds_file(csv_fname, sort_seg_stop_id_pairs=False):
+    pack_entry = speeds_pack.get_pack_entry(csv_fname)
+    if pack_entry:
+        pack, entry_fname = pack_entry
+        contents = pack.get_contents(entry_fname)
+        if contents is None:
+            raise IOError("No speeds file %s in speeds pack %s." \
+                % (entry_fname, pack.pack_fname))
+        csv_file = StringIO(contents)
+    else:
+        safe_fpath = misc_utils.get_win_safe_path(csv_fname)
+        csv_file = open(safe_fpath, 'r')
     reader = csv.reader(csv_file, delimiter=';')
 
     headers = reader.next()
@@ -157,9 +281,9 @@ def read_avg_speeds_on_segments(csv_fname, sort_seg_stop_id_pairs=False):
         if sort_seg_stop_id_pairs:
             stop_ids = tuple(map(str, sorted(map(int, stop_ids))))
         seg_distances[stop_ids] = float(row[dist_row_i])
-        speeds_in_tps = map(float, row[len(AVG_SPEED_HEADERS):])
+        speeds_in_tps = tuple(map(float, row[len(AVG_SPEED_HEADERS):]))
         r_avg_speeds_on_segs[stop_ids] = speeds_in_tps
     csv_file.close()
-    return time_periods, r_avg_speeds_on_segs, seg_distances, \
-        stop_gtfs_ids_to_names_map
+    return tuple(time_periods), ReadOnlyDict(r_avg_speeds_on_segs), \
+        ReadOnlyDict(seg_distances), ReadOnlyDict(stop_gtfs_ids_to_names_map)
 